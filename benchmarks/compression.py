@@ -0,0 +1,74 @@
+"""Compare bytes on the wire and CPU time for each way of compressing a
+stream of small messages, in both codecs.
+
+Run from the repository root:
+
+    python benchmarks/compression.py
+"""
+
+import os
+import sys
+import time
+import random
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from encodium import Encodium, Integer, String, Boolean
+from encodium.compress import build_dictionary, compress, decompress, Compressor, Decompressor
+
+
+class Person(Encodium):
+    age = Integer.Definition(non_negative=True)
+    name = String.Definition()
+    diabetic = Boolean.Definition(default=True)
+
+
+def people(n, seed):
+    rng = random.Random(seed)
+    names = ['John', 'Jane', 'Lucy', 'Sam', 'Alex', 'Kim']
+    return [Person(age=rng.randrange(100), name='%s %d' % (rng.choice(names), rng.randrange(1000)),
+                   diabetic=rng.random() < 0.1) for _ in range(n)]
+
+
+def per_message(zdict):
+    def run(messages):
+        compressed = [compress(data, zdict) for data in messages]
+        for data in compressed:
+            decompress(data, zdict)
+        return compressed
+    return run
+
+
+def streaming(zdict):
+    def run(messages):
+        compressor, decompressor = Compressor(zdict), Decompressor(zdict)
+        compressed = [compressor.compress(data) for data in messages]
+        for data in compressed:
+            decompressor.decompress(data)
+        return compressed
+    return run
+
+
+def main():
+    messages = people(5000, 0)
+    print('%-8s %-24s %10s %8s %12s' % ('codec', 'method', 'bytes', 'ratio', 'us/message'))
+    for codec in ('bencode', 'json'):
+        encoded = [person.to_bencode() if codec == 'bencode' else person.to_json().encode() for person in messages]
+        raw = sum(map(len, encoded))
+        zdict = build_dictionary(Person, samples=people(20, 1), codec=codec)
+        methods = [
+            ('none', lambda messages: messages),
+            ('per message', per_message(None)),
+            ('per message, dictionary', per_message(zdict)),
+            ('stream', streaming(None)),
+            ('stream, dictionary', streaming(zdict)),
+        ]
+        for label, method in methods:
+            start = time.perf_counter()
+            size = sum(map(len, method(encoded)))
+            elapsed = time.perf_counter() - start
+            print('%-8s %-24s %10d %8.2f %12.2f' % (codec, label, size, raw / size, elapsed / len(encoded) * 1e6))
+
+
+if __name__ == '__main__':
+    main()
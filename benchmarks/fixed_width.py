@@ -0,0 +1,53 @@
+"""Compare fixed-width numbers with Integer in bencode: size and speed.
+
+Run from the repository root:
+
+    python benchmarks/fixed_width.py
+"""
+
+import os
+import sys
+import random
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from encodium import Encodium, Integer, List, UInt16, UInt32, Int64, Float64
+
+
+def reading(definition):
+    class Reading(Encodium):
+        sensor = definition
+        samples = List.Definition(definition)
+    return Reading
+
+
+TYPES = [
+    ('Integer', Integer.Definition()),
+    ('UInt16', UInt16.Definition()),
+    ('UInt32', UInt32.Definition()),
+    ('Int64', Int64.Definition()),
+    ('Float64', Float64.Definition()),
+]
+
+
+def best(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    rng = random.Random(0)
+    values = [rng.randrange(65536) for _ in range(1000)]
+    print('%-8s %8s %14s %14s' % ('type', 'bytes', 'encode (us)', 'decode (us)'))
+    for label, definition in TYPES:
+        cls = reading(definition)
+        samples = [float(value) for value in values] if label == 'Float64' else values
+        message = cls(sensor=samples[0], samples=samples)
+        data = message.to_bencode()
+        assert cls.from_bencode(data) == message
+        print('%-8s %8d %14.1f %14.1f' % (label, len(data), best(message.to_bencode, 200),
+                                          best(lambda: cls.from_bencode(data), 200)))
+
+
+if __name__ == '__main__':
+    main()
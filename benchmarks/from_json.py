@@ -0,0 +1,70 @@
+"""Break from_json() down into parsing and building objects.
+
+from_json() parses with the selected JSON backend and then calls from_obj().
+A schema-driven parser written in Python, which built objects as it parsed,
+was 1.3-2.8x slower than this on the stdlib backend, so the dict tree is
+kept. The parse column shows how much of the time it could ever save.
+
+Run from the repository root:
+
+    python benchmarks/from_json.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import encodium
+from encodium import Encodium, Integer, String, Boolean, List, Bytes
+
+
+class Person(Encodium):
+    age = Integer.Definition(non_negative=True)
+    name = String.Definition()
+    diabetic = Boolean.Definition(default=True)
+
+
+class Party(Encodium):
+    people = List.Definition(Person.Definition())
+
+
+class City(Encodium):
+    parties = List.Definition(Party.Definition())
+
+
+class Upload(Encodium):
+    data = Bytes.Definition()
+    owner = Person.Definition()
+
+
+MESSAGES = [
+    ('small', Person(age=30, name='John')),
+    ('nested', City(parties=[Party(people=[Person(age=i, name='Person %d' % i) for i in range(50)]) for _ in range(20)])),
+    ('bytes', Upload(data=b'x' * 100000, owner=Person(age=30, name='John'))),
+]
+
+
+def best(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print('%-8s %-8s %12s %12s %12s' % ('message', 'backend', 'parse (us)', 'build (us)', 'total (us)'))
+    for label, message in MESSAGES:
+        cls = type(message)
+        data = message.to_json()
+        number = max(1, 20000 // len(data))
+        for name, backend in encodium.json_backends.items():
+            encodium.set_json_backend(name)
+            obj = backend.loads(data)
+            parse = best(lambda: backend.loads(data), number)
+            build = best(lambda: cls.from_obj(obj), number)
+            total = best(lambda: cls.from_json(data), number)
+            print('%-8s %-8s %12.1f %12.1f %12.1f' % (label, name, parse, build, total))
+    encodium.set_json_backend()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,73 @@
+"""Compare to_json() and from_json() on each available JSON backend.
+
+Run from the repository root:
+
+    python benchmarks/json_backends.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+import encodium
+from encodium import Encodium, Integer, String, Boolean, List, Map, Bytes
+
+
+class Person(Encodium):
+    age = Integer.Definition(non_negative=True)
+    name = String.Definition()
+    diabetic = Boolean.Definition(default=True)
+
+
+class Party(Encodium):
+    people = List.Definition(Person.Definition())
+
+
+class City(Encodium):
+    parties = List.Definition(Party.Definition())
+
+
+class Census(Encodium):
+    ages = Map.Definition(String.Definition(), Integer.Definition())
+
+
+class Upload(Encodium):
+    data = Bytes.Definition()
+    owner = Person.Definition()
+
+
+MESSAGES = [
+    ('small', Person(age=30, name='John')),
+    ('nested', City(parties=[Party(people=[Person(age=i, name='Person %d' % i) for i in range(50)]) for _ in range(20)])),
+    ('map', Census(ages={'person %d' % i: i for i in range(1000)})),
+    ('bytes', Upload(data=b'x' * 100000, owner=Person(age=30, name='John'))),
+]
+
+
+def best(function, number):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print('%-8s %-8s %14s %14s' % ('message', 'backend', 'encode (us)', 'decode (us)'))
+    for label, message in MESSAGES:
+        cls = type(message)
+        data = message.to_json()
+        number = max(1, 20000 // len(data))
+        baseline = None
+        for name in reversed(encodium.json_backends):
+            encodium.set_json_backend(name)
+            assert message.to_json() == data
+            times = (best(message.to_json, number), best(lambda: cls.from_json(data), number))
+            if baseline is None:
+                baseline = times
+                print('%-8s %-8s %14.1f %14.1f' % (label, name, times[0], times[1]))
+            else:
+                print('%-8s %-8s %8.1f %4.1fx %8.1f %4.1fx' % (label, name, times[0], baseline[0] / times[0], times[1], baseline[1] / times[1]))
+    encodium.set_json_backend()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,88 @@
+"""Compare RPC throughput against one call per socket with send_to/recv_from.
+
+Run from the repository root:
+
+    python benchmarks/rpc.py
+"""
+
+import os
+import sys
+import time
+import socket
+import socketserver
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from encodium import Encodium, Integer, String, Boolean
+from encodium.rpc import Method, LoopbackServer, ConnectionPool
+
+
+class Person(Encodium):
+    age = Integer.Definition(non_negative=True)
+    name = String.Definition()
+    diabetic = Boolean.Definition(default=True)
+
+
+class Lookup(Encodium):
+    name = String.Definition()
+
+
+PEOPLE = {'Person %d' % i: Person(age=i, name='Person %d' % i) for i in range(100)}
+NAMES = sorted(PEOPLE)
+CALLS = 2000
+
+
+class OneShotHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        PEOPLE[Lookup.recv_from(self.request).name].send_to(self.request)
+
+
+def one_call_per_socket(address):
+    for i in range(CALLS):
+        sock = socket.create_connection(address)
+        try:
+            Lookup(name=NAMES[i % len(NAMES)]).send_to(sock)
+            Person.recv_from(sock)
+        finally:
+            sock.close()
+
+
+def sequential(connection, lookup):
+    for i in range(CALLS):
+        connection.call(lookup, Lookup(name=NAMES[i % len(NAMES)]))
+
+
+def pipelined(connection, lookup):
+    futures = [connection.call_async(lookup, Lookup(name=NAMES[i % len(NAMES)])) for i in range(CALLS)]
+    for future in futures:
+        future.result()
+
+
+def report(label, function, *args):
+    start = time.perf_counter()
+    function(*args)
+    elapsed = time.perf_counter() - start
+    print('%-22s %10.0f calls/s' % (label, CALLS / elapsed))
+
+
+def main():
+    one_shot = socketserver.ThreadingTCPServer(('127.0.0.1', 0), OneShotHandler)
+    one_shot.daemon_threads = True
+    threading.Thread(target=one_shot.serve_forever, daemon=True).start()
+    lookup = Method('lookup', Lookup, Person)
+    pool = ConnectionPool()
+    try:
+        with LoopbackServer({lookup: lambda request: PEOPLE[request.name]}) as server:
+            connection = pool.get(server.address)
+            report('one call per socket', one_call_per_socket, one_shot.server_address)
+            report('rpc, one at a time', sequential, connection, lookup)
+            report('rpc, pipelined', pipelined, connection, lookup)
+    finally:
+        pool.close()
+        one_shot.shutdown()
+        one_shot.server_close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,172 @@
+"""Benchmark encodium.server against a thread per connection.
+
+The first part runs the same blocking clients against Server and against a
+socketserver.ThreadingTCPServer which uses recv_from() and send_to(). The
+second measures the latency of small requests while another connection
+sends large ones, with and without offloading their decoding.
+
+Run from the repository root:
+
+    python benchmarks/server.py
+"""
+
+import os
+import sys
+import time
+import socket
+import asyncio
+import threading
+import socketserver
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from encodium import Encodium, Integer, String, Boolean, List
+from encodium.server import Server
+
+
+class Person(Encodium):
+    age = Integer.Definition(non_negative=True)
+    name = String.Definition()
+    diabetic = Boolean.Definition(default=True)
+
+
+class Crowd(Encodium):
+    people = List.Definition(Person.Definition())
+
+
+def older(request):
+    return Person(age=request.age + 1, name=request.name)
+
+
+class ServerThread:
+    ''' Runs a Server on its own event loop, so clients can block. '''
+
+    def __init__(self, cls, handler, **kwargs):
+        self._args = (cls, handler, kwargs)
+        self._ready = threading.Event()
+        self._thread = threading.Thread(target=lambda: asyncio.run(self._main()), daemon=True)
+
+    async def _main(self):
+        cls, handler, kwargs = self._args
+        self._loop = asyncio.get_running_loop()
+        self._stop = asyncio.Event()
+        async with Server(cls, handler, **kwargs) as server:
+            self.address = server.address
+            self._ready.set()
+            await self._stop.wait()
+
+    def __enter__(self):
+        self._thread.start()
+        self._ready.wait()
+        return self
+
+    def __exit__(self, *exc_info):
+        self._loop.call_soon_threadsafe(self._stop.set)
+        self._thread.join()
+
+
+class ThreadedHandler(socketserver.BaseRequestHandler):
+    def handle(self):
+        while True:
+            try:
+                request = Person.recv_from(self.request)
+            except ConnectionError:
+                return
+            older(request).send_to(self.request)
+
+
+def client(address, count, pipelined):
+    sock = socket.create_connection(address)
+    replies = sock.makefile('rb')
+    try:
+        requests = [Person(age=i, name='Person %d' % i) for i in range(count)]
+        if pipelined:
+            Encodium.send_many(sock, requests)
+            for _ in requests:
+                Person.from_json(replies.readline())
+        else:
+            for request in requests:
+                request.send_to(sock)
+                Person.from_json(replies.readline())
+    finally:
+        replies.close()
+        sock.close()
+
+
+def throughput(address, clients, count, pipelined):
+    threads = [threading.Thread(target=client, args=(address, count, pipelined)) for _ in range(clients)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    return clients * count / (time.perf_counter() - start)
+
+
+def small_latency(address, stop):
+    sock = socket.create_connection(address)
+    replies = sock.makefile('rb')
+    latencies = []
+    try:
+        while not stop.is_set():
+            start = time.perf_counter()
+            Crowd(people=[Person(age=1, name='Small')]).send_to(sock)
+            Crowd.from_json(replies.readline())
+            latencies.append(time.perf_counter() - start)
+    finally:
+        replies.close()
+        sock.close()
+    return latencies
+
+
+def large_sender(address, count):
+    crowd = Crowd(people=[Person(age=i % 100, name='Person %d' % i) for i in range(20000)])
+    sock = socket.create_connection(address)
+    replies = sock.makefile('rb')
+    try:
+        for _ in range(count):
+            crowd.send_to(sock)
+            replies.readline()
+    finally:
+        replies.close()
+        sock.close()
+
+
+def offload(offload_size):
+    results = []
+    stop = threading.Event()
+    with ServerThread(Crowd, lambda crowd: Crowd(people=crowd.people[:1]), offload_size=offload_size) as server:
+        small = threading.Thread(target=lambda: results.extend(small_latency(server.address, stop)))
+        small.start()
+        large_sender(server.address, 10)
+        stop.set()
+        small.join()
+    results.sort()
+    return results[len(results) // 2], results[int(len(results) * 0.99)], results[-1]
+
+
+def main():
+    threaded = socketserver.ThreadingTCPServer(('127.0.0.1', 0), ThreadedHandler)
+    threaded.daemon_threads = True
+    threading.Thread(target=threaded.serve_forever, daemon=True).start()
+    print('%-34s %12s' % ('clients x requests', 'requests/s'))
+    try:
+        with ServerThread(Person, older, max_pending=64) as server:
+            for clients, count in ((1, 2000), (20, 200), (100, 40)):
+                for label, address, pipelined in (('threads', threaded.server_address, False),
+                                                  ('Server', server.address, False),
+                                                  ('Server, pipelined', server.address, True)):
+                    rate = throughput(address, clients, count, pipelined)
+                    print('%3d x %-5d %-22s %12.0f' % (clients, count, label, rate))
+    finally:
+        threaded.shutdown()
+        threaded.server_close()
+
+    print()
+    print('%-34s %8s %8s %8s' % ('small requests beside large ones', 'p50 ms', 'p99 ms', 'max ms'))
+    for label, offload_size in (('decoded on the loop', 2 ** 30), ('decoded in the executor', 65536)):
+        print('%-34s %8.2f %8.2f %8.2f' % ((label,) + tuple(latency * 1000 for latency in offload(offload_size))))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,56 @@
+"""Measure how encode_many() and decode_many() scale with threads.
+
+Threads only run in parallel on a free-threaded build of Python, so run
+this on both kinds of interpreter. The header says which one it is.
+
+Run from the repository root:
+
+    python benchmarks/threads.py
+"""
+
+import os
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from encodium import Encodium, Integer, String, Boolean, List
+
+
+class Person(Encodium):
+    age = Integer.Definition(non_negative=True)
+    name = String.Definition()
+    diabetic = Boolean.Definition(default=True)
+
+
+class Party(Encodium):
+    people = List.Definition(Person.Definition())
+
+
+def timed(function, *args, **kwargs):
+    start = time.perf_counter()
+    function(*args, **kwargs)
+    return time.perf_counter() - start
+
+
+def main():
+    gil = sys._is_gil_enabled() if hasattr(sys, '_is_gil_enabled') else True
+    print('Python %s, GIL %s, %d CPUs' % (sys.version.split()[0], 'enabled' if gil else 'disabled', os.cpu_count()))
+    parties = [Party(people=[Person(age=i % 100, name='Person %d' % i) for i in range(20)]) for _ in range(5000)]
+    for codec in ('bencode', 'json'):
+        items = Encodium.encode_many(parties, codec)
+        encode = timed(Encodium.encode_many, parties, codec)
+        decode = timed(Party.decode_many, items, codec)
+        print()
+        print('%-8s %-8s %12s %8s %12s %8s' % (codec, 'threads', 'encode (s)', 'speedup', 'decode (s)', 'speedup'))
+        print('%-8s %-8s %12.3f %8s %12.3f %8s' % ('', 'none', encode, '', decode, ''))
+        for workers in (1, 2, 4, 8):
+            with ThreadPoolExecutor(workers) as executor:
+                encoded = timed(Encodium.encode_many, parties, codec, executor)
+                decoded = timed(Party.decode_many, items, codec, executor)
+            print('%-8s %-8d %12.3f %7.1fx %12.3f %7.1fx' % ('', workers, encoded, encode / encoded, decoded, decode / decoded))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,54 @@
+"""Compare Encodium.try_from_obj against catching ValidationError from from_obj.
+
+Run from the repository root:
+
+    python benchmarks/try_from_obj.py
+"""
+
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from encodium import Encodium, Integer, String, Boolean, ValidationError
+
+
+class Person(Encodium):
+    age = Integer.Definition(non_negative=True)
+    name = String.Definition(max_length=50)
+    diabetic = Boolean.Definition(default=True)
+    optional = Integer.Definition(optional=True)
+
+
+CASES = [
+    ('negative age', {'age': -1, 'name': 'x'}),
+    ('wrong type', {'age': 'x', 'name': 'x'}),
+    ('missing field', {'name': 'x'}),
+    ('name too long', {'age': 1, 'name': 'x' * 60}),
+    ('valid', {'age': 1, 'name': 'x'}),
+]
+
+
+def best(function, number=20000):
+    return min(timeit.repeat(function, number=number, repeat=5)) / number * 1e6
+
+
+def main():
+    print('%-16s %12s %12s %8s' % ('case', 'catch (us)', 'try (us)', 'speedup'))
+    for label, obj in CASES:
+        def catching():
+            try:
+                Person.from_obj(obj)
+            except ValidationError:
+                pass
+
+        def trying():
+            Person.try_from_obj(obj)
+
+        caught, tried = best(catching), best(trying)
+        print('%-16s %12.2f %12.2f %7.1fx' % (label, caught, tried, caught / tried))
+
+
+if __name__ == '__main__':
+    main()
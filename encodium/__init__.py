@@ -59,7 +59,13 @@ The following arguments are included by default:
 
 * ``optional`` -- Whether or not the attribute is allowed to be None.
 * ``default`` -- The default value to set the attribute to, if it is not
-  provided.
+  provided. A constant default is validated once, when the class is
+  created. A callable default is called for each new object, and its result
+  is validated unless ``trusted_default`` is set.
+* ``trusted_default`` -- Whether the results of a callable default are always
+  valid, so they can skip validation.
+* ``indexed`` -- Whether a ``RecordStore`` should keep an index of the
+  attribute's values (see ``encodium.store``).
 
 Some examples::
 
@@ -97,6 +103,86 @@ Here's an example to illustrates this::
             if self.hash != expected_hash:
                 raise ValidationError('has an invalid hash')
 
+Filtering Invalid Objects
+-------------------------
+
+When many objects are expected to be invalid, ``try_from_obj()`` is faster
+than catching ``ValidationError``. It returns a ``ValidationResult``, which is
+true if the object was valid::
+
+    result = Person.try_from_obj(obj, all_errors=True)
+    if result:
+        people.append(result.value)
+    else:
+        for error in result.errors:
+            print(error.field, error.code, error.message)
+
+Each ``FieldError`` has a ``code``: ``'missing'``, ``'type'``, ``'decode'``
+(``from_obj()`` failed), ``'value'`` (``check_value()`` failed),
+``'unknown'`` or ``'check'``. Fields of nested objects, and the items of
+lists and maps, are named like ``'parties[0].people[2].age'``, and messages
+are only built when asked for. ``result.get()`` returns the object or
+raises the first error.
+
+Unknown Fields
+--------------
+
+Fields which aren't part of the class, for example those sent by a newer
+version of a message, are ignored by default. Setting
+``_encodium_unknown_fields`` on the class changes this::
+
+    class Person(Encodium):
+        _encodium_unknown_fields = 'collect'
+        ...
+
+* ``'ignore'`` -- Drop unknown fields.
+* ``'collect'`` -- Keep them in the object's ``_encodium_unknown`` dict.
+* ``'error'`` -- Raise a ``ValidationError``.
+
+In every case ``Person._encodium_unknown_count`` counts the unknown fields
+seen.
+
+Fixed-width Numbers
+-------------------
+
+``UInt8``, ``UInt16``, ``UInt32`` and ``UInt64``, their signed ``Int``
+equivalents, ``Float32`` and ``Float64`` only accept values that fit in their
+width. In bencode they are packed into byte strings with ``struct``, which is
+smaller and faster than ASCII digits, and a ``List`` of them is packed into a
+single byte string. In JSON they are ordinary numbers::
+
+    class Reading(Encodium):
+        sensor = UInt16.Definition()
+        samples = List.Definition(Float32.Definition())
+
+Maps
+----
+
+``Map.Definition(key_definition, value_definition)`` holds a dict. Keys may
+be ``String``, ``Bytes`` or ``Integer`` and both keys and values are validated
+by their definitions::
+
+    class Census(Encodium):
+        ages = Map.Definition(String.Definition(), Integer.Definition())
+
+A map is encoded as a native bencode or JSON dict with its keys sorted, so
+equal maps always have the same encoding. Integer keys are encoded as
+strings, and ``Bytes`` keys are base64 encoded in JSON.
+
+Repeated Strings
+----------------
+
+Strings which repeat across many objects, such as country codes, can share
+one ``str`` per distinct value when decoded::
+
+    class Order(Encodium):
+        country = String.Definition(intern=True)
+        status = Enum.Definition(values=('open', 'paid', 'shipped'))
+
+Each interned field keeps its own cache of up to ``intern_limit`` (1024)
+values; values decoded after it fills are not shared. An ``Enum`` only
+accepts its ``values``, and always decodes to the same objects.
+
 Custom Constraints
 ------------------
 
@@ -118,6 +204,16 @@ Note that `_encodium_type` can be used to override the expected type.
 Otherwise the class that `Definition` is nested inside will be used
 automatically if it inherits from `Encodium`.
 
+A definition remembers the Encodium objects it has accepted, and doesn't
+call ``check_value()`` on one again until it is changed with ``change()`` or
+by setting a field. Changes made in place, such as appending to a ``List``
+field or changing a nested object, aren't noticed. If a ``check_value()``
+depends on them, call ``change()`` with the edited value before reusing the
+object::
+
+    crowd.people.append(john)
+    crowd.change(people=crowd.people)
+
 Recursive Definitions
 ---------------------
 
@@ -136,6 +232,99 @@ instead of ``ClassName.Definition(...)``, as thus::
         right = Encodium.Definition('Tree', optional=True)
         value = String.Definition()
 
+Patches
+-------
+
+Rather than re-sending a whole object after a small edit, ``diff()`` produces
+a patch containing only the fields that changed, which ``apply_patch()``
+applies to the old version::
+
+    patch = new_john.diff(john, codec='bencode')
+    john.apply_patch(patch)
+
+Nested ``Encodium`` fields are patched recursively, and ``List`` fields are
+patched element by element. Only the patched fields are validated.
+
+Similarly, ``evolve()`` returns a modified copy of an object, sharing the
+unchanged values and validating only the changed ones::
+
+    older_john = john.evolve(age=26)
+
+Encoded Sizes
+-------------
+
+``encoded_size()`` gives the exact length of an object's bencoding (or JSON,
+with ``codec='json'``) without encoding it, and ``encode_into()`` writes the
+encoding straight into a preallocated buffer::
+
+    buffer = bytearray(sum([person.encoded_size() for person in people]))
+    offset = 0
+    for person in people:
+        offset = person.encode_into(buffer, offset)
+
+JSON Backends
+-------------
+
+``to_json()`` and ``from_json()`` use orjson or ujson if either is installed,
+and the standard library otherwise. The output is the same whichever is
+used: compact, with sorted keys and only ASCII characters. The backend can
+be chosen by name, or with the ``ENCODIUM_JSON_BACKEND`` environment
+variable::
+
+    import encodium
+    encodium.set_json_backend('json')
+
+``encodium.json_backends`` holds the available backends.
+
+The backends encode ``to_json_primitive()``, so that is the hook for
+changing how a value is written. A class, or a ``Definition`` used anywhere
+inside it, may still override ``to_json()`` instead; such classes are
+encoded field by field as before, by the standard library, and
+``encoded_size()`` and ``encode_into()`` follow the override.
+
+Graphs
+------
+
+``to_bencode()`` encodes a nested object in full everywhere it appears, and
+decoding creates a separate copy for each appearance. ``to_graph()``
+encodes each distinct object once instead, and ``from_graph()`` shares the
+decoded object wherever the original was shared::
+
+    data = city.to_graph()
+    city = City.from_graph(data)
+
+The encoding is a list of the objects' primitives, with nested objects
+replaced by their position in the list. The outermost object is last.
+``codec='json'`` may be given to both.
+
+Batches and Threads
+-------------------
+
+``encode_many()`` and ``decode_many()`` encode or decode a list of objects,
+optionally spread over the workers of an executor::
+
+    with ThreadPoolExecutor() as executor:
+        data = Encodium.encode_many(people, executor=executor)
+        people = Person.decode_many(data, executor=executor)
+
+Both take ``codec='json'`` too. Threads only speed this up on a
+free-threaded build of Python. Classes and definitions are only read once
+they are created, so objects may be encoded, decoded and validated from
+any number of threads, as long as no thread changes an object while others
+use it.
+
+Streaming
+---------
+
+The items of a large ``List`` field can be decoded one at a time from a file
+or socket, using bounded memory::
+
+    for party in City.iter_field(f, 'parties'):
+        ...
+
+See ``encodium.stream`` for details, and for ``scan()``, which filters a file
+of records before decoding them.
+
 Transmitting over a Socket
 --------------------------
 
@@ -147,16 +336,48 @@ Here's an example::
 The default encoding is JSON, but will have the option to specify alternative
 encodings soon.
 
+Batches of objects can be sent and received with fewer system calls::
+
+    Person.send_many(sock, people)
+    people = Person.recv_many(sock, max_items=100)
+
+``encodium.server`` serves a handler for objects in this format with
+asyncio. ``encodium.compress`` has compressed streams, which use a preset
+dictionary built from a class's field names.
+
 '''
 
+import os
 import sys
+import copy
 import json
+import math
+import socket
+import struct
 import base64
 import binascii
+import threading
+from types import MappingProxyType
 from collections import OrderedDict
 
 from bencodepy import encode as to_bencode, decode as from_bencode
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import ujson
+except ImportError:
+    ujson = None
+
+# The most buffers a single sendmsg() call may be given on most platforms.
+_IOV_MAX = 1024
+
+# Guards the counters and caches which are shared by every thread.
+_lock = threading.Lock()
+
 class ValidationError(Exception):
     ''' Raise in the case of a validation error.
     Always in a form that can be appended to the name of a field.
@@ -165,6 +386,508 @@ class ValidationError(Exception):
     pass
 
 
+class FieldError:
+    ''' One reason why try_from_obj() rejected an object. code is one of
+    'missing', 'type', 'decode', 'value', 'unknown' or 'check', and field is
+    None for errors which aren't about a single field. The message is only
+    built when it is asked for; for a 'value' error found without raising,
+    expected is the definition whose check_value() builds it.
+    '''
+
+    __slots__ = ('field', 'code', 'expected', 'value', 'error')
+
+    def __init__(self, field, code, expected=None, value=None, error=None):
+        self.field = field
+        self.code = code
+        self.expected = expected
+        self.value = value
+        self.error = error
+
+    @property
+    def message(self):
+        if self.error is None and self.code == 'value':
+            try:
+                self.expected.check_value(self.value)
+            except ValidationError as e:
+                self.error = e
+        if self.error is not None:
+            message = self.error.args[0]
+        elif self.code == 'missing':
+            message = 'cannot be None'
+        elif self.code == 'unknown':
+            message = 'is not a field of ' + self.expected.__name__
+        elif self.field is None:
+            message = 'Cannot create Encodium object from ' + self.value.__class__.__name__
+        else:
+            message = 'is supposed to be type ' + str(self.expected)
+            message += ', but was set to something of type ' + str(self.value.__class__) + '.'
+        return message if self.field is None else self.field + ' ' + message
+
+    def __repr__(self):
+        return '<FieldError %s %s>' % (self.code, self.field)
+
+
+class ValidationResult:
+    ''' The result of try_from_obj(): the object, if it was valid, and the
+    errors otherwise.
+    '''
+
+    __slots__ = ('value', 'errors')
+
+    def __init__(self, value, errors):
+        self.value = value
+        self.errors = errors
+
+    def __bool__(self):
+        return not self.errors
+
+    def get(self):
+        ''' Returns the object, or raises a ValidationError for the first
+        error.
+        '''
+        if self.errors:
+            raise ValidationError(self.errors[0].message)
+        return self.value
+
+
+def _try_value(definition, name, value, errors):
+    ''' Checks a value against definition without raising, appending any
+    error to errors. Returns whether the value is valid.
+    '''
+    if value is None:
+        if definition.optional:
+            return True
+        errors.append(FieldError(name, 'missing'))
+        return False
+    if definition._encodium_plain_type_check:
+        if not isinstance(value, definition._encodium_type):
+            errors.append(FieldError(name, 'type', definition._encodium_type, value))
+            return False
+    else:
+        try:
+            definition.check_type(value)
+        except ValidationError as e:
+            errors.append(FieldError(name, 'type', definition._encodium_type, value, e))
+            return False
+    if definition._encodium_check_needed:
+        # The library's own checks are tested without raising.
+        predicate = _value_predicates.get(type(definition).check_value)
+        if predicate is not None:
+            if not predicate(definition, value):
+                errors.append(FieldError(name, 'value', definition, value))
+                return False
+            return True
+        try:
+            definition._encodium_check_value(value)
+        except ValidationError as e:
+            errors.append(FieldError(name, 'value', error=e))
+            return False
+    return True
+
+
+# Returned by _try_decode() for a value which isn't valid.
+_invalid = object()
+
+
+def _prefix_errors(errors, start, prefix):
+    ''' Names the errors from start onwards as being inside prefix. '''
+    for error in errors[start:]:
+        if error.field is None:
+            error.field = prefix
+        elif error.field[0] == '[':
+            error.field = prefix + error.field
+        else:
+            error.field = prefix + '.' + error.field
+
+
+def _try_kind(definition):
+    ''' Returns how _try_decode() handles definition: 'plain' values are
+    used as they are, 'object', 'list' and 'map' values are walked without
+    raising, and 'other' values are decoded with from_obj().
+    '''
+    kind = definition.__dict__.get('_encodium_try_kind')
+    if kind is None:
+        cls = type(definition)
+        if cls.from_obj is Encodium.Definition.from_obj:
+            kind = 'object' if hasattr(definition._encodium_type, 'try_from_obj') else 'plain'
+        elif cls.from_obj is List.Definition.from_obj and cls.check_type is List.Definition.check_type and cls.check_value is List.Definition.check_value:
+            kind = 'list'
+        elif cls.from_obj is Map.Definition.from_obj and cls.check_type is Map.Definition.check_type and cls.check_value is Map.Definition.check_value:
+            kind = 'map'
+        else:
+            kind = 'other'
+        definition.__dict__['_encodium_try_kind'] = kind
+    return kind
+
+
+def _try_decode(definition, obj, errors, all_errors):
+    ''' Decodes and checks obj against definition without raising, like
+    try_from_obj(). Errors are appended to errors with field names relative
+    to obj. Returns _invalid if obj isn't valid.
+    '''
+    if obj is None:
+        return None if _try_value(definition, None, None, errors) else _invalid
+    kind = _try_kind(definition)
+    if kind == 'plain':
+        value = obj
+    elif kind == 'object' and (obj.__class__ is dict or obj.__class__ is OrderedDict):
+        result = definition._encodium_type.try_from_obj(obj, all_errors)
+        if result.errors:
+            errors.extend(result.errors)
+            return _invalid
+        value = result.value
+    elif kind == 'list' and type(obj) is list:
+        # Items are checked one by one, so the list needn't be checked again.
+        inner_definition = definition.inner_definition
+        value = []
+        start = len(errors)
+        for i, inner_obj in enumerate(obj):
+            mark = len(errors)
+            inner_value = _try_decode(inner_definition, inner_obj, errors, all_errors)
+            if inner_value is _invalid:
+                _prefix_errors(errors, mark, '[%d]' % i)
+                if not all_errors:
+                    return _invalid
+            value.append(inner_value)
+        return _invalid if len(errors) > start else value
+    elif kind == 'map' and isinstance(obj, dict):
+        key_definition = definition.key_definition
+        value_definition = definition.value_definition
+        value = {}
+        start = len(errors)
+        for key_obj, inner_obj in obj.items():
+            mark = len(errors)
+            try:
+                key = definition._key_from_obj(key_obj)
+            except ValidationError as e:
+                errors.append(FieldError(None, 'decode', error=e))
+                key = _invalid
+            if key is not _invalid and _try_value(key_definition, None, key, errors):
+                inner_value = _try_decode(value_definition, inner_obj, errors, all_errors)
+                if inner_value is not _invalid:
+                    value[key] = inner_value
+            if len(errors) > mark:
+                _prefix_errors(errors, mark, '[%s]' % (key_obj.decode(errors='replace') if type(key_obj) is bytes else key_obj))
+                if not all_errors:
+                    return _invalid
+        return _invalid if len(errors) > start else value
+    else:
+        try:
+            value = definition.from_obj(obj)
+        except ValidationError as e:
+            errors.append(FieldError(None, 'decode', error=e))
+            return _invalid
+    return value if _try_value(definition, None, value, errors) else _invalid
+
+
+def _decode_utf8(data):
+    try:
+        return data.decode()
+    except UnicodeDecodeError:
+        raise ValidationError("is not valid UTF-8")
+
+
+class JsonBackend:
+    ''' Encodes and decodes JSON with the standard library. dumps() must give
+    the canonical form: compact, with sorted keys, and only ASCII characters.
+    '''
+
+    name = 'json'
+
+    def dumps(self, obj, floats=True):
+        ''' Encodes a primitive, such as the result of to_json_primitive().
+        floats may be False if obj is known to contain no floats.
+        '''
+        return json.dumps(obj, separators=(',', ':'), sort_keys=True)
+
+    def loads(self, data):
+        return json.loads(data)
+
+
+# Faster libraries read integers of 20 or more digits as floats, or not at
+# all. Mapping every digit to 9 lets a run of them be found with a substring
+# search, which is much faster than searching for a regex.
+_digits_to_nines = bytes.maketrans(b'0123456789', b'9999999999')
+_long_digits = b'9' * 20
+
+
+def _has_long_digits(data):
+    return _long_digits in data.translate(_digits_to_nines)
+
+
+class _OrjsonBackend(JsonBackend):
+    name = 'orjson'
+
+    def dumps(self, obj, floats=True):
+        # orjson writes floats and non-ASCII characters differently, so those
+        # are left to the standard library.
+        if not floats:
+            try:
+                data = orjson.dumps(obj, option=orjson.OPT_SORT_KEYS)
+            except TypeError:
+                data = None
+            if data is not None and data.isascii() and b'\x7f' not in data:
+                return data.decode()
+        return super().dumps(obj)
+
+    def loads(self, data):
+        if type(data) is str:
+            data = data.encode()
+        if not _has_long_digits(data):
+            try:
+                return orjson.loads(data)
+            except orjson.JSONDecodeError:
+                # The standard library may still accept it, e.g. NaN.
+                pass
+        return super().loads(data)
+
+
+class _UjsonBackend(JsonBackend):
+    name = 'ujson'
+
+    def dumps(self, obj, floats=True):
+        if not floats:
+            try:
+                data = ujson.dumps(obj, sort_keys=True, ensure_ascii=False, escape_forward_slashes=False)
+            except (TypeError, OverflowError):
+                data = None
+            if data is not None and data.isascii() and '\x7f' not in data:
+                return data
+        return super().dumps(obj)
+
+    def loads(self, data):
+        if type(data) is str:
+            data = data.encode()
+        if not _has_long_digits(data):
+            try:
+                return ujson.loads(data)
+            except ValueError:
+                pass
+        return super().loads(data)
+
+
+# The available backends, fastest first.
+json_backends = OrderedDict()
+if orjson is not None:
+    json_backends['orjson'] = _OrjsonBackend()
+if ujson is not None:
+    json_backends['ujson'] = _UjsonBackend()
+json_backends['json'] = JsonBackend()
+
+_json_backend = None
+
+
+def set_json_backend(name='auto'):
+    ''' Selects the JSON backend by name, or the fastest available one if
+    name is 'auto'.
+    '''
+    global _json_backend
+    if name == 'auto':
+        name = next(iter(json_backends))
+    if name not in json_backends:
+        raise ValueError("JSON backend %r is not available" % name)
+    _json_backend = json_backends[name]
+
+
+def get_json_backend():
+    return _json_backend
+
+
+set_json_backend(os.environ.get('ENCODIUM_JSON_BACKEND', 'auto'))
+
+
+def _has_floats(definition):
+    ''' Whether values of definition might contain floats. '''
+    inner = getattr(definition, 'inner_definition', None) or getattr(definition, 'value_definition', None)
+    if inner is not None:
+        return _has_floats(inner)
+    expected = getattr(definition, '_encodium_type', None)
+    if not isinstance(expected, type):
+        return True
+    if issubclass(expected, Encodium):
+        return expected._encodium_has_floats
+    return issubclass(expected, float)
+
+
+def _is_scalar(definition):
+    ''' Whether values of definition are immutable, so their encoded size
+    can be cached with the object holding them.
+    '''
+    if hasattr(definition, 'inner_definition') or hasattr(definition, 'value_definition'):
+        return False
+    expected = getattr(definition, '_encodium_type', None)
+    return isinstance(expected, type) and not issubclass(expected, Encodium)
+
+
+def _has_custom_json(definition):
+    ''' Whether values of definition might be encoded by an overridden
+    to_json(), which the JSON backends would bypass.
+    '''
+    if type(definition).to_json not in _library_to_json:
+        return True
+    inner = getattr(definition, 'inner_definition', None) or getattr(definition, 'value_definition', None)
+    if inner is not None:
+        return _has_custom_json(inner)
+    expected = getattr(definition, '_encodium_type', None)
+    if isinstance(expected, type) and issubclass(expected, Encodium):
+        return expected._encodium_custom_json
+    return False
+
+
+def _patch_op(op):
+    ''' Normalises a decoded patch operation so it always has str keys. '''
+    if not isinstance(op, dict):
+        raise ValidationError("has an invalid patch")
+    return {key.decode() if type(key) is bytes else key: value for key, value in op.items()}
+
+
+def _bencoded_size(obj):
+    ''' The length of the bencoding of a primitive. '''
+    if type(obj) is bytes:
+        return len(str(len(obj))) + 1 + len(obj)
+    elif type(obj) is str:
+        length = len(obj) if obj.isascii() else len(obj.encode())
+        return len(str(length)) + 1 + length
+    elif isinstance(obj, int):
+        return len(str(obj)) + 2
+    elif isinstance(obj, list):
+        return 2 + sum([_bencoded_size(item) for item in obj])
+    elif isinstance(obj, dict):
+        return 2 + sum([_bencoded_size(key) + _bencoded_size(value) for key, value in obj.items()])
+    raise TypeError("Cannot bencode " + obj.__class__.__name__)
+
+
+def _json_size(obj):
+    ''' The length of the compact JSON encoding of a primitive. '''
+    if obj is None or obj is True:
+        return 4
+    elif obj is False:
+        return 5
+    elif type(obj) is str:
+        if obj.isascii() and obj.isprintable():
+            # Only quotes and backslashes need escaping.
+            return len(obj) + 2 + obj.count('"') + obj.count('\\')
+        return len(json.dumps(obj))
+    elif isinstance(obj, int):
+        return len(str(obj))
+    elif isinstance(obj, float):
+        return len(json.dumps(obj))
+    elif isinstance(obj, list):
+        return 2 + sum([_json_size(item) for item in obj]) + max(len(obj) - 1, 0)
+    elif isinstance(obj, dict):
+        return 2 + sum([_json_size(key) + 1 + _json_size(value) for key, value in obj.items()]) + max(len(obj) - 1, 0)
+    raise TypeError("Cannot encode " + obj.__class__.__name__ + " as JSON")
+
+
+def _bencode_into(obj, view, offset):
+    ''' Writes the bencoding of a primitive into a memoryview and returns the
+    offset after it.
+    '''
+    if type(obj) is bytes or type(obj) is str:
+        if type(obj) is str:
+            obj = obj.encode()
+        header = b'%d:' % len(obj)
+        view[offset:offset + len(header)] = header
+        offset += len(header)
+        view[offset:offset + len(obj)] = obj
+        return offset + len(obj)
+    elif isinstance(obj, int):
+        piece = b'i%de' % obj
+        view[offset:offset + len(piece)] = piece
+        return offset + len(piece)
+    elif isinstance(obj, list):
+        view[offset] = 0x6c  # l
+        offset += 1
+        for item in obj:
+            offset = _bencode_into(item, view, offset)
+    elif isinstance(obj, dict):
+        view[offset] = 0x64  # d
+        offset += 1
+        for key, value in obj.items():
+            offset = _bencode_into(value, view, _bencode_into(key, view, offset))
+    else:
+        raise TypeError("Cannot bencode " + obj.__class__.__name__)
+    view[offset] = 0x65  # e
+    return offset + 1
+
+
+def _write(view, offset, piece):
+    view[offset:offset + len(piece)] = piece
+    return offset + len(piece)
+
+
+def _encodium_restore(cls, values):
+    ''' Unpickles an Encodium object. It was valid when it was pickled, so it
+    isn't validated again.
+    '''
+    obj = cls.__new__(cls)
+    obj.__dict__.update(zip(cls._encodium_sorted_fields, values))
+    return obj
+
+
+class _GraphEncoder:
+    ''' Numbers the distinct objects of a graph, and collects their
+    primitives in a table. Nested objects come before the objects containing
+    them.
+    '''
+
+    def __init__(self, for_json):
+        self.for_json = for_json
+        self.table = []
+        self.numbers = {}
+        self.encoding = set()
+
+    def add(self, obj):
+        ''' Returns the number of obj, adding it to the table if it isn't there
+        already.
+        '''
+        number = self.numbers.get(id(obj))
+        if number is not None:
+            return number
+        if id(obj) in self.encoding:
+            raise ValueError("Cannot encode a graph containing a cycle")
+        self.encoding.add(id(obj))
+        fields = obj._encodium_fields
+        values = obj.__dict__
+        primitive = OrderedDict()
+        for name in obj._encodium_sorted_fields:
+            value = values[name]
+            if value is not None:
+                primitive[name] = fields[name].to_graph_primitive(value, self, self.for_json)
+            elif self.for_json:
+                primitive[name] = None
+        self.encoding.discard(id(obj))
+        self.numbers[id(obj)] = number = len(self.table)
+        self.table.append(primitive)
+        return number
+
+
+class _GraphDecoder:
+    ''' Decodes the objects of a graph table as they are referred to. '''
+
+    def __init__(self, table):
+        self.table = table
+        self.objects = {}
+        # Objects may only refer to those before them, so there are no cycles.
+        self.limit = len(table)
+
+    def get(self, number, cls):
+        if type(number) is not int or not 0 <= number < self.limit:
+            raise ValidationError("has an invalid reference " + repr(number))
+        obj = self.objects.get(number)
+        if obj is None:
+            limit = self.limit
+            self.limit = number
+            try:
+                obj = cls._encodium_from_graph(self.table[number], self)
+            finally:
+                self.limit = limit
+            self.objects[number] = obj
+        elif not isinstance(obj, cls):
+            raise ValidationError("refers to a %s, not a %s" % (obj.__class__.__name__, cls.__name__))
+        return obj
+
+
 class Field:
     ''' This class included for backwards compatibility. '''
 
@@ -210,22 +933,103 @@ class EncodiumMeta(type):
                 if isinstance(value, Encodium.Definition):
                     cls._encodium_fields[key] = value
 
+            # _encodium_keys maps the str and bytes forms of each field name to
+            # (name, definition), so decoding doesn't re-encode the names.
+            cls._encodium_keys = {}
+            for key, value in cls._encodium_fields.items():
+                cls._encodium_keys[key] = cls._encodium_keys[key.encode()] = (key, value)
+
+            # The field names in encoding order.
+            cls._encodium_sorted_fields = tuple(sorted(cls._encodium_fields))
+
+            # The encoded field names, for encoded_size() and encode_into().
+            cls._encodium_bencoded_keys = {key: to_bencode(key) for key in cls._encodium_fields}
+            cls._encodium_json_keys = {key: ('"' + key + '":').encode() for key in cls._encodium_fields}
+
+            # Fields holding lists, maps or other objects, which may change
+            # in place, so their sizes aren't cached.
+            cls._encodium_nested_fields = tuple([key for key in cls._encodium_sorted_fields if not _is_scalar(cls._encodium_fields[key])])
+
+            # Each class counts its own unknown fields.
+            cls._encodium_unknown_count = 0
+
+            # Whether a faster JSON backend can encode it exactly.
+            cls._encodium_has_floats = any([_has_floats(value) for value in cls._encodium_fields.values()])
+
+            # Whether to_json() has been overridden, here or in a field, so
+            # it must be encoded field by field rather than by a backend.
+            cls._encodium_custom_json = cls.to_json is not Encodium.to_json or any([_has_custom_json(value) for value in cls._encodium_fields.values()])
+
+            # Constant defaults are validated once, here, and copied into new
+            # objects without being checked again. Those which fail are left
+            # to change(), so the error is raised when an object is created.
+            cls._encodium_defaults = {}
+            factories = []
+            for key in cls._encodium_sorted_fields:
+                value = cls._encodium_fields[key]
+                if callable(value.default):
+                    factories.append((key, value))
+                    continue
+                try:
+                    value.check_type(value.default)
+                    if value.default is not None:
+                        value._encodium_check_value(value.default)
+                    cls._encodium_defaults[key] = value.default
+                except ValidationError:
+                    factories.append((key, value))
+            cls._encodium_default_factories = tuple(factories)
+
+            # The class is only read from now on, and may be shared between
+            # threads, so its tables are made read-only.
+            cls._encodium_fields = MappingProxyType(cls._encodium_fields)
+            cls._encodium_keys = MappingProxyType(cls._encodium_keys)
+            cls._encodium_bencoded_keys = MappingProxyType(cls._encodium_bencoded_keys)
+            cls._encodium_json_keys = MappingProxyType(cls._encodium_json_keys)
+            cls._encodium_defaults = MappingProxyType(cls._encodium_defaults)
+
 
 class Encodium(metaclass=EncodiumMeta):
     ''' This is the base class for all Encodium objects.
     '''
 
     _encodium_fields = {}
+    _encodium_keys = {}
+    _encodium_sorted_fields = ()
+
+    # What to do with unknown fields: 'ignore', 'collect' or 'error'.
+    _encodium_unknown_fields = 'ignore'
+    _encodium_unknown_count = 0
+    _encodium_has_floats = False
+    _encodium_custom_json = False
+    _encodium_nested_fields = ()
+
+    # The validated constant defaults, and the other fields with defaults
+    # which need to be called or checked for each object.
+    _encodium_defaults = {}
+    _encodium_default_factories = ()
 
     class Definition:
         optional = False
         default = None
+        indexed = False
+        # Set if default is a callable whose results are always valid.
+        trusted_default = False
+
+        # Set by __init__(); these are the safe answers for subclasses which
+        # don't call it.
+        _encodium_plain_type_check = False
+        _encodium_check_needed = True
 
         def __init__(self, *args, **kwargs):
             # Copy across kwargs.
             for key, value in kwargs.items():
                 self.__dict__[key] = value
 
+            # Note which checks can be skipped or done inline, because they
+            # haven't been overridden.
+            self._encodium_plain_type_check = type(self).check_type is Encodium.Definition.check_type
+            self._encodium_check_needed = type(self).check_value is not Encodium.Definition.check_value
+
         def check_type(self, value):
             if value is None:
                 if not self.optional:
@@ -241,6 +1045,40 @@ class Encodium(metaclass=EncodiumMeta):
         def check_value(self, value):
             pass
 
+        def _encodium_check_value(self, value):
+            ''' Calls check_value(), unless value is an Encodium object which
+            this definition has accepted before and which hasn't changed since.
+            In-place changes to its lists, maps and nested objects aren't
+            noticed.
+            '''
+            if not self._encodium_check_needed:
+                return
+            if isinstance(value, Encodium):
+                accepted = value.__dict__.get('_encodium_accepted')
+                if accepted is not None and self in accepted:
+                    return
+                self.check_value(value)
+                # setdefault() keeps this safe when threads check one object.
+                value.__dict__.setdefault('_encodium_accepted', set()).add(self)
+            else:
+                self.check_value(value)
+
+        def encoded_size(self, value, codec):
+            if isinstance(value, Encodium):
+                return value.encoded_size(codec)
+            elif codec == 'bencode':
+                return _bencoded_size(self.to_primitive(value))
+            elif type(self).to_json not in _library_to_json:
+                return len(self.to_json(value).encode())
+            return _json_size(self.to_json_primitive(value))
+
+        def encode_into(self, value, view, offset, codec):
+            if isinstance(value, Encodium):
+                return value._encodium_encode_into(view, offset, codec)
+            elif codec == 'bencode':
+                return _bencode_into(self.to_primitive(value), view, offset)
+            return _write(view, offset, self.to_json(value).encode())
+
         def to_json(self, value):
             if hasattr(value, 'to_json'):
                 return value.to_json()
@@ -256,6 +1094,14 @@ class Encodium(metaclass=EncodiumMeta):
             else:
                 return value
 
+        def to_json_primitive(self, value):
+            if hasattr(value, 'to_json_primitive'):
+                return value.to_json_primitive()
+            elif type(value) is list:
+                return [v.to_json_primitive() if hasattr(v, 'to_json_primitive') else v for v in value]
+            else:
+                return value
+
         def from_obj(self, obj):
             if hasattr(self._encodium_type, 'from_obj'):
                 if not isinstance(obj, dict):
@@ -264,15 +1110,82 @@ class Encodium(metaclass=EncodiumMeta):
             else:
                 return obj
 
+        def to_graph_primitive(self, value, graph, for_json):
+            ''' Like to_primitive(), but Encodium objects are added to graph
+            and replaced by their number in it.
+            '''
+            if isinstance(value, Encodium):
+                return graph.add(value)
+            return self.to_json_primitive(value) if for_json else self.to_primitive(value)
+
+        def from_graph_obj(self, obj, graph):
+            ''' Like from_obj(), but Encodium objects are looked up in graph
+            by number.
+            '''
+            if hasattr(self._encodium_type, 'from_obj'):
+                return graph.get(obj, self._encodium_type)
+            return self.from_obj(obj)
+
+        def diff(self, old, new, for_json=False):
+            ''' Returns the patch operation turning old into new, or None if
+            they are the same.
+            '''
+            if old is new or (old.__class__ is new.__class__ and old == new):
+                return None
+            if new is None:
+                return OrderedDict([('d', 1)])
+            if isinstance(new, Encodium) and old.__class__ is new.__class__:
+                patch = new._encodium_diff(old, for_json)
+                return OrderedDict([('p', patch)]) if patch else None
+            if for_json:
+                return OrderedDict([('v', self.to_json_primitive(new))])
+            return OrderedDict([('v', self.to_primitive(new))])
+
+        def patch(self, value, op):
+            ''' Returns a new value with the patch operation applied. '''
+            op = _patch_op(op)
+            if 'd' in op:
+                return None
+            if 'v' in op:
+                return self.from_obj(op['v'])
+            if 'p' in op and isinstance(value, Encodium):
+                return value.evolve(**value._encodium_patch_changes(op['p']))
+            raise ValidationError("has an invalid patch")
+
     def __init__(self, *args, **kwargs):
-        for name, definition in self._encodium_fields.items():
+        values = self._encodium_defaults.copy()
+        for name, definition in self._encodium_default_factories:
             if name not in kwargs:
-                if callable(definition.default):
-                    kwargs[name] = definition.default()
-                else:
+                if not callable(definition.default):
                     kwargs[name] = definition.default
-
-        self.change(**kwargs)
+                elif definition.trusted_default:
+                    values[name] = definition.default()
+                else:
+                    kwargs[name] = definition.default()
+        for name in kwargs:
+            values.pop(name, None)
+        self.__dict__.update(values)
+
+        # check() is still told about every field.
+        self._encodium_change(kwargs, self._encodium_fields.keys())
+
+    def __setattr__(self, name, value):
+        # Setting a field directly skips validation, so definitions which
+        # accepted this object must check it again.
+        if name in self._encodium_fields:
+            self._encodium_forget()
+        object.__setattr__(self, name, value)
+
+    def _encodium_forget(self):
+        ''' Forgets what was cached about this object's values, after they
+        change.
+        '''
+        self.__dict__.pop('_encodium_accepted', None)
+        self.__dict__.pop('_encodium_sizes', None)
+
+    def __reduce__(self):
+        # Pickle the values in field order rather than the whole __dict__.
+        return (_encodium_restore, (self.__class__, tuple([self.__dict__[name] for name in self._encodium_sorted_fields])))
 
     def __repr__(self):
         return '<%s %s>' % (self.__class__.__name__, str(self.to_primitive()))
@@ -288,26 +1201,34 @@ class Encodium(metaclass=EncodiumMeta):
         return not (self == other)
 
     def change(self, **kwargs):
+        self._encodium_change(kwargs, None)
+
+    def _encodium_change(self, kwargs, checked):
+        ''' Validates and sets the fields in kwargs, then calls check() with
+        checked, or with the changed field names if checked is None.
+        '''
         changed_attributes = {}
+        unknown = None
         for name, value in kwargs.items():
-            if name not in self._encodium_fields:
-                # TODO: decide how to handle this case.
-                sys.stderr.write("Warning: Argument " + name +
-                                 " provided but isn't a field for" +
-                                 " Encodium type " + self.__class__.__name__ + "\n")
+            definition = self._encodium_fields.get(name)
+            if definition is None:
+                if unknown is None:
+                    unknown = {}
+                unknown[name] = value
             else:
-                definition = self.__class__.__dict__[name]
-
                 try:
                     definition.check_type(value)
                     if value is not None:
-                        definition.check_value(value)
+                        definition._encodium_check_value(value)
                     changed_attributes[name] = value
                 except ValidationError as e:
                     # Prepend the name of the field to the exception message
                     e.args = (name + " " + e.args[0],) + e.args[1:]
                     raise
 
+        if unknown is not None:
+            self._encodium_count_unknown(unknown)
+
         backup = {}
         for name, value in changed_attributes.items():
             try:
@@ -317,22 +1238,106 @@ class Encodium(metaclass=EncodiumMeta):
             self.__dict__[name] = value
 
         try:
-            self.check(changed_attributes.keys())
+            self.check(changed_attributes.keys() if checked is None else checked)
         except ValidationError as e:
             # Restore the backup before re-raising.
-            for name, value in backup:
+            for name, value in backup.items():
                 self.__dict__[name] = value
             raise
 
+        # Definitions which accepted this object must check it again.
+        if changed_attributes:
+            self._encodium_forget()
+
+        if unknown is not None and self._encodium_unknown_fields == 'collect':
+            self.__dict__.setdefault('_encodium_unknown', {}).update(unknown)
+
+    @classmethod
+    def _encodium_count_unknown(cls, unknown):
+        ''' Counts unknown fields, raising if the policy is 'error'. '''
+        with _lock:
+            cls._encodium_unknown_count += len(unknown)
+        if cls._encodium_unknown_fields == 'error':
+            raise ValidationError(', '.join(sorted(unknown)) + " is not a field of " + cls.__name__)
+
     def check(self, changed_attributes):
         pass
 
+    def diff(self, old, codec=None):
+        ''' Returns a patch which turns old into this object.
+
+        The patch is a primitive unless codec is 'bencode' or 'json', in which
+        case it is encoded.
+        '''
+        if old.__class__ is not self.__class__:
+            raise TypeError("Cannot diff %s against %s" % (self.__class__.__name__, old.__class__.__name__))
+        patch = self._encodium_diff(old, codec == 'json')
+        if codec is None:
+            return patch
+        elif codec == 'bencode':
+            return to_bencode(patch)
+        elif codec == 'json':
+            return json.dumps(patch, separators=(',', ':'))
+        raise ValueError("Unknown codec " + repr(codec))
+
+    def _encodium_diff(self, old, for_json):
+        patch = OrderedDict()
+        for name in self._encodium_sorted_fields:
+            op = self._encodium_fields[name].diff(old.__dict__[name], self.__dict__[name], for_json)
+            if op is not None:
+                patch[name] = op
+        return patch
+
+    def apply_patch(self, patch):
+        ''' Applies a patch produced by diff(), in primitive, bencode or JSON
+        form. Only the patched fields are validated.
+        '''
+        self.change(**self._encodium_patch_changes(patch))
+
+    def _encodium_patch_changes(self, patch):
+        if type(patch) is bytes:
+            try:
+                patch = from_bencode(patch)
+            except Exception:
+                raise ValidationError("Invalid bencoded patch")
+        elif type(patch) is str:
+            try:
+                patch = json.loads(patch)
+            except ValueError:
+                raise ValidationError("Invalid JSON patch: %s" % patch)
+        if not isinstance(patch, dict):
+            raise ValidationError("Cannot apply patch from " + patch.__class__.__name__)
+
+        changes = {}
+        for name, op in patch.items():
+            if type(name) is bytes:
+                name = name.decode()
+            if name not in self._encodium_fields:
+                raise ValidationError(name + " is not a field of " + self.__class__.__name__)
+            try:
+                changes[name] = self._encodium_fields[name].patch(self.__dict__[name], op)
+            except ValidationError as e:
+                e.args = (name + " " + e.args[0],) + e.args[1:]
+                raise
+        return changes
+
+    def evolve(self, **changes):
+        ''' Returns a copy of this object with the given fields changed.
+
+        The unchanged values are shared with this object rather than copied,
+        and only the changed fields (and check()) are validated, so the cost
+        is proportional to the number of changes rather than the object size.
+        '''
+        evolved = copy.copy(self)
+        evolved.change(**changes)
+        return evolved
+
     def to_json(self):
+        if not self._encodium_custom_json:
+            return _json_backend.dumps(self.to_json_primitive(), self._encodium_has_floats)
         ret = ['{']
         first_iteration = True
-        fields = list(self._encodium_fields.keys())
-        fields.sort()
-        for name in fields:
+        for name in self._encodium_sorted_fields:
             definition = self._encodium_fields[name]
             if not first_iteration:
                 ret.append(',')
@@ -340,17 +1345,165 @@ class Encodium(metaclass=EncodiumMeta):
             ret.append('"')
             ret.append(name)
             ret.append('":')
-            ret.append(definition.to_json(self.__dict__[name]))
+            value = self.__dict__[name]
+            ret.append('null' if value is None else definition.to_json(value))
         ret.append('}')
         return ''.join(ret)
 
+    def encoded_size(self, codec='bencode'):
+        ''' Returns the length in bytes of to_bencode(), or of to_json() if
+        codec is 'json', without encoding the object.
+
+        The size of the scalar fields is cached until the object is changed.
+        Lists, maps and nested objects are measured on every call, as they
+        may have been changed in place.
+        '''
+        if codec == 'json' and self._encodium_custom_json:
+            return len(self.to_json().encode())
+        fields = self._encodium_fields
+        values = self.__dict__
+        sizes = values.get('_encodium_sizes')
+        if sizes is not None and codec in sizes:
+            size = sizes[codec]
+        else:
+            nested = self._encodium_nested_fields
+            if codec == 'bencode':
+                keys = self._encodium_bencoded_keys
+                size = 2
+                for name in self._encodium_sorted_fields:
+                    value = values[name]
+                    if value is not None:
+                        size += len(keys[name])
+                        if name not in nested:
+                            size += fields[name].encoded_size(value, codec)
+            elif codec == 'json':
+                keys = self._encodium_json_keys
+                size = 1 + len(fields)
+                for name in self._encodium_sorted_fields:
+                    value = values[name]
+                    size += len(keys[name])
+                    if value is None:
+                        size += 4
+                    elif name not in nested:
+                        size += fields[name].encoded_size(value, codec)
+            else:
+                raise ValueError("Unknown codec " + repr(codec))
+            if sizes is None:
+                sizes = values.setdefault('_encodium_sizes', {})
+            sizes[codec] = size
+
+        for name in self._encodium_nested_fields:
+            value = values[name]
+            if value is not None:
+                size += fields[name].encoded_size(value, codec)
+        return size
+
+    def encode_into(self, buffer, offset=0, codec='bencode'):
+        ''' Writes to_bencode(), or to_json() if codec is 'json', directly into
+        a bytearray or writable memoryview at offset. Returns the offset of
+        the end of what was written.
+        '''
+        if offset + self.encoded_size(codec) > len(buffer):
+            raise ValueError("buffer is too small")
+        with memoryview(buffer) as view:
+            return self._encodium_encode_into(view, offset, codec)
+
+    def _encodium_encode_into(self, view, offset, codec):
+        fields = self._encodium_fields
+        if codec == 'bencode':
+            keys = self._encodium_bencoded_keys
+            view[offset] = 0x64  # d
+            offset += 1
+            for name in self._encodium_sorted_fields:
+                value = self.__dict__[name]
+                if value is not None:
+                    offset = fields[name].encode_into(value, view, _write(view, offset, keys[name]), codec)
+            view[offset] = 0x65  # e
+        elif self._encodium_custom_json:
+            return _write(view, offset, self.to_json().encode())
+        else:
+            keys = self._encodium_json_keys
+            view[offset] = 0x7b  # {
+            offset += 1
+            for i, name in enumerate(self._encodium_sorted_fields):
+                if i:
+                    view[offset] = 0x2c  # ,
+                    offset += 1
+                offset = _write(view, offset, keys[name])
+                value = self.__dict__[name]
+                if value is None:
+                    offset = _write(view, offset, b'null')
+                else:
+                    offset = fields[name].encode_into(value, view, offset, codec)
+            view[offset] = 0x7d  # }
+        return offset + 1
+
     def to_bencode(self):
         return to_bencode(self.to_primitive())
 
     def to_primitive(self):
-        fields = list(self._encodium_fields.keys())
-        fields.sort()
-        return OrderedDict([(field, self._encodium_fields[field].to_primitive(self.__dict__[field])) for field in fields if self.__dict__[field] is not None])
+        fields = self._encodium_fields
+        return OrderedDict([(field, fields[field].to_primitive(self.__dict__[field])) for field in self._encodium_sorted_fields if self.__dict__[field] is not None])
+
+    def to_json_primitive(self):
+        ''' Like to_primitive(), but suitable for json.dumps(): None is kept
+        and Bytes are base64 encoded.
+        '''
+        fields = self._encodium_fields
+        values = self.__dict__
+        return OrderedDict([(field, None if values[field] is None else fields[field].to_json_primitive(values[field])) for field in self._encodium_sorted_fields])
+
+    def to_graph(self, codec='bencode'):
+        ''' Encodes this object so each distinct nested object is only
+        encoded once. See Graphs.
+        '''
+        if codec not in ('bencode', 'json'):
+            raise ValueError("Unknown codec " + repr(codec))
+        graph = _GraphEncoder(codec == 'json')
+        graph.add(self)
+        if codec == 'bencode':
+            return to_bencode(graph.table)
+        return json.dumps(graph.table, separators=(',', ':'))
+
+    @classmethod
+    def from_graph(cls, data, codec='bencode'):
+        ''' Decodes the output of to_graph(), sharing nested objects which
+        were shared when it was encoded.
+        '''
+        if codec == 'bencode':
+            try:
+                table = from_bencode(data)
+            except Exception:
+                raise ValidationError("Invalid bencode")
+        elif codec == 'json':
+            try:
+                table = json.loads(data)
+            except ValueError:
+                raise ValidationError("Invalid JSON: %s" % data)
+        else:
+            raise ValueError("Unknown codec " + repr(codec))
+        if type(table) is not list or not table:
+            raise ValidationError("Cannot create Encodium graph from " + table.__class__.__name__)
+        graph = _GraphDecoder(table)
+        return graph.get(len(table) - 1, cls)
+
+    @classmethod
+    def _encodium_from_graph(cls, obj, graph):
+        if obj.__class__ is not dict and obj.__class__ is not OrderedDict:
+            raise ValidationError("Cannot create Encodium object from " + obj.__class__.__name__)
+        kwargs = {}
+        unknown = None
+        keys = cls._encodium_keys
+        for key, value in obj.items():
+            entry = keys.get(key)
+            if entry is None:
+                if unknown is None:
+                    unknown = {}
+                unknown[key.decode(errors='replace') if type(key) is bytes else key] = value
+            elif value is not None:
+                kwargs[entry[0]] = entry[1].from_graph_obj(value, graph)
+
+        return cls._encodium_create(kwargs, unknown)
 
     def serialize(self):
         return self.to_bencode()
@@ -368,17 +1521,116 @@ class Encodium(metaclass=EncodiumMeta):
         if obj.__class__ != dict and obj.__class__ != OrderedDict:
             raise ValidationError("Cannot create Encodium object from " + obj.__class__.__name__)
         kwargs = {}
-        for name, definition in cls._encodium_fields.items():
-            if name in obj and obj[name] != None:
-                kwargs[name] = definition.from_obj(obj[name])
-            elif name.encode() in obj and obj[name.encode()] is not None:
-                kwargs[name] = definition.from_obj(obj[name.encode()])
-        return cls(**kwargs)
+        unknown = None
+        keys = cls._encodium_keys
+        for key, value in obj.items():
+            entry = keys.get(key)
+            if entry is None:
+                if unknown is None:
+                    unknown = {}
+                unknown[key.decode(errors='replace') if type(key) is bytes else key] = value
+            elif value is not None:
+                kwargs[entry[0]] = entry[1].from_obj(value)
+
+        return cls._encodium_create(kwargs, unknown)
+
+    @classmethod
+    def _encodium_create(cls, kwargs, unknown):
+        ''' Creates an object from decoded fields, applying the unknown field
+        policy to the unknown ones.
+        '''
+        if unknown is None:
+            return cls(**kwargs)
+        cls._encodium_count_unknown(unknown)
+        ret = cls(**kwargs)
+        if cls._encodium_unknown_fields == 'collect':
+            ret.__dict__['_encodium_unknown'] = unknown
+        return ret
+
+    @classmethod
+    def try_from_obj(cls, obj, all_errors=False):
+        ''' Like from_obj(), but returns a ValidationResult instead of
+        raising. Unless all_errors is set, it stops at the first error.
+        '''
+        if obj.__class__ is not dict and obj.__class__ is not OrderedDict:
+            return ValidationResult(None, [FieldError(None, 'type', dict, obj)])
+        errors = []
+        kwargs = {}
+        unknown = None
+        failed = set()
+        keys = cls._encodium_keys
+        for key, value in obj.items():
+            entry = keys.get(key)
+            if entry is None:
+                if unknown is None:
+                    unknown = {}
+                unknown[key.decode(errors='replace') if type(key) is bytes else key] = value
+                continue
+            if value is None:
+                continue
+            name, definition = entry
+            mark = len(errors)
+            value = _try_decode(definition, value, errors, all_errors)
+            if value is not _invalid:
+                kwargs[name] = value
+                continue
+            _prefix_errors(errors, mark, name)
+            failed.add(name)
+            if not all_errors:
+                return ValidationResult(None, errors)
+
+        if unknown is not None:
+            with _lock:
+                cls._encodium_unknown_count += len(unknown)
+            if cls._encodium_unknown_fields == 'error':
+                errors.extend([FieldError(name, 'unknown', cls) for name in sorted(unknown)])
+                if not all_errors:
+                    return ValidationResult(None, errors)
+
+        # Fields which failed have no value, but aren't missing.
+        values = cls._encodium_defaults.copy()
+        for name, definition in cls._encodium_default_factories:
+            if name not in kwargs and name not in failed:
+                value = definition.default() if callable(definition.default) else definition.default
+                if definition.trusted_default or _try_value(definition, name, value, errors):
+                    values[name] = value
+                elif not all_errors:
+                    return ValidationResult(None, errors)
+        if errors:
+            return ValidationResult(None, errors)
+
+        values.update(kwargs)
+        ret = cls.__new__(cls)
+        ret.__dict__.update(values)
+        try:
+            ret.check(cls._encodium_fields.keys())
+        except ValidationError as e:
+            return ValidationResult(None, [FieldError(None, 'check', error=e)])
+        if unknown is not None and cls._encodium_unknown_fields == 'collect':
+            ret.__dict__['_encodium_unknown'] = unknown
+        return ValidationResult(ret, errors)
+
+    @classmethod
+    def iter_field(cls, stream, name, codec='bencode', chunk_size=65536):
+        ''' Yields the validated items of the List field name of a message
+        read from a file or socket, one at a time. See encodium.stream.
+        '''
+        from encodium.stream import iter_field
+        return iter_field(cls, stream, name, codec, chunk_size)
+
+    @classmethod
+    def scan(cls, source, where, chunk_size=65536):
+        ''' Yields the records in a buffer, file or socket of concatenated
+        bencoded records which match the conditions in where, testing them
+        before they are decoded. See encodium.stream.
+        '''
+        from encodium.stream import scan
+        return scan(cls, source, where, chunk_size)
 
     @classmethod
     def from_json(cls, data):
         try:
-            obj = json.loads(data)
+            obj = _json_backend.loads(data)
         except ValueError:
             obj = None
         if obj is None:
@@ -391,13 +1643,115 @@ class Encodium(metaclass=EncodiumMeta):
         data = []
         while True:
             data.append(sock.recv(1))
-            if data[-1] == '\n':
+            if data[-1] in ('\n', b'\n'):
                 break
+            if not data[-1]:
+                raise ConnectionError("connection closed")
+        if type(data[0]) is bytes:
+            return cls.from_json(b''.join(data).decode())
         return cls.from_json(''.join(data))
 
     def send_to(self, sock):
         # TODO: refactor this into send_json_to
-        sock.send(self.to_json() + '\n')
+        sock.send((self.to_json() + '\n').encode())
+
+    @staticmethod
+    def send_many(sock, objs):
+        ''' Sends objects in the same format as send_to(), writing the whole
+        batch with as few sendmsg() calls as possible.
+        '''
+        buffers = [(obj.to_json() + '\n').encode() for obj in objs]
+        if not hasattr(sock, 'sendmsg'):
+            sock.sendall(b''.join(buffers))
+            return
+        i = 0
+        while i < len(buffers):
+            sent = sock.sendmsg(buffers[i:i + _IOV_MAX])
+            # Skip past the buffers that were sent in full, and keep the unsent
+            # part of a partially sent one.
+            while i < len(buffers) and sent >= len(buffers[i]):
+                sent -= len(buffers[i])
+                i += 1
+            if sent:
+                buffers[i] = memoryview(buffers[i])[sent:]
+
+    @classmethod
+    def recv_many(cls, sock, max_items=None, bufsize=65536):
+        ''' Receives objects sent by send_to() or send_many().
+
+        Every complete object already waiting in the socket's receive buffer
+        (up to max_items) is decoded, blocking only until there is at least
+        one. Partial objects are left in the socket for the next call.
+        '''
+        chunks = []
+        while True:
+            data = sock.recv(bufsize, socket.MSG_PEEK)
+            if not data:
+                raise ConnectionError("connection closed")
+            end = -1
+            count = 0
+            while max_items is None or count < max_items:
+                newline = data.find(b'\n', end + 1)
+                if newline == -1:
+                    break
+                end = newline
+                count += 1
+            # Only take what was peeked, so partial objects stay in the socket.
+            wanted = end + 1 if end != -1 else len(data)
+            while wanted:
+                chunk = sock.recv(wanted)
+                chunks.append(chunk)
+                wanted -= len(chunk)
+            if end != -1:
+                break
+        lines = b''.join(chunks).split(b'\n')[:-1]
+        return [cls.from_json(line.decode()) for line in lines]
+
+    @staticmethod
+    def encode_many(objs, codec='bencode', executor=None, chunk_size=64):
+        ''' Returns the encodings of objs, as to_bencode() or to_json() would,
+        in order.
+
+        If an executor is given, the objects are encoded in chunks of
+        chunk_size on its workers. Threads only run in parallel on a
+        free-threaded build of Python; elsewhere a ProcessPoolExecutor can be
+        used instead.
+        '''
+        if codec not in ('bencode', 'json'):
+            raise ValueError("Unknown codec " + repr(codec))
+        objs = list(objs)
+        if executor is None:
+            return _encode_chunk(objs, codec)
+        chunks = [objs[i:i + chunk_size] for i in range(0, len(objs), chunk_size)]
+        return [item for chunk in executor.map(_encode_chunk, chunks, [codec] * len(chunks)) for item in chunk]
+
+    @classmethod
+    def decode_many(cls, items, codec='bencode', executor=None, chunk_size=64):
+        ''' Returns the objects decoded from items, in order, as
+        from_bencode() or from_json() would. The first invalid item raises
+        its ValidationError.
+
+        An executor is used as in encode_many().
+        '''
+        if codec not in ('bencode', 'json'):
+            raise ValueError("Unknown codec " + repr(codec))
+        items = list(items)
+        if executor is None:
+            return _decode_chunk(cls, items, codec)
+        chunks = [items[i:i + chunk_size] for i in range(0, len(items), chunk_size)]
+        return [obj for chunk in executor.map(_decode_chunk, [cls] * len(chunks), chunks, [codec] * len(chunks)) for obj in chunk]
+
+
+def _encode_chunk(objs, codec):
+    if codec == 'bencode':
+        return [obj.to_bencode() for obj in objs]
+    return [obj.to_json() for obj in objs]
+
+
+def _decode_chunk(cls, items, codec):
+    if codec == 'bencode':
+        return [cls.from_bencode(item) for item in items]
+    return [cls.from_json(item) for item in items]
 
 
 class Integer(Encodium):
@@ -410,6 +1764,133 @@ class Integer(Encodium):
                 raise ValidationError("must not be negative")
 
 
+class FixedWidth(Encodium):
+    ''' The base for numbers with a fixed-width encoding. In bencode they are
+    packed big-endian into a byte string; in JSON they are plain numbers.
+    '''
+
+    class Definition(Encodium.Definition):
+        _encodium_type = int
+        _encodium_struct = None
+        minimum = None
+        maximum = None
+
+        def check_type(self, value):
+            # bool is a subclass of int, but True isn't a number.
+            if value.__class__ is bool:
+                raise ValidationError('is supposed to be a number, but was set to a bool.')
+            super().check_type(value)
+
+        def check_value(self, value):
+            if not self.minimum <= value <= self.maximum:
+                raise ValidationError("must be between %s and %s" % (self.minimum, self.maximum))
+
+        def to_primitive(self, value):
+            return self._encodium_struct.pack(value)
+
+        def from_obj(self, obj):
+            if type(obj) is bytes:
+                if len(obj) != self._encodium_struct.size:
+                    raise ValidationError("must be packed into %d bytes" % self._encodium_struct.size)
+                return self._encodium_struct.unpack(obj)[0]
+            return obj
+
+        def encoded_size(self, value, codec):
+            if codec == 'bencode':
+                return len(str(self._encodium_struct.size)) + 1 + self._encodium_struct.size
+            return super().encoded_size(value, codec)
+
+        def encode_into(self, value, view, offset, codec):
+            if codec == 'bencode':
+                offset = _write(view, offset, b'%d:' % self._encodium_struct.size)
+                self._encodium_struct.pack_into(view, offset, value)
+                return offset + self._encodium_struct.size
+            return super().encode_into(value, view, offset, codec)
+
+
+class UInt8(FixedWidth):
+    class Definition(FixedWidth.Definition):
+        _encodium_struct = struct.Struct('>B')
+        minimum, maximum = 0, 2 ** 8 - 1
+
+
+class UInt16(FixedWidth):
+    class Definition(FixedWidth.Definition):
+        _encodium_struct = struct.Struct('>H')
+        minimum, maximum = 0, 2 ** 16 - 1
+
+
+class UInt32(FixedWidth):
+    class Definition(FixedWidth.Definition):
+        _encodium_struct = struct.Struct('>I')
+        minimum, maximum = 0, 2 ** 32 - 1
+
+
+class UInt64(FixedWidth):
+    class Definition(FixedWidth.Definition):
+        _encodium_struct = struct.Struct('>Q')
+        minimum, maximum = 0, 2 ** 64 - 1
+
+
+class Int8(FixedWidth):
+    class Definition(FixedWidth.Definition):
+        _encodium_struct = struct.Struct('>b')
+        minimum, maximum = -2 ** 7, 2 ** 7 - 1
+
+
+class Int16(FixedWidth):
+    class Definition(FixedWidth.Definition):
+        _encodium_struct = struct.Struct('>h')
+        minimum, maximum = -2 ** 15, 2 ** 15 - 1
+
+
+class Int32(FixedWidth):
+    class Definition(FixedWidth.Definition):
+        _encodium_struct = struct.Struct('>i')
+        minimum, maximum = -2 ** 31, 2 ** 31 - 1
+
+
+class Int64(FixedWidth):
+    class Definition(FixedWidth.Definition):
+        _encodium_struct = struct.Struct('>q')
+        minimum, maximum = -2 ** 63, 2 ** 63 - 1
+
+
+class Float64(FixedWidth):
+    class Definition(FixedWidth.Definition):
+        _encodium_type = float
+        _encodium_struct = struct.Struct('>d')
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # Every float fits, so there is nothing to check.
+            if type(self).check_value is Float64.Definition.check_value:
+                self._encodium_check_needed = False
+
+        def check_value(self, value):
+            pass
+
+        def from_obj(self, obj):
+            # JSON may represent whole floats as integers.
+            if type(obj) is int:
+                try:
+                    return float(obj)
+                except OverflowError:
+                    raise ValidationError("is too large for a float")
+            return super().from_obj(obj)
+
+
+class Float32(Float64):
+    ''' Values are rounded to single precision when encoded in bencode. '''
+
+    class Definition(Float64.Definition):
+        _encodium_struct = struct.Struct('>f')
+        maximum = 3.4028234663852886e+38
+
+        def check_value(self, value):
+            if math.isfinite(value) and abs(value) > self.maximum:
+                raise ValidationError("is too large for a 32 bit float")
+
 
 class String(Encodium):
     class Definition(Encodium.Definition):
@@ -420,17 +1901,72 @@ class String(Encodium):
             if self.max_length is not None and len(value) > self.max_length:
                 raise ValidationError("was set to a string of length %d but cannot be longer than %d" % (len(value), self.max_length))
 
+        # Decoded strings can be shared through a cache of up to
+        # intern_limit values per definition.
+        intern = False
+        intern_limit = 1024
+
+        def from_obj(self, obj):
+            if type(obj) is bytes:
+                obj = _decode_utf8(obj)
+            # Only strings are interned; anything else is left for
+            # check_type() to reject.
+            if self.intern and type(obj) is str:
+                cache = self.__dict__.get('_encodium_interned')
+                if cache is None:
+                    cache = self.__dict__.setdefault('_encodium_interned', {})
+                value = cache.get(obj)
+                if value is not None:
+                    return value
+                if len(cache) < self.intern_limit:
+                    # Another thread may have added it since.
+                    return cache.setdefault(obj, obj)
+            return obj
+
+
+class Enum(Encodium):
+    class Definition(Encodium.Definition):
+        _encodium_type = str
+        values = ()
+
+        def __init__(self, *args, **kwargs):
+            super().__init__(*args, **kwargs)
+            # Maps decoded and encoded forms to the canonical value.
+            self._encodium_values = {}
+            for value in self.values:
+                self._encodium_values[value] = value
+                self._encodium_values[value.encode()] = value
+
+        def check_value(self, value):
+            if value not in self._encodium_values:
+                raise ValidationError("must be one of " + ', '.join(self.values))
+
         def from_obj(self, obj):
+            value = self._encodium_values.get(obj) if type(obj) in (str, bytes) else None
+            if value is not None:
+                return value
             if type(obj) is bytes:
-                return obj.decode()
+                return _decode_utf8(obj)
             return obj
 
+
 class Boolean(Encodium):
+    ''' bencode has no booleans, so True and False are encoded as i1e and
+    i0e. from_obj() can't tell which codec a value came from, so it accepts
+    1 and 0 in JSON too; any other number is still rejected.
+    '''
+
     class Definition(Encodium.Definition):
         _encodium_type = bool
 
-        def check_value(self, value):
-            pass
+        def to_primitive(self, value):
+            # bencode has no booleans, so use i1e and i0e.
+            return int(value)
+
+        def from_obj(self, obj):
+            if type(obj) is int and obj in (0, 1):
+                return bool(obj)
+            return obj
 
 
 class List(Encodium):
@@ -440,51 +1976,403 @@ class List(Encodium):
         def __init__(self, inner_definition, *args, **kwargs):
             super().__init__(self, *args, **kwargs)
             self.inner_definition = inner_definition
+            if type(self).check_value is List.Definition.check_value:
+                self._encodium_check_needed = inner_definition._encodium_check_needed
+            # Lists of fixed-width numbers are packed into one byte string,
+            # unless they may hold None.
+            if inner_definition.optional:
+                self._encodium_struct = None
+            else:
+                self._encodium_struct = getattr(inner_definition, '_encodium_struct', None)
+            # Their items can be checked all at once, unless the checks are
+            # overridden.
+            packed = self._encodium_struct is not None and type(self).check_type is List.Definition.check_type
+            self._encodium_packed_type = packed and type(inner_definition).check_type is FixedWidth.Definition.check_type
+            self._encodium_packed_range = packed and type(self).check_value is List.Definition.check_value and type(inner_definition).check_value is FixedWidth.Definition.check_value
+
+        def _packed_format(self, count):
+            return '>%d%s' % (count, self._encodium_struct.format[1:])
 
         def check_type(self, value):
             super().check_type(value)
             if value is not None:
-                for inner_value in value:
-                    try:
-                        self.inner_definition.check_type(inner_value)
-                    except ValidationError as e:
-                        # Prepend the inner-ness to the error message.
-                        e.args = ('inner item ' + e.args[0],) + e.args[1:]
-                        raise
+                inner_definition = self.inner_definition
+                if self._encodium_packed_type and set(map(type, value)) <= {inner_definition._encodium_type}:
+                    return
+                if inner_definition._encodium_plain_type_check:
+                    # Only items which fail the isinstance() check need the
+                    # full check_type(), which raises the error.
+                    expected = inner_definition._encodium_type
+                    for inner_value in value:
+                        if not isinstance(inner_value, expected):
+                            self._check_inner_type(inner_value)
+                else:
+                    for inner_value in value:
+                        self._check_inner_type(inner_value)
+
+        def _check_inner_type(self, inner_value):
+            try:
+                self.inner_definition.check_type(inner_value)
+            except ValidationError as e:
+                # Prepend the inner-ness to the error message.
+                e.args = ('inner item ' + e.args[0],) + e.args[1:]
+                raise
 
         def check_value(self, value):
+            if self._encodium_packed_range and value:
+                inner_definition = self.inner_definition
+                try:
+                    if inner_definition.minimum <= min(value) and max(value) <= inner_definition.maximum:
+                        return
+                except TypeError:
+                    # Unchecked items, such as None, are left to the loop.
+                    pass
             for inner_value in value:
+                if inner_value is None:
+                    continue
                 try:
-                    self.inner_definition.check_value(inner_value)
+                    self.inner_definition._encodium_check_value(inner_value)
                 except ValidationError as e:
                     # Prepend the inner-ness to the error message.
                     e.args = ('inner item ' + e.args[0],) + e.args[1:]
                     raise
 
         def to_json(self, value):
-            inner_json = [self.inner_definition.to_json(inner_value) for inner_value in value]
+            inner_json = ['null' if inner_value is None else self.inner_definition.to_json(inner_value) for inner_value in value]
             return '[' + ','.join(inner_json) + ']'
 
+        def encoded_size(self, value, codec):
+            inner_definition = self.inner_definition
+            if codec == 'bencode' and self._encodium_struct is not None:
+                length = len(value) * self._encodium_struct.size
+                return len(str(length)) + 1 + length
+            elif codec == 'bencode':
+                return 2 + sum([inner_definition.encoded_size(inner_value, codec) for inner_value in value])
+            return 1 + max(len(value), 1) + sum([4 if inner_value is None else inner_definition.encoded_size(inner_value, codec) for inner_value in value])
+
+        def encode_into(self, value, view, offset, codec):
+            inner_definition = self.inner_definition
+            if codec == 'bencode' and self._encodium_struct is not None:
+                offset = _write(view, offset, b'%d:' % (len(value) * self._encodium_struct.size))
+                struct.pack_into(self._packed_format(len(value)), view, offset, *value)
+                return offset + len(value) * self._encodium_struct.size
+            elif codec == 'bencode':
+                view[offset] = 0x6c  # l
+                offset += 1
+                for inner_value in value:
+                    offset = inner_definition.encode_into(inner_value, view, offset, codec)
+                view[offset] = 0x65  # e
+            else:
+                view[offset] = 0x5b  # [
+                offset += 1
+                for i, inner_value in enumerate(value):
+                    if i:
+                        view[offset] = 0x2c  # ,
+                        offset += 1
+                    if inner_value is None:
+                        offset = _write(view, offset, b'null')
+                    else:
+                        offset = inner_definition.encode_into(inner_value, view, offset, codec)
+                view[offset] = 0x5d  # ]
+            return offset + 1
+
+        def to_primitive(self, value):
+            if self._encodium_struct is not None:
+                return struct.pack(self._packed_format(len(value)), *value)
+            return [None if inner_value is None else self.inner_definition.to_primitive(inner_value) for inner_value in value]
+
+        def to_json_primitive(self, value):
+            return [None if inner_value is None else self.inner_definition.to_json_primitive(inner_value) for inner_value in value]
+
+        def to_graph_primitive(self, value, graph, for_json):
+            if self._encodium_struct is not None:
+                return self.to_json_primitive(value) if for_json else self.to_primitive(value)
+            inner_definition = self.inner_definition
+            return [None if inner_value is None else inner_definition.to_graph_primitive(inner_value, graph, for_json) for inner_value in value]
+
+        def from_graph_obj(self, obj, graph):
+            if type(obj) is not list:
+                return self.from_obj(obj)
+            inner_definition = self.inner_definition
+            return [None if inner_obj is None else inner_definition.from_graph_obj(inner_obj, graph) for inner_obj in obj]
+
         def from_obj(self, obj):
-            return [self.inner_definition.from_obj(inner_obj) for inner_obj in obj]
+            if type(obj) is bytes and self._encodium_struct is not None:
+                if len(obj) % self._encodium_struct.size:
+                    raise ValidationError("has a packed length which isn't a multiple of %d" % self._encodium_struct.size)
+                return list(struct.unpack(self._packed_format(len(obj) // self._encodium_struct.size), obj))
+            if not isinstance(obj, list):
+                raise ValidationError("Cannot create List from " + obj.__class__.__name__)
+            inner_definition = self.inner_definition
+            return [None if inner_obj is None else inner_definition.from_obj(inner_obj) for inner_obj in obj]
+
+        def diff(self, old, new, for_json=False):
+            if type(old) is not list or type(new) is not list:
+                return super().diff(old, new, for_json)
+            items = []
+            for index, (old_item, new_item) in enumerate(zip(old, new)):
+                op = self.inner_definition.diff(old_item, new_item, for_json)
+                if op is not None:
+                    items.append([index, op])
+            for index in range(len(old), len(new)):
+                # Extending the list pads it with None.
+                op = self.inner_definition.diff(None, new[index], for_json)
+                if op is not None:
+                    items.append([index, op])
+            op = OrderedDict()
+            if items:
+                op['i'] = items
+            if len(old) != len(new):
+                op['l'] = len(new)
+            return op or None
+
+        def patch(self, value, op):
+            op = _patch_op(op)
+            if value is None or ('i' not in op and 'l' not in op):
+                return super().patch(value, op)
+            patched = list(value)
+            if 'l' in op:
+                length = op['l']
+                if type(length) is not int or length < 0:
+                    raise ValidationError("has an invalid patch")
+                del patched[length:]
+                patched.extend([None] * (length - len(patched)))
+            for item in op.get('i', ()):
+                try:
+                    index, inner_op = item
+                except (TypeError, ValueError):
+                    raise ValidationError("has an invalid patch")
+                if type(index) is not int or not 0 <= index < len(patched):
+                    raise ValidationError("has an invalid patch")
+                try:
+                    patched[index] = self.inner_definition.patch(patched[index], inner_op)
+                except ValidationError as e:
+                    e.args = ('inner item ' + e.args[0],) + e.args[1:]
+                    raise
+            return patched
 
 
-class Bytes(Encodium):
+class Map(Encodium):
     class Definition(Encodium.Definition):
-        _encodium_type = bytes
+        _encodium_type = dict
+
+        def __init__(self, key_definition, value_definition, *args, **kwargs):
+            super().__init__(self, *args, **kwargs)
+            if key_definition._encodium_type not in (str, bytes, int):
+                raise TypeError("Map keys must be String, Bytes or Integer")
+            self.key_definition = key_definition
+            self.value_definition = value_definition
+            if type(self).check_value is Map.Definition.check_value:
+                self._encodium_check_needed = key_definition._encodium_check_needed or value_definition._encodium_check_needed
+
+        def check_type(self, value):
+            super().check_type(value)
+            if value is not None:
+                key_definition = self.key_definition
+                value_definition = self.value_definition
+                for key, inner_value in value.items():
+                    try:
+                        if key is None:
+                            raise ValidationError("cannot be None")
+                        if key.__class__ is bool:
+                            # True and False would collide with the keys 1 and 0.
+                            raise ValidationError("is supposed to be type %s, but was set to something of type %s." % (key_definition._encodium_type, bool))
+                        key_definition.check_type(key)
+                    except ValidationError as e:
+                        e.args = ('key ' + e.args[0],) + e.args[1:]
+                        raise
+                    try:
+                        value_definition.check_type(inner_value)
+                    except ValidationError as e:
+                        e.args = ('value for key %r ' % (key,) + e.args[0],) + e.args[1:]
+                        raise
 
         def check_value(self, value):
-            pass
+            key_definition = self.key_definition
+            value_definition = self.value_definition
+            for key, inner_value in value.items():
+                try:
+                    key_definition._encodium_check_value(key)
+                except ValidationError as e:
+                    e.args = ('key ' + e.args[0],) + e.args[1:]
+                    raise
+                if inner_value is None:
+                    continue
+                try:
+                    value_definition._encodium_check_value(inner_value)
+                except ValidationError as e:
+                    e.args = ('value for key %r ' % (key,) + e.args[0],) + e.args[1:]
+                    raise
+
+        def _key_primitive(self, key, for_json):
+            if type(key) is bytes:
+                return base64.b64encode(key).decode('utf-8') if for_json else key
+            elif type(key) is str:
+                return key.encode() if not for_json else key
+            return str(key).encode() if not for_json else str(key)
+
+        def _key_from_obj(self, obj):
+            if self.key_definition._encodium_type is int:
+                if type(obj) is int:
+                    return obj
+                # Only the form _key_primitive() produces is accepted, so
+                # every key has exactly one encoding.
+                try:
+                    text = obj.decode('ascii') if type(obj) is bytes else obj
+                    key = int(text)
+                except (ValueError, TypeError):
+                    raise ValidationError("key %r is not an integer" % (obj,))
+                if type(text) is not str or str(key) != text:
+                    raise ValidationError("key %r is not a canonical integer" % (obj,))
+                return key
+            return self.key_definition.from_obj(obj)
+
+        def _sorted_items(self, value, for_json):
+            ''' Returns the items of value with their keys as primitives, in
+            canonical order.
+            '''
+            return sorted([(self._key_primitive(key, for_json), inner_value) for key, inner_value in value.items()], key=lambda item: item[0])
+
+        def _encoded_items(self, value, codec):
+            ''' Returns the items of value with their keys encoded, including
+            the separator in JSON, in canonical order.
+            '''
+            if codec == 'bencode':
+                return [(b'%d:' % len(key) + key, inner_value) for key, inner_value in self._sorted_items(value, False)]
+            return [(json.dumps(key).encode() + b':', inner_value) for key, inner_value in self._sorted_items(value, True)]
+
+        def to_primitive(self, value):
+            value_definition = self.value_definition
+            return OrderedDict([(key, None if inner_value is None else value_definition.to_primitive(inner_value)) for key, inner_value in self._sorted_items(value, False)])
+
+        def to_json_primitive(self, value):
+            value_definition = self.value_definition
+            return OrderedDict([(key, None if inner_value is None else value_definition.to_json_primitive(inner_value)) for key, inner_value in self._sorted_items(value, True)])
+
+        def to_json(self, value):
+            value_definition = self.value_definition
+            items = [key.decode() + ('null' if inner_value is None else value_definition.to_json(inner_value)) for key, inner_value in self._encoded_items(value, 'json')]
+            return '{' + ','.join(items) + '}'
+
+        def to_graph_primitive(self, value, graph, for_json):
+            value_definition = self.value_definition
+            return OrderedDict([(key, None if inner_value is None else value_definition.to_graph_primitive(inner_value, graph, for_json)) for key, inner_value in self._sorted_items(value, for_json)])
+
+        def from_graph_obj(self, obj, graph):
+            if not isinstance(obj, dict):
+                raise ValidationError("Cannot create Map from " + obj.__class__.__name__)
+            value_definition = self.value_definition
+            return {self._key_from_obj(key): None if inner_obj is None else value_definition.from_graph_obj(inner_obj, graph) for key, inner_obj in obj.items()}
+
+        def from_obj(self, obj):
+            if not isinstance(obj, dict):
+                raise ValidationError("Cannot create Map from " + obj.__class__.__name__)
+            value_definition = self.value_definition
+            return {self._key_from_obj(key): None if inner_obj is None else value_definition.from_obj(inner_obj) for key, inner_obj in obj.items()}
+
+        def encoded_size(self, value, codec):
+            value_definition = self.value_definition
+            size = 2
+            for key, inner_value in self._encoded_items(value, codec):
+                size += len(key) + (4 if inner_value is None else value_definition.encoded_size(inner_value, codec))
+            if codec == 'json':
+                size += max(len(value) - 1, 0)
+            return size
+
+        def encode_into(self, value, view, offset, codec):
+            value_definition = self.value_definition
+            view[offset] = 0x64 if codec == 'bencode' else 0x7b  # d or {
+            offset += 1
+            for i, (key, inner_value) in enumerate(self._encoded_items(value, codec)):
+                if i and codec == 'json':
+                    view[offset] = 0x2c  # ,
+                    offset += 1
+                offset = _write(view, offset, key)
+                if inner_value is None:
+                    offset = _write(view, offset, b'null')
+                else:
+                    offset = value_definition.encode_into(inner_value, view, offset, codec)
+            view[offset] = 0x65 if codec == 'bencode' else 0x7d  # e or }
+            return offset + 1
+
+        def diff(self, old, new, for_json=False):
+            if not isinstance(old, dict) or not isinstance(new, dict):
+                return super().diff(old, new, for_json)
+            value_definition = self.value_definition
+            items = []
+            for key, new_value in new.items():
+                op = value_definition.diff(old.get(key), new_value, for_json)
+                if op is None and key not in old:
+                    # A new key whose value is None.
+                    op = OrderedDict([('d', 1)])
+                if op is not None:
+                    items.append([self._key_primitive(key, for_json), op])
+            removed = [self._key_primitive(key, for_json) for key in old if key not in new]
+            op = OrderedDict()
+            if items:
+                op['m'] = sorted(items, key=lambda item: item[0])
+            if removed:
+                op['r'] = sorted(removed)
+            return op or None
+
+        def patch(self, value, op):
+            op = _patch_op(op)
+            if value is None or ('m' not in op and 'r' not in op):
+                return super().patch(value, op)
+            patched = dict(value)
+            for key in op.get('r', ()):
+                patched.pop(self._key_from_obj(key), None)
+            for item in op.get('m', ()):
+                try:
+                    key, inner_op = item
+                except (TypeError, ValueError):
+                    raise ValidationError("has an invalid patch")
+                key = self._key_from_obj(key)
+                try:
+                    patched[key] = self.value_definition.patch(patched.get(key), inner_op)
+                except ValidationError as e:
+                    e.args = ('value for key %r ' % (key,) + e.args[0],) + e.args[1:]
+                    raise
+            return patched
+
+
+class Bytes(Encodium):
+    class Definition(Encodium.Definition):
+        _encodium_type = bytes
 
         def to_json(self, value):
             return json.dumps(base64.b64encode(value).decode('utf-8'))
 
+        def to_json_primitive(self, value):
+            return base64.b64encode(value).decode('utf-8')
+
+        def encoded_size(self, value, codec):
+            if codec == 'bencode':
+                return len(str(len(value))) + 1 + len(value)
+            # Quoted base64.
+            return 2 + (len(value) + 2) // 3 * 4
+
         @classmethod
         def from_obj(cls, obj):
             if type(obj) is bytes:
                 return obj
             try:
                 return base64.b64decode(obj)
-            except binascii.Error:
+            except (binascii.Error, TypeError, ValueError):
                 pass
             raise ValidationError("invalid base 64")
+
+
+# The library's own to_json() methods, which agree with to_json_primitive().
+_library_to_json = frozenset([Encodium.Definition.to_json, List.Definition.to_json, Map.Definition.to_json, Bytes.Definition.to_json])
+
+# Non-raising versions of the library's check_value() methods, for
+# try_from_obj().
+_value_predicates = {
+    Integer.Definition.check_value: lambda definition, value: not definition.non_negative or value >= 0,
+    FixedWidth.Definition.check_value: lambda definition, value: definition.minimum <= value <= definition.maximum,
+    Float64.Definition.check_value: lambda definition, value: True,
+    Float32.Definition.check_value: lambda definition, value: not math.isfinite(value) or abs(value) <= definition.maximum,
+    String.Definition.check_value: lambda definition, value: definition.max_length is None or len(value) <= definition.max_length,
+    Enum.Definition.check_value: lambda definition, value: value in definition._encodium_values,
+}
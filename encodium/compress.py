@@ -0,0 +1,182 @@
+'''
+
+Compression
+===========
+
+Encoded messages are dominated by field names and small values, which
+per-message zlib can't compress well because each message is too short to
+repeat anything. Two things help: a preset dictionary, built from the field
+names of a class and some sample messages, and a compression context which
+persists across all the messages on a connection::
+
+    from encodium.compress import build_dictionary, CompressedStream
+
+    zdict = build_dictionary(Person, samples=[john, jane])
+
+    stream = CompressedStream(sock, Person, zdict=zdict)
+    stream.send(john)
+    john = stream.recv()
+
+Both ends must use the same dictionary and codec. Each message is sent as a
+four byte big-endian length followed by its compressed bytes, and is
+flushed with ``Z_SYNC_FLUSH`` so the receiver can decode it straight away.
+
+``CompressedStream`` also works on files opened in binary mode, and
+iterating over it yields the objects until the end of the file::
+
+    with open('people.z', 'wb') as f:
+        stream = CompressedStream(f, Person, zdict=zdict)
+        for person in people:
+            stream.send(person)
+
+    with open('people.z', 'rb') as f:
+        people = list(CompressedStream(f, Person, zdict=zdict))
+
+A file must be written by a single ``CompressedStream``, since every message
+depends on the ones before it.
+
+``RecordStore`` takes a ``zdict`` too. Its records can be read in any order,
+so each one is compressed on its own, with the dictionary alone.
+
+'''
+
+import zlib
+import struct
+
+from encodium import Encodium, List, Map
+
+_length = struct.Struct('>I')
+
+# Raw deflate, as the zlib header and checksum would cost more than they are
+# worth on small messages.
+_wbits = -15
+
+
+def _field_names(cls, codec, seen):
+    ''' Yields the encoded field names of cls and of the classes nested in
+    it.
+    '''
+    if cls in seen:
+        return
+    seen.add(cls)
+    keys = cls._encodium_bencoded_keys if codec == 'bencode' else cls._encodium_json_keys
+    for name in cls._encodium_sorted_fields:
+        yield keys[name]
+        definition = cls._encodium_fields[name]
+        while isinstance(definition, (List.Definition, Map.Definition)):
+            definition = definition.inner_definition if isinstance(definition, List.Definition) else definition.value_definition
+        nested = definition._encodium_type
+        if isinstance(nested, type) and issubclass(nested, Encodium):
+            yield from _field_names(nested, codec, seen)
+
+
+def build_dictionary(cls, samples=(), codec='bencode', size=32768):
+    ''' Returns a preset zlib dictionary for messages of cls, made from its
+    field names and the encodings of the sample objects.
+
+    zlib finds the end of the dictionary most cheaply, so the samples, which
+    are closest to real messages, are placed after the field names. The
+    dictionary is cut to its last size bytes.
+    '''
+    if codec not in ('bencode', 'json'):
+        raise ValueError("Unknown codec " + repr(codec))
+    parts = list(_field_names(cls, codec, set()))
+    for sample in samples:
+        parts.append(sample.to_bencode() if codec == 'bencode' else sample.to_json().encode())
+    return b''.join(parts)[-size:]
+
+
+class Compressor:
+    ''' Compresses a sequence of messages with one context, so later messages
+    can refer back to earlier ones.
+    '''
+
+    def __init__(self, zdict=None, level=6):
+        if zdict:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, _wbits, zdict=zdict)
+        else:
+            self._compressor = zlib.compressobj(level, zlib.DEFLATED, _wbits)
+
+    def compress(self, data):
+        ''' Returns the compressed message, which can be decompressed as soon
+        as it is received.
+        '''
+        return self._compressor.compress(data) + self._compressor.flush(zlib.Z_SYNC_FLUSH)
+
+
+class Decompressor:
+    ''' Decompresses messages produced by a Compressor, in order. '''
+
+    def __init__(self, zdict=None):
+        if zdict:
+            self._decompressor = zlib.decompressobj(_wbits, zdict=zdict)
+        else:
+            self._decompressor = zlib.decompressobj(_wbits)
+
+    def decompress(self, data):
+        return self._decompressor.decompress(data)
+
+
+def compress(data, zdict=None, level=6):
+    ''' Compresses a single message with its own context. '''
+    return Compressor(zdict, level).compress(data)
+
+
+def decompress(data, zdict=None):
+    ''' Decompresses a message produced by compress(). '''
+    return Decompressor(zdict).decompress(data)
+
+
+class CompressedStream:
+    ''' Sends and receives compressed, length-prefixed cls objects over a
+    socket or a binary file.
+    '''
+
+    def __init__(self, stream, cls, zdict=None, codec='bencode', level=6):
+        if codec not in ('bencode', 'json'):
+            raise ValueError("Unknown codec " + repr(codec))
+        self.cls = cls
+        self.codec = codec
+        self._write = stream.write if hasattr(stream, 'write') else stream.sendall
+        self._read = stream.read if hasattr(stream, 'read') else stream.recv
+        self._compressor = Compressor(zdict, level)
+        self._decompressor = Decompressor(zdict)
+
+    def send(self, obj):
+        if not isinstance(obj, self.cls):
+            raise TypeError("Cannot send %s on a stream of %s" % (obj.__class__.__name__, self.cls.__name__))
+        data = self._compressor.compress(obj.to_bencode() if self.codec == 'bencode' else obj.to_json().encode())
+        self._write(_length.pack(len(data)) + data)
+
+    def _read_exactly(self, size):
+        chunks = []
+        while size:
+            chunk = self._read(size)
+            if not chunk:
+                raise ConnectionError("connection closed")
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def _decode(self, length):
+        data = self._decompressor.decompress(self._read_exactly(length))
+        if self.codec == 'bencode':
+            return self.cls.from_bencode(data)
+        return self.cls.from_json(data.decode())
+
+    def recv(self):
+        length, = _length.unpack(self._read_exactly(_length.size))
+        return self._decode(length)
+
+    def __iter__(self):
+        ''' Yields received objects until the stream ends between two of
+        them.
+        '''
+        while True:
+            header = self._read(_length.size)
+            if not header:
+                return
+            if len(header) < _length.size:
+                header += self._read_exactly(_length.size - len(header))
+            length, = _length.unpack(header)
+            yield self._decode(length)
@@ -40,6 +40,58 @@ def _encodium_get_locals(func):
     return ret
 
 
+def _encodium_class_cache(cls, name, func):
+    ''' Returns func()'s locals, traced once per class and then cached. '''
+    cached = cls.__dict__.get(name)
+    if cached is None:
+        cached = _encodium_get_locals(func)
+        setattr(cls, name, cached)
+    return cached
+
+
+def _encode_length(length):
+    encoded_length = length.to_bytes((length.bit_length() + 7) >> 3, 'big')
+    if length >= 0xfa:
+        encoded_length_length = len(encoded_length)
+        if encoded_length_length > 6:
+            raise ValidationError("length too big")
+        encoded_length = bytes([encoded_length_length + 0xf9]) + encoded_length
+    return encoded_length
+
+
+def _decode_length(data, index=0):
+    length = data[index]
+    length_length = 1
+    if length >= 0xfa:
+        length_length = 1 + (length - 0xf9)
+        length = int.from_bytes(data[index + 1:index + 1 + (length - 0xf9)], 'big')
+    # TODO: validation on decoded length
+    return length, length_length
+
+
+def _deserialize(field, item):
+    ''' Fields with fields are split further, so they are given the
+    memoryview slice; other fields are given bytes.
+    '''
+    if hasattr(field.__class__, 'fields') or isinstance(field, List):
+        return field.deserialize(item)
+    return field.deserialize(bytes(item))
+
+
+def _split(data):
+    ''' Splits serialized data into its length-prefixed items. They are
+    memoryview slices, so nested items aren't copied.
+    '''
+    data = memoryview(data)
+    i = 1
+    array = []
+    while i < len(data):
+        length, length_length = _decode_length(data, i)
+        array.append(data[i + length_length:i + length_length + length])
+        i += length_length + length
+    return array
+
+
 class Field(object):
     _order = 0
 
@@ -48,6 +100,10 @@ class Field(object):
         self._order = Field._order
         Field._order += 1
 
+        # The instance type only depends on the class, so it is made once.
+        if not hasattr(self, 'type') and '_encodium_instance_type' in self.__class__.__dict__:
+            self.type = self.__class__._encodium_instance_type
+
         if not hasattr(self, 'type'):
 
             class FieldInstance(object):
@@ -72,15 +128,14 @@ class Field(object):
                 def __eq__(inner_self, other):
                     if inner_self.__class__.__name__ != other.__class__.__name__:
                         return False
-                    fields = self.get_fields()
-                    for name, field in fields:
+                    for name, field in self.get_fields():
                         if getattr(inner_self, name) != getattr(other, name):
                             return False
                     return True
 
                 def __setattr__(inner_self, key, value):
                     nonlocal self
-                    fields = dict(self.get_fields())
+                    fields = self._encodium_field_map()
                     if key in fields:
                         field = fields[key]
                         if value is None:
@@ -104,6 +159,7 @@ class Field(object):
             self.type = type(self.__class__.__name__ + 'Instance',
                              (FieldInstance,),
                              dict(self.__class__.__dict__))
+            self.__class__._encodium_instance_type = self.type
 
         # Add the REAL make (not a class function, instance function)
 
@@ -118,7 +174,7 @@ class Field(object):
 
         self.make = types.MethodType(make, self)
 
-        options = _encodium_get_locals(self.__class__.default_options)
+        options = _encodium_class_cache(self.__class__, '_encodium_options', self.__class__.default_options)
         self.default = None
         self.optional = None
         for key, value in options.items():
@@ -146,24 +202,27 @@ class Field(object):
         # Default serialize is to go through each of the fields.
         if not hasattr(self.__class__, 'fields'):
             raise NotImplementedError(self.__class__.__name__ + " has no fields")
-        fields = _encodium_get_locals(self.__class__.fields)
-        ordered_fields = []
-        for key, value in fields.items():
-            if isinstance(value, Field):
-                ordered_fields.append((value._order, key, value))
-        ordered_fields.sort()
-        return [(key, value) for _, key, value in ordered_fields]
+        # fields() is only run once per class, so every instance shares the
+        # same Field objects.
+        cls = self.__class__
+        ordered_fields = cls.__dict__.get('_encodium_fields')
+        if ordered_fields is None:
+            fields = _encodium_get_locals(cls.fields)
+            ordered_fields = []
+            for key, value in fields.items():
+                if isinstance(value, Field):
+                    ordered_fields.append((value._order, key, value))
+            ordered_fields.sort()
+            ordered_fields = [(key, value) for _, key, value in ordered_fields]
+            cls._encodium_fields = ordered_fields
+            cls._encodium_field_dict = dict(ordered_fields)
+        return ordered_fields
+
+    def _encodium_field_map(self):
+        self.get_fields()
+        return self.__class__._encodium_field_dict
 
     def serialize(self, value):
-        def encode_length(length):
-            encoded_length = length.to_bytes((length.bit_length() + 7) >> 3, 'big')
-            if length >= 0xfa:
-                encoded_length_length = len(encoded_length)
-                if encoded_length_length > 6:
-                    raise ValidationError("length too big")
-                encoded_length = bytes([encoded_length_length + 0xf9]) + encoded_length
-            return encoded_length
-
         array = [b'\x01']
         for key, field in self.get_fields():
             attr = getattr(value, key)
@@ -171,32 +230,17 @@ class Field(object):
                 array.append(b'\x00')
             else:
                 data = field.serialize(attr)
-                array.append(encode_length(len(data)))
+                array.append(_encode_length(len(data)))
                 array.append(data)
         return b''.join(array)
 
     def deserialize(self, data):
-        def decode_length(data, index=0):
-            length = int.from_bytes(data[index:index + 1], 'big')
-            length_length = 1
-            if length >= 0xfa:
-                length_length = 1 + (length - 0xf9)
-                length = int.from_bytes(data[index + 1:index + 1 + (length - 0xf9)], 'big')
-            # TODO: validation on decoded length
-            return length, length_length
-
-        i = 1
-        array = []
-        while i < len(data):
-            length, length_length = decode_length(data, i)
-            array.append(data[i + length_length:i + length_length + length])
-            i += length_length + length
         kwargs = {}
-        for (key, field), item in zip(self.get_fields(), array):
-            if item is b'':
+        for (key, field), item in zip(self.get_fields(), _split(data)):
+            if not item:
                 kwargs[key] = None
             else:
-                kwargs[key] = field.deserialize(item)
+                kwargs[key] = _deserialize(field, item)
         return self.make(**kwargs)
 
     @classmethod
@@ -265,42 +309,18 @@ class List(Field):
                 raise
 
     def serialize(self, l):
-        def encode_length(length):
-            encoded_length = length.to_bytes((length.bit_length() + 7) >> 3, 'big')
-            if length >= 0xfa:
-                encoded_length_length = len(encoded_length)
-                if encoded_length_length > 6:
-                    raise ValidationError("length too big")
-                encoded_length = bytes([encoded_length_length + 0xf9]) + encoded_length
-            return encoded_length
-
         array = [b'\x01']
         for attr in l:
             if attr is None:
                 array.append(b'\x00')
             else:
                 data = self.inner_field.serialize(attr)
-                array.append(encode_length(len(data)))
+                array.append(_encode_length(len(data)))
                 array.append(data)
         return b''.join(array)
 
     def deserialize(self, data):
-        def decode_length(data, index=0):
-            length = int.from_bytes(data[index:index + 1], 'big')
-            length_length = 1
-            if length >= 0xfa:
-                length_length = 1 + (length - 0xf9)
-                length = int.from_bytes(data[index + 1:index + 1 + (length - 0xf9)], 'big')
-            # TODO: validation on decoded length
-            return length, length_length
-
-        i = 1
-        array = []
-        while i < len(data):
-            length, length_length = decode_length(data, i)
-            array.append(self.inner_field.deserialize(data[i + length_length:i + length_length + length]))
-            i += length_length + length
-        return array
+        return [_deserialize(self.inner_field, item) for item in _split(data)]
 
 
 class Boolean(Field):
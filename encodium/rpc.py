@@ -0,0 +1,313 @@
+'''
+
+RPC
+===
+
+Typed request/response calls over a single connection::
+
+    from encodium.rpc import Method, LoopbackServer, ConnectionPool
+
+    lookup = Method('lookup', LookupRequest, Person)
+
+    server = LoopbackServer({lookup: lambda request: people[request.name]})
+
+    pool = ConnectionPool()
+    john = pool.get(server.address).call(lookup, LookupRequest(name='John'))
+
+Every call carries a request id, so many calls can be in flight on one
+connection at once and responses may arrive in any order. ``call_async()``
+sends a request without waiting for the response, which lets calls be
+pipelined.
+
+``Connection`` uses blocking sockets and a reader thread, while
+``AsyncConnection`` uses asyncio streams. Both use the same framing: a four
+byte big-endian length followed by a bencoded ``Envelope``.
+
+'''
+
+import socket
+import struct
+import asyncio
+import threading
+import itertools
+import socketserver
+from concurrent.futures import Future
+
+from bencodepy import DecodingError
+
+from encodium import Encodium, Integer, String, Bytes, ValidationError
+
+_length = struct.Struct('>I')
+
+
+class RemoteError(Exception):
+    ''' Raised when the remote handler for a call fails. '''
+    pass
+
+
+class Envelope(Encodium):
+    ''' The frame sent for each request and response. '''
+    id = Integer.Definition(non_negative=True)
+    method = String.Definition(optional=True)
+    body = Bytes.Definition(optional=True)
+    error = String.Definition(optional=True)
+
+
+class Method:
+    ''' Pairs the name of a remote method with its request and response
+    types.
+    '''
+
+    def __init__(self, name, request, response):
+        self.name = name
+        self.request = request
+        self.response = response
+
+
+def encode_frame(envelope):
+    data = envelope.serialize()
+    return _length.pack(len(data)) + data
+
+
+class FrameDecoder:
+    ''' Incrementally splits received bytes into Envelopes. '''
+
+    def __init__(self):
+        self._buffer = bytearray()
+
+    def feed(self, data):
+        ''' Adds received data and returns the Envelopes it completes. '''
+        self._buffer += data
+        envelopes = []
+        start = 0
+        while len(self._buffer) - start >= _length.size:
+            length, = _length.unpack_from(self._buffer, start)
+            end = start + _length.size + length
+            if end > len(self._buffer):
+                break
+            try:
+                envelopes.append(Envelope.deserialize(bytes(self._buffer[start + _length.size:end])))
+            except (DecodingError, ValueError, TypeError) as e:
+                # bencodepy raises ValueError for malformed integers.
+                raise ValidationError("Invalid frame: %s" % e)
+            start = end
+        del self._buffer[:start]
+        return envelopes
+
+
+def _response(method, envelope):
+    if envelope.error is not None:
+        raise RemoteError(envelope.error)
+    return method.response.deserialize(envelope.body)
+
+
+class Connection:
+    ''' A blocking connection that multiplexes calls by request id. '''
+
+    def __init__(self, address, timeout=None):
+        self.address = address
+        self._sock = socket.create_connection(address, timeout)
+        self._sock.settimeout(None)
+        self._send_lock = threading.Lock()
+        self._pending = {}
+        self._pending_lock = threading.Lock()
+        self._ids = itertools.count()
+        self.closed = False
+        self._reader = threading.Thread(target=self._read, daemon=True)
+        self._reader.start()
+
+    def _read(self):
+        decoder = FrameDecoder()
+        error = None
+        try:
+            while True:
+                data = self._sock.recv(65536)
+                if not data:
+                    break
+                for envelope in decoder.feed(data):
+                    with self._pending_lock:
+                        future, method = self._pending.pop(envelope.id, (None, None))
+                    if future is None:
+                        continue
+                    try:
+                        future.set_result(_response(method, envelope))
+                    except Exception as e:
+                        future.set_exception(e)
+        except (OSError, ValidationError) as e:
+            error = e
+        with self._pending_lock:
+            self.closed = True
+            pending, self._pending = self._pending, {}
+        if error is not None:
+            # The stream can't be resynchronised after a bad frame.
+            try:
+                self._sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+        for future, _ in pending.values():
+            future.set_exception(error or ConnectionError("connection closed"))
+
+    def call_async(self, method, request):
+        ''' Sends a request and returns a Future for its response. '''
+        if not isinstance(request, method.request):
+            raise TypeError("%s expects a %s" % (method.name, method.request.__name__))
+        future = Future()
+        request_id = next(self._ids)
+        with self._pending_lock:
+            if self.closed:
+                raise ConnectionError("connection closed")
+            self._pending[request_id] = (future, method)
+        frame = encode_frame(Envelope(id=request_id, method=method.name, body=request.serialize()))
+        with self._send_lock:
+            self._sock.sendall(frame)
+        return future
+
+    def call(self, method, request, timeout=None):
+        return self.call_async(method, request).result(timeout)
+
+    def close(self):
+        self.closed = True
+        try:
+            self._sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self._sock.close()
+
+
+class AsyncConnection:
+    ''' An asyncio connection that multiplexes calls by request id. '''
+
+    def __init__(self, reader, writer):
+        self._reader = reader
+        self._writer = writer
+        self._pending = {}
+        self._ids = itertools.count()
+        self.closed = False
+        self._task = asyncio.ensure_future(self._read())
+
+    @classmethod
+    async def open(cls, address):
+        reader, writer = await asyncio.open_connection(*address)
+        return cls(reader, writer)
+
+    async def _read(self):
+        decoder = FrameDecoder()
+        error = None
+        try:
+            while True:
+                data = await self._reader.read(65536)
+                if not data:
+                    break
+                for envelope in decoder.feed(data):
+                    future, method = self._pending.pop(envelope.id, (None, None))
+                    if future is None or future.done():
+                        continue
+                    try:
+                        future.set_result(_response(method, envelope))
+                    except Exception as e:
+                        future.set_exception(e)
+        except (OSError, ValidationError) as e:
+            error = e
+        self.closed = True
+        if error is not None:
+            self._writer.close()
+        pending, self._pending = self._pending, {}
+        for future, _ in pending.values():
+            if not future.done():
+                future.set_exception(error or ConnectionError("connection closed"))
+
+    def call_async(self, method, request):
+        ''' Sends a request and returns an asyncio Future for its response. '''
+        if not isinstance(request, method.request):
+            raise TypeError("%s expects a %s" % (method.name, method.request.__name__))
+        if self.closed:
+            raise ConnectionError("connection closed")
+        future = asyncio.get_running_loop().create_future()
+        request_id = next(self._ids)
+        self._pending[request_id] = (future, method)
+        self._writer.write(encode_frame(Envelope(id=request_id, method=method.name, body=request.serialize())))
+        return future
+
+    async def call(self, method, request):
+        future = self.call_async(method, request)
+        await self._writer.drain()
+        return await future
+
+    async def close(self):
+        self._writer.close()
+        await self._writer.wait_closed()
+        await self._task
+
+
+class ConnectionPool:
+    ''' Keeps one open Connection per (host, port) endpoint. '''
+
+    def __init__(self, timeout=None):
+        self.timeout = timeout
+        self._connections = {}
+        self._lock = threading.Lock()
+
+    def get(self, address):
+        address = tuple(address)
+        with self._lock:
+            connection = self._connections.get(address)
+            if connection is None or connection.closed:
+                connection = Connection(address, self.timeout)
+                self._connections[address] = connection
+            return connection
+
+    def close(self):
+        with self._lock:
+            connections, self._connections = self._connections, {}
+        for connection in connections.values():
+            connection.close()
+
+
+def handle_envelope(handlers, envelope):
+    ''' Runs the handler for a request Envelope and returns the response
+    Envelope. handlers maps Methods to functions taking a request and
+    returning a response.
+    '''
+    if envelope.method not in handlers:
+        return Envelope(id=envelope.id, error="unknown method " + str(envelope.method))
+    method, handler = handlers[envelope.method]
+    try:
+        response = handler(method.request.deserialize(envelope.body))
+        if not isinstance(response, method.response):
+            raise TypeError("%s returned a %s" % (method.name, response.__class__.__name__))
+        return Envelope(id=envelope.id, body=response.serialize())
+    except Exception as e:
+        return Envelope(id=envelope.id, error="%s: %s" % (e.__class__.__name__, e))
+
+
+class LoopbackServer:
+    ''' A threaded server on localhost, for tests and local services. '''
+
+    def __init__(self, handlers, host='127.0.0.1', port=0):
+        handlers = {method.name: (method, handler) for method, handler in handlers.items()}
+
+        class Handler(socketserver.BaseRequestHandler):
+            def handle(inner_self):
+                decoder = FrameDecoder()
+                while True:
+                    data = inner_self.request.recv(65536)
+                    if not data:
+                        break
+                    frames = [encode_frame(handle_envelope(handlers, envelope)) for envelope in decoder.feed(data)]
+                    inner_self.request.sendall(b''.join(frames))
+
+        self._server = socketserver.ThreadingTCPServer((host, port), Handler)
+        self._server.daemon_threads = True
+        self.address = self._server.server_address
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+        self._thread.start()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        self._server.shutdown()
+        self._server.server_close()
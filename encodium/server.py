@@ -0,0 +1,157 @@
+'''
+
+Server
+======
+
+An asyncio server which receives Encodium objects, passes each one to a
+handler and sends back the handler's response::
+
+    from encodium.server import Server
+
+    async def greet(person):
+        return Greeting(text='Hello ' + person.name)
+
+    async with Server(Person, greet, port=8000) as server:
+        await server.serve_forever()
+
+Messages use the same framing as ``send_to()`` and ``recv_from()``: one
+line of JSON per object. A client may send many requests without waiting,
+and the responses come back in the same order. The handler may be a plain
+function or a coroutine function.
+
+Decoding a large message can hold up every other connection, so messages
+of at least ``offload_size`` bytes are decoded in ``executor`` (the loop's
+default thread pool if it is None). A ``ProcessPoolExecutor`` may be used
+if the request class can be pickled, i.e. it is defined at module level.
+
+Two limits apply backpressure. Each connection stops reading once
+``max_pending`` of its requests are waiting for a response, and at most
+``max_in_flight`` requests are decoded or handled at once across all
+connections. Lines longer than ``max_size`` bytes are rejected.
+
+A connection is closed if it sends an invalid message or its handler
+raises, after the responses to its earlier requests have been sent.
+
+``close()`` shuts down gracefully: the server stops accepting connections
+and reading requests, sends the responses to the requests it has already
+read, and then closes every connection.
+
+'''
+
+import asyncio
+import inspect
+
+
+def _decode(cls, data):
+    return cls.from_json(data.decode())
+
+
+class Server:
+    ''' Serves one handler for requests of type cls. '''
+
+    def __init__(self, cls, handler, host='127.0.0.1', port=0, executor=None, offload_size=65536,
+                 max_pending=16, max_in_flight=256, max_size=2 ** 24):
+        self.cls = cls
+        self.handler = handler
+        self.host = host
+        self.port = port
+        self.executor = executor
+        self.offload_size = offload_size
+        self.max_pending = max_pending
+        self.max_in_flight = max_in_flight
+        self.max_size = max_size
+        self.address = None
+        self._server = None
+        self._in_flight = None
+        self._connections = set()
+
+    async def __aenter__(self):
+        await self.start()
+        return self
+
+    async def __aexit__(self, *exc_info):
+        await self.close()
+
+    async def start(self):
+        self._in_flight = asyncio.Semaphore(self.max_in_flight)
+        self._server = await asyncio.start_server(self._serve, self.host, self.port, limit=self.max_size)
+        self.address = self._server.sockets[0].getsockname()[:2]
+
+    async def serve_forever(self):
+        ''' Serves until close() is called. '''
+        try:
+            await self._server.serve_forever()
+        except asyncio.CancelledError:
+            if self._server.is_serving():
+                raise
+
+    async def close(self):
+        self._server.close()
+        connections = list(self._connections)
+        for connection in connections:
+            connection.cancel()
+        await asyncio.gather(*connections, return_exceptions=True)
+        await self._server.wait_closed()
+
+    async def _serve(self, reader, writer):
+        connection = asyncio.current_task()
+        self._connections.add(connection)
+        replies = asyncio.Queue(self.max_pending)
+        replier = asyncio.ensure_future(self._reply(replies, writer))
+        try:
+            while not replier.done():
+                try:
+                    line = await reader.readline()
+                except (ValueError, ConnectionError):
+                    # The line was too long, or the connection was lost.
+                    break
+                if not line.endswith(b'\n'):
+                    break
+                # Blocks while max_pending requests are waiting.
+                await replies.put(asyncio.ensure_future(self._handle(line)))
+        except asyncio.CancelledError:
+            # Shutting down: stop reading, but send the pending responses.
+            pass
+        finally:
+            self._connections.discard(connection)
+            await replies.put(None)
+            await replier
+            writer.close()
+            try:
+                await writer.wait_closed()
+            except ConnectionError:
+                pass
+
+    async def _handle(self, line):
+        async with self._in_flight:
+            if len(line) >= self.offload_size:
+                request = await asyncio.get_running_loop().run_in_executor(self.executor, _decode, self.cls, line)
+            else:
+                request = _decode(self.cls, line)
+            response = self.handler(request)
+            if inspect.isawaitable(response):
+                response = await response
+            return response
+
+    async def _reply(self, replies, writer):
+        ''' Sends the responses in the order the requests arrived. After an
+        error the connection is closed and the remaining requests are
+        cancelled.
+        '''
+        failed = False
+        while True:
+            task = await replies.get()
+            if task is None:
+                return
+            if failed:
+                if not task.cancel() and not task.cancelled():
+                    # Retrieve the exception, so it isn't logged.
+                    task.exception()
+                continue
+            try:
+                response = await task
+                writer.write((response.to_json() + '\n').encode())
+                await writer.drain()
+            except Exception:
+                failed = True
+                writer.close()
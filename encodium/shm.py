@@ -0,0 +1,200 @@
+'''
+
+Shared Memory
+=============
+
+Passes large objects between processes on the same host without copying
+them through a pipe. The sender encodes the object straight into a shared
+memory segment and sends only a small ``Handle``::
+
+    from encodium.shm import share, attach
+
+    shared = share(city)
+    queue.put(shared.handle)
+    ...
+    shared.close()
+
+The receiver attaches to the segment and decodes fields as they are used::
+
+    with attach(City, queue.get()) as city:
+        for party in city.parties:
+            ...
+
+Each field is decoded and validated the first time it is read. ``Bytes``
+fields are returned as ``memoryview`` slices of the segment rather than
+copied, and become unusable once the receiver closes it. ``decode()``
+returns an ordinary, fully validated object, copied out of the segment.
+``check()`` is only run by ``decode()``.
+
+The process which shared an object owns the segment: ``close()`` frees it,
+so it must not be called until every receiver has attached and finished.
+Receivers only ever close their own mapping, and never free the segment.
+
+'''
+
+from multiprocessing import shared_memory, resource_tracker
+
+from bencodepy import decode as from_bencode, DecodingError
+
+from encodium import Encodium, Bytes, String, Integer, ValidationError
+from encodium.stream import _find, _skip, _int
+
+
+class Handle(Encodium):
+    ''' Names a shared object. It is small enough to pickle or send. '''
+    name = String.Definition()
+    size = Integer.Definition(non_negative=True)
+
+
+class SharedObject:
+    ''' An object encoded into a new shared memory segment, which is freed by
+    close().
+    '''
+
+    def __init__(self, obj):
+        size = obj.encoded_size()
+        self._memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        try:
+            obj.encode_into(self._memory.buf)
+        except BaseException:
+            self.close()
+            raise
+        self.handle = Handle(name=self._memory.name, size=size)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        if self._memory is not None:
+            self._memory.close()
+            self._memory.unlink()
+            self._memory = None
+
+
+def share(obj):
+    ''' Encodes obj into a new shared memory segment. '''
+    return SharedObject(obj)
+
+
+def _open(name):
+    ''' Attaches to an existing segment without letting this process's
+    resource tracker free it when the process exits.
+    '''
+    try:
+        return shared_memory.SharedMemory(name, track=False)
+    except TypeError:
+        # Before Python 3.13, attaching registers the segment as if this
+        # process had created it.
+        memory = shared_memory.SharedMemory(name)
+        resource_tracker.unregister(memory._name, 'shared_memory')
+        return memory
+
+
+class AttachedObject:
+    ''' A read-only view of a shared object, which decodes its fields
+    lazily.
+    '''
+
+    def __init__(self, cls, handle):
+        self._cls = cls
+        self._memory = _open(handle.name)
+        self._buf = self._memory.buf[:handle.size]
+        self._offsets = {}
+        self._values = {}
+        self._views = []
+        try:
+            self._index()
+        except IndexError:
+            self.close()
+            raise ValidationError("Unexpected end of shared object")
+        except ValidationError:
+            self.close()
+            raise
+
+    def _index(self):
+        ''' Finds where each field's value is, without decoding it. '''
+        buf = self._buf
+        if buf[0] != 0x64:  # d
+            raise ValidationError("Cannot create Encodium object from non-dict bencode")
+        keys = self._cls._encodium_keys
+        offset = 1
+        while buf[offset] != 0x65:  # e
+            colon = _find(buf, 0x3a, offset)
+            end = colon + 1 + _int(bytes(buf[offset:colon]))
+            entry = keys.get(bytes(buf[colon + 1:end]))
+            start, offset = end, _skip(buf, end)
+            if entry is not None:
+                self._offsets[entry[0]] = (start, offset)
+            elif self._cls._encodium_unknown_fields == 'error':
+                raise ValidationError(bytes(buf[colon + 1:end]).decode(errors='replace') + " is not a field of " + self._cls.__name__)
+
+    def __getattr__(self, name):
+        definition = self._cls._encodium_fields.get(name)
+        if definition is None or name.startswith('_'):
+            raise AttributeError(name)
+        if name not in self._values:
+            self._values[name] = self._decode_field(name, definition)
+        return self._values[name]
+
+    def _decode_field(self, name, definition):
+        if self._buf is None:
+            raise ValueError("shared object is closed")
+        try:
+            if name not in self._offsets:
+                value = definition.default() if callable(definition.default) else definition.default
+                definition.check_type(value)
+                return value
+            start, end = self._offsets[name]
+            if type(definition) is Bytes.Definition:
+                # Bytes are returned without being copied.
+                view = self._buf[_find(self._buf, 0x3a, start) + 1:end]
+                self._views.append(view)
+                return view
+            try:
+                obj = from_bencode(bytes(self._buf[start:end]))
+            except (DecodingError, ValueError, TypeError):
+                # _index() only checks the structure; bencodepy raises
+                # ValueError for malformed integers.
+                raise ValidationError("Invalid bencode")
+            if type(obj) is tuple:
+                # bencodepy returns top-level strings and integers in a tuple.
+                obj = obj[0]
+            value = definition.from_obj(obj)
+            definition.check_type(value)
+            definition._encodium_check_value(value)
+        except ValidationError as e:
+            e.args = (name + " " + e.args[0],) + e.args[1:]
+            raise
+        return value
+
+    def decode(self):
+        ''' Returns a copy of the whole object, fully validated. '''
+        return self._cls.from_bencode(bytes(self._buf))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def close(self):
+        ''' Unmaps the segment. Bytes values read from it can't be used
+        afterwards.
+        '''
+        if self._memory is None:
+            return
+        for view in self._views:
+            view.release()
+        self._views = []
+        self._buf.release()
+        self._buf = None
+        self._memory.close()
+        self._memory = None
+
+
+def attach(cls, handle):
+    ''' Attaches to an object of type cls shared with share(). '''
+    return AttachedObject(cls, handle)
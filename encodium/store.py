@@ -0,0 +1,471 @@
+'''
+
+Record Store
+============
+
+An append-only log of Encodium objects, read through ``mmap``::
+
+    from encodium.store import RecordStore
+
+    with RecordStore('people.log', Person) as store:
+        number = store.append(john)
+        john = store[number]
+
+        for person in store.iter_range(10, 20):
+            print(person.name)
+
+Each record is the object's ``serialize()`` output, prefixed with its length
+and a CRC32. The offset of every record is kept in an index file alongside
+the log (``people.log.idx``), so opening a store doesn't read the log.
+
+If the process dies part way through an append, the next open discards the
+incomplete record and indexes any complete records the index missed. Field
+indexes forget any entries for records the log lost.
+
+Passing ``zdict`` (see ``encodium.compress.build_dictionary()``) compresses
+each record with that preset dictionary. A store must always be opened with
+the dictionary it was written with.
+
+Secondary Indexes
+-----------------
+
+Fields declared with ``indexed=True`` are indexed by value::
+
+    class Person(Encodium):
+        name = String.Definition(indexed=True)
+        age = Integer.Definition()
+
+    with RecordStore('people.log', Person) as store:
+        johns = list(store.find('name', 'John'))
+        ns = list(store.find_range('name', 'N', 'O'))
+
+Each index is a sorted run of ``(value, record number)`` entries, searched by
+bisection, plus a journal of entries appended since the run was written. When
+the journal grows past ``compact_threshold`` entries it is merged into the
+run. ``rebuild_index()`` builds an index from the whole log using sorted
+chunks of at most ``chunk_size`` entries, so memory stays bounded.
+
+'''
+
+import os
+import mmap
+import heapq
+import bisect
+import struct
+import zlib
+
+from encodium.compress import compress, decompress
+from bencodepy import encode as to_bencode, decode as from_bencode
+
+_header = struct.Struct('>II')
+_offset = struct.Struct('>Q')
+
+
+def _read(f, offset, size):
+    f.seek(offset)
+    return f.read(size)
+
+
+class _Log:
+    ''' An append-only log of length prefixed byte strings, with a persisted
+    offset index.
+    '''
+
+    def __init__(self, path):
+        self.path = path
+        self._data = open(path, 'a+b')
+        self._index = open(path + '.idx', 'a+b')
+        self._data_size = os.fstat(self._data.fileno()).st_size
+        self._count = os.fstat(self._index.fileno()).st_size // _offset.size
+        self._data_map = None
+        self._index_map = None
+        self._mapped_count = 0
+        self._recover()
+
+    def _record_length(self, offset):
+        ''' Returns the length of the record at offset, or None if it is
+        incomplete or corrupt.
+        '''
+        header = _read(self._data, offset, _header.size)
+        if len(header) < _header.size:
+            return None
+        length, crc = _header.unpack(header)
+        if offset + _header.size + length > self._data_size:
+            return None
+        if zlib.crc32(_read(self._data, offset + _header.size, length)) != crc:
+            return None
+        return length
+
+    def _recover(self):
+        # Drop index entries pointing at records which never made it to disk.
+        end = 0
+        while self._count:
+            offset, = _offset.unpack(_read(self._index, (self._count - 1) * _offset.size, _offset.size))
+            length = self._record_length(offset)
+            if length is not None:
+                end = offset + _header.size + length
+                break
+            self._count -= 1
+        self._index.truncate(self._count * _offset.size)
+
+        # Index complete records written after the last index entry, and
+        # discard anything after them.
+        while True:
+            length = self._record_length(end)
+            if length is None:
+                break
+            self._index.write(_offset.pack(end))
+            self._count += 1
+            end += _header.size + length
+        self._index.flush()
+        self._data.truncate(end)
+        self._data_size = end
+
+    def _remap(self):
+        # Mapping only needs the buffered appends in the files, not on disk;
+        # durability is left to flush() and close().
+        self._data.flush()
+        self._index.flush()
+        self._unmap()
+        self._data_map = mmap.mmap(self._data.fileno(), 0, access=mmap.ACCESS_READ)
+        self._index_map = mmap.mmap(self._index.fileno(), 0, access=mmap.ACCESS_READ)
+        self._mapped_count = self._count
+
+    def _unmap(self):
+        if self._data_map is not None:
+            self._data_map.close()
+            self._index_map.close()
+            self._data_map = self._index_map = None
+            self._mapped_count = 0
+
+    def __len__(self):
+        return self._count
+
+    def append(self, data):
+        ''' Appends data and returns its record number. '''
+        offset = self._data_size
+        self._data.write(_header.pack(len(data), zlib.crc32(data)))
+        self._data.write(data)
+        self._index.write(_offset.pack(offset))
+        self._data_size += _header.size + len(data)
+        self._count += 1
+        return self._count - 1
+
+    def get(self, number):
+        if number < 0:
+            number += self._count
+        if not 0 <= number < self._count:
+            raise IndexError("record number out of range")
+        if number >= self._mapped_count:
+            self._remap()
+        offset, = _offset.unpack_from(self._index_map, number * _offset.size)
+        length, _ = _header.unpack_from(self._data_map, offset)
+        start = offset + _header.size
+        return self._data_map[start:start + length]
+
+    def flush(self):
+        ''' Writes any buffered appends to disk. The log is flushed before the
+        index so that the index never gets ahead of the log.
+        '''
+        self._data.flush()
+        os.fsync(self._data.fileno())
+        self._index.flush()
+        os.fsync(self._index.fileno())
+
+    def close(self):
+        if self._data.closed:
+            return
+        self._unmap()
+        self.flush()
+        self._data.close()
+        self._index.close()
+
+
+def _remove_log(path):
+    for name in (path, path + '.idx'):
+        if os.path.exists(name):
+            os.remove(name)
+
+
+def _index_key(value):
+    ''' Returns the sortable, bencodable form of an indexed value. '''
+    if type(value) is str:
+        return value.encode()
+    if type(value) is bool:
+        return int(value)
+    return value
+
+
+class _Run:
+    ''' A sorted run of (key, number) entries stored in a _Log.
+
+    Record 0 of the log holds the number of records the run covers.
+    '''
+
+    def __init__(self, log):
+        self.log = log
+        self.covered = from_bencode(log.get(0))[0] if len(log) else 0
+
+    def __len__(self):
+        return max(len(self.log) - 1, 0)
+
+    def __getitem__(self, i):
+        return tuple(from_bencode(self.log.get(i + 1)))
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self[i]
+
+    @staticmethod
+    def write(path, entries, covered):
+        ''' Writes sorted entries to a new run at path + '.tmp' and returns
+        that path, to be moved into place with replace().
+        '''
+        tmp_path = path + '.tmp'
+        _remove_log(tmp_path)
+        log = _Log(tmp_path)
+        log.append(to_bencode([covered]))
+        for entry in entries:
+            log.append(to_bencode(list(entry)))
+        log.close()
+        return tmp_path
+
+    @staticmethod
+    def replace(tmp_path, path):
+        ''' Moves a run written by write() into place.
+
+        The old index file is removed first and the new one moved in last, so
+        a crash part way through leaves a log without an index, which _Log
+        rebuilds by scanning.
+        '''
+        if os.path.exists(path + '.idx'):
+            os.remove(path + '.idx')
+        os.replace(tmp_path, path)
+        os.replace(tmp_path + '.idx', path + '.idx')
+
+
+class FieldIndex:
+    ''' A persisted index from the values of one field to record numbers. '''
+
+    compact_threshold = 100000
+
+    def __init__(self, path):
+        self.path = path
+        self._run = _Run(_Log(path + '.sorted'))
+        self._journal = _Log(path + '.journal')
+        self._pending = []
+        self.covered = self._run.covered
+        for i in range(len(self._journal)):
+            entry = from_bencode(self._journal.get(i))
+            number = entry[0]
+            # Entries already merged into the run can be left behind by a
+            # crash during compaction.
+            if number < self._run.covered:
+                continue
+            if len(entry) == 2:
+                self._pending.append((entry[1], number))
+            self.covered = max(self.covered, number + 1)
+        self._pending.sort()
+
+    def append(self, number, value):
+        ''' Records that record number has the given value. '''
+        if value is None:
+            self._journal.append(to_bencode([number]))
+        else:
+            key = _index_key(value)
+            self._journal.append(to_bencode([number, key]))
+            bisect.insort(self._pending, (key, number))
+        self.covered = number + 1
+        if len(self._pending) > self.compact_threshold:
+            self.compact()
+
+    def lookup(self, value):
+        ''' Returns the numbers of the records whose value equals value. '''
+        key = _index_key(value)
+        return self._range((key,), (key, float('inf')))
+
+    def range(self, start=None, stop=None):
+        ''' Returns the numbers of the records with start <= value < stop,
+        ordered by value. Either bound may be None.
+        '''
+        return self._range(None if start is None else (_index_key(start),),
+                           None if stop is None else (_index_key(stop),))
+
+    def _range(self, low, high):
+        def between(entries):
+            lo = 0 if low is None else bisect.bisect_left(entries, low)
+            hi = len(entries) if high is None else bisect.bisect_left(entries, high)
+            for i in range(lo, hi):
+                yield entries[i]
+        for key, number in heapq.merge(between(self._run), between(self._pending)):
+            yield number
+
+    def compact(self):
+        ''' Merges the journal into the sorted run. Both are already sorted,
+        so this streams rather than loading the run into memory.
+        '''
+        tmp_path = _Run.write(self.path + '.sorted', heapq.merge(self._run, self._pending), self.covered)
+        self._replace_run(tmp_path, self.covered)
+
+    def truncate(self, count):
+        ''' Forgets the entries for records numbered count or above, which the
+        log has lost.
+        '''
+        entries = (entry for entry in heapq.merge(self._run, self._pending) if entry[1] < count)
+        self._replace_run(_Run.write(self.path + '.sorted', entries, count), count)
+
+    def build(self, entries, covered, chunk_size):
+        ''' Replaces the index with (key, number) entries, which don't need to
+        be sorted. At most chunk_size entries are held in memory at once.
+        '''
+        runs = []
+        chunk = []
+
+        def flush_chunk():
+            run_path = '%s.chunk%d' % (self.path, len(runs))
+            chunk.sort()
+            _Run.replace(_Run.write(run_path, chunk, 0), run_path)
+            runs.append(_Run(_Log(run_path)))
+            del chunk[:]
+
+        for entry in entries:
+            chunk.append(entry)
+            if len(chunk) >= chunk_size:
+                flush_chunk()
+        if chunk or not runs:
+            flush_chunk()
+
+        tmp_path = _Run.write(self.path + '.sorted', heapq.merge(*runs), covered)
+        for run in runs:
+            run.log.close()
+            _remove_log(run.log.path)
+        self._replace_run(tmp_path, covered)
+
+    def _replace_run(self, tmp_path, covered):
+        self._run.log.close()
+        _Run.replace(tmp_path, self.path + '.sorted')
+        self._run = _Run(_Log(self.path + '.sorted'))
+
+        # Journal entries below the run's coverage are skipped when loading,
+        # so a crash before the journal is removed is harmless.
+        self._journal.close()
+        _remove_log(self._journal.path)
+        self._journal = _Log(self.path + '.journal')
+        self._pending = []
+        self.covered = covered
+
+    def flush(self):
+        self._journal.flush()
+
+    def close(self):
+        self._run.log.close()
+        self._journal.close()
+
+
+class RecordStore:
+    ''' An append-only store of instances of an Encodium class. '''
+
+    chunk_size = 100000
+
+    def __init__(self, path, cls, zdict=None):
+        self.cls = cls
+        self.zdict = zdict
+        self._log = _Log(path)
+        self._indexes = {}
+        for name, definition in cls._encodium_fields.items():
+            if definition.indexed:
+                index = FieldIndex('%s.%s' % (path, name))
+                self._indexes[name] = index
+                # The log may have lost a torn tail which the index saw, and
+                # those numbers will be reused.
+                if index.covered > len(self._log):
+                    index.truncate(len(self._log))
+                # Catch up on records the index missed, for example because
+                # the field has only just been marked as indexed.
+                missing = len(self._log) - index.covered
+                if missing > self.chunk_size:
+                    self.rebuild_index(name)
+                elif missing > 0:
+                    for number in range(index.covered, len(self._log)):
+                        index.append(number, self[number].__dict__[name])
+
+    def __len__(self):
+        return len(self._log)
+
+    def __getitem__(self, number):
+        return self.cls.from_bencode(self.get_raw(number))
+
+    def __iter__(self):
+        return self.iter_range(0, None)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    def append(self, obj):
+        ''' Appends obj and returns its record number. '''
+        if not isinstance(obj, self.cls):
+            raise TypeError("Cannot store %s in a store of %s" % (obj.__class__.__name__, self.cls.__name__))
+        data = obj.serialize()
+        if self.zdict is not None:
+            data = compress(data, self.zdict)
+        number = self._log.append(data)
+        for name, index in self._indexes.items():
+            index.append(number, obj.__dict__[name])
+        return number
+
+    def get_raw(self, number):
+        ''' Returns the serialized record without decoding it. '''
+        if self.zdict is not None:
+            return decompress(self._log.get(number), self.zdict)
+        return self._log.get(number)
+
+    def iter_range(self, start=0, stop=None):
+        ''' Lazily decodes the records numbered from start up to stop. '''
+        count = len(self._log)
+        stop = count if stop is None else min(stop, count)
+        for number in range(start, stop):
+            yield self[number]
+
+    def index(self, name):
+        ''' Returns the FieldIndex for an indexed field. '''
+        try:
+            return self._indexes[name]
+        except KeyError:
+            raise KeyError(name + " is not an indexed field of " + self.cls.__name__)
+
+    def find(self, name, value):
+        ''' Lazily decodes the records whose field equals value. '''
+        for number in self.index(name).lookup(value):
+            yield self[number]
+
+    def find_range(self, name, start=None, stop=None):
+        ''' Lazily decodes the records with start <= field < stop, ordered by
+        the field's value.
+        '''
+        for number in self.index(name).range(start, stop):
+            yield self[number]
+
+    def rebuild_index(self, name, chunk_size=None):
+        ''' Rebuilds an index by scanning the log, holding at most chunk_size
+        entries in memory.
+        '''
+        def entries():
+            for number, obj in enumerate(self):
+                value = obj.__dict__[name]
+                if value is not None:
+                    yield (_index_key(value), number)
+
+        self.index(name).build(entries(), len(self._log), chunk_size or self.chunk_size)
+
+    def flush(self):
+        self._log.flush()
+        for index in self._indexes.values():
+            index.flush()
+
+    def close(self):
+        self._log.close()
+        for index in self._indexes.values():
+            index.close()
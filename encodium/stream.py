@@ -0,0 +1,465 @@
+'''
+
+Streaming
+=========
+
+Decodes one ``List`` field of a large message an item at a time, straight
+from a file or socket, without holding the whole message in memory::
+
+    with open('city.bencode', 'rb') as f:
+        for party in City.iter_field(f, 'parties'):
+            print(len(party.people))
+
+Each item is validated against the list's inner definition as it is
+yielded. The other fields of the message are skipped without being decoded
+or validated, and memory use is bounded by the size of the largest item.
+
+Both bencode and JSON (``codec='json'``) are supported.
+
+Scanning
+--------
+
+A file or buffer of concatenated bencoded records can be filtered without
+decoding every record::
+
+    with open('people.bencode', 'rb') as f:
+        for person in Person.scan(f, where={'age': ('>=', 18), 'name': ('==', 'John')}):
+            ...
+
+Each condition compares one field with ``==``, ``!=``, ``<``, ``<=``, ``>``,
+``>=`` or ``in`` (a collection of values). The conditions are tested on the
+encoded bytes: the record's keys are located and its integers, strings and
+fixed-width numbers are compared in place, and only records which match
+every condition are decoded and validated. Only fields holding a single
+integer, string, bytes or fixed-width number can be compared, and a record
+in which a field is missing (i.e. None) doesn't match conditions on it.
+
+'''
+
+import re
+import json
+import operator
+from collections import OrderedDict
+
+from encodium import ValidationError, Encodium, List, Map
+
+_json_delimiter = re.compile(rb'[,\]}\s]')
+_json_string_special = re.compile(rb'["\\]')
+_json_whitespace = b' \t\r\n'
+
+
+class _Reader:
+    ''' Buffers reads from a file-like object or a socket. '''
+
+    def __init__(self, stream, chunk_size=65536):
+        self._read = stream.read if hasattr(stream, 'read') else stream.recv
+        self.chunk_size = chunk_size
+        self.buffer = bytearray()
+        self.pos = 0
+        # Data from mark onwards is kept in the buffer even once it is read.
+        self.mark = None
+
+    def more(self, size=None):
+        ''' Reads more data into the buffer, returning False at the end of
+        the stream.
+        '''
+        discard = self.pos if self.mark is None else min(self.pos, self.mark)
+        if discard:
+            del self.buffer[:discard]
+            self.pos -= discard
+            if self.mark is not None:
+                self.mark -= discard
+        data = self._read(max(size or 0, self.chunk_size))
+        if not data:
+            return False
+        self.buffer += data
+        return True
+
+    def fill(self, size):
+        while len(self.buffer) - self.pos < size:
+            if not self.more(size - (len(self.buffer) - self.pos)):
+                raise ValidationError("Unexpected end of stream")
+
+    def peek(self):
+        self.fill(1)
+        return self.buffer[self.pos]
+
+    def take(self, size):
+        self.fill(size)
+        data = bytes(self.buffer[self.pos:self.pos + size])
+        self.pos += size
+        return data
+
+    def take_until(self, delimiter):
+        ''' Returns the data up to delimiter, and consumes the delimiter. '''
+        start = 0
+        while True:
+            end = self.buffer.find(delimiter, self.pos + start)
+            if end != -1:
+                data = bytes(self.buffer[self.pos:end])
+                self.pos = end + 1
+                return data
+            start = len(self.buffer) - self.pos
+            if not self.more():
+                raise ValidationError("Unexpected end of stream")
+
+    def skip(self, size):
+        while size > len(self.buffer) - self.pos:
+            size -= len(self.buffer) - self.pos
+            self.pos = len(self.buffer)
+            if not self.more(min(size, self.chunk_size)):
+                raise ValidationError("Unexpected end of stream")
+        self.pos += size
+
+    def skip_whitespace(self):
+        while True:
+            while self.pos < len(self.buffer):
+                if self.buffer[self.pos] not in _json_whitespace:
+                    return
+                self.pos += 1
+            if not self.more():
+                return
+
+
+def _int(digits):
+    ''' Parses the digits of a bencoded integer or length. '''
+    try:
+        return int(digits)
+    except ValueError:
+        raise ValidationError("Invalid bencode")
+
+
+def _bencode_value(reader, keep):
+    ''' Reads one bencoded value, returning it if keep is true and skipping
+    it otherwise.
+    '''
+    c = reader.peek()
+    if c == 0x69:  # i
+        reader.pos += 1
+        digits = reader.take_until(b'e')
+        return _int(digits) if keep else None
+    elif 0x30 <= c <= 0x39:
+        length = _int(reader.take_until(b':'))
+        if keep:
+            return reader.take(length)
+        reader.skip(length)
+    elif c == 0x6c or c == 0x64:  # l or d
+        reader.pos += 1
+        items = []
+        while reader.peek() != 0x65:  # e
+            item = _bencode_value(reader, keep)
+            if keep:
+                items.append(item)
+        reader.pos += 1
+        if keep and c == 0x64:
+            return OrderedDict(zip(items[::2], items[1::2]))
+        return items if keep else None
+    else:
+        raise ValidationError("Invalid bencode")
+
+
+def _json_value(reader, keep):
+    ''' Reads one JSON value, returning its raw bytes if keep is true and
+    skipping it otherwise.
+    '''
+    reader.skip_whitespace()
+    parts = []
+    if reader.peek() not in b'[{"':
+        # A number, true, false or null ends at the next delimiter.
+        while True:
+            match = _json_delimiter.search(reader.buffer, reader.pos)
+            end = match.start() if match else len(reader.buffer)
+            if keep:
+                parts.append(bytes(reader.buffer[reader.pos:end]))
+            reader.pos = end
+            if match or not reader.more():
+                return b''.join(parts)
+
+    depth = 0
+    in_string = False
+    while True:
+        buffer = reader.buffer
+        i = reader.pos
+        done = False
+        while i < len(buffer):
+            if in_string:
+                match = _json_string_special.search(buffer, i)
+                if match is None:
+                    i = len(buffer)
+                elif buffer[match.start()] == 0x5c:  # backslash
+                    if match.start() + 1 >= len(buffer):
+                        # Wait for the escaped character.
+                        i = match.start()
+                        break
+                    i = match.start() + 2
+                else:
+                    i = match.start() + 1
+                    in_string = False
+                    if depth == 0:
+                        done = True
+                        break
+            else:
+                c = buffer[i]
+                i += 1
+                if c == 0x22:  # "
+                    in_string = True
+                elif c == 0x5b or c == 0x7b:  # [ or {
+                    depth += 1
+                elif c == 0x5d or c == 0x7d:  # ] or }
+                    depth -= 1
+                    if depth == 0:
+                        done = True
+                        break
+        if keep:
+            parts.append(bytes(buffer[reader.pos:i]))
+        reader.pos = i
+        if done:
+            return b''.join(parts)
+        if not reader.more():
+            raise ValidationError("Unexpected end of stream")
+
+
+def _json_loads(data):
+    try:
+        return json.loads(data)
+    except ValueError:
+        raise ValidationError("Invalid JSON: %s" % data.decode(errors='replace'))
+
+
+def _json_expect(reader, expected):
+    reader.skip_whitespace()
+    c = reader.peek()
+    if c not in expected:
+        raise ValidationError("Invalid JSON: expected one of " + expected.decode())
+    reader.pos += 1
+    return c
+
+
+def _iter_bencode(reader, name, packed):
+    if reader.peek() != 0x64:  # d
+        raise ValidationError("Cannot create Encodium object from non-dict bencode")
+    reader.pos += 1
+    key = name.encode()
+    while reader.peek() != 0x65:  # e
+        if _bencode_value(reader, True) == key:
+            if packed is not None and 0x30 <= reader.peek() <= 0x39:
+                # A packed list of fixed-width numbers.
+                length = _int(reader.take_until(b':'))
+                if length % packed.size:
+                    raise ValidationError(name + " has a packed length which isn't a multiple of %d" % packed.size)
+                for _ in range(length // packed.size):
+                    yield packed.unpack(reader.take(packed.size))[0]
+                return
+            if reader.peek() != 0x6c:  # l
+                raise ValidationError(name + " is not a list")
+            reader.pos += 1
+            while reader.peek() != 0x65:
+                yield _bencode_value(reader, True)
+            return
+        _bencode_value(reader, False)
+
+
+def _iter_json(reader, name):
+    _json_expect(reader, b'{')
+    if _json_peek_end(reader, 0x7d):
+        return
+    while True:
+        key = _json_loads(_json_value(reader, True))
+        _json_expect(reader, b':')
+        if key == name:
+            reader.skip_whitespace()
+            if reader.peek() == 0x6e:  # n, for null
+                return
+            _json_expect(reader, b'[')
+            if _json_peek_end(reader, 0x5d):
+                return
+            while True:
+                yield _json_loads(_json_value(reader, True))
+                if _json_expect(reader, b',]') == 0x5d:
+                    return
+        _json_value(reader, False)
+        if _json_expect(reader, b',}') == 0x7d:
+            return
+
+
+def _json_peek_end(reader, end):
+    ''' Consumes and returns True if the next character is end. '''
+    reader.skip_whitespace()
+    if reader.peek() == end:
+        reader.pos += 1
+        return True
+    return False
+
+
+def iter_field(cls, stream, name, codec='bencode', chunk_size=65536):
+    ''' Yields the validated items of the List field name of a cls message
+    read from stream, which may be a file-like object or a socket.
+    '''
+    definition = cls._encodium_fields.get(name)
+    if not isinstance(definition, List.Definition):
+        raise ValueError(name + " is not a List field of " + cls.__name__)
+
+    reader = _Reader(stream, chunk_size)
+    if codec == 'bencode':
+        items = _iter_bencode(reader, name, definition._encodium_struct)
+    elif codec == 'json':
+        items = _iter_json(reader, name)
+    else:
+        raise ValueError("Unknown codec " + repr(codec))
+    return _validated(items, name, definition.inner_definition)
+
+
+def _validated(items, name, inner_definition):
+    for item in items:
+        try:
+            value = inner_definition.from_obj(item) if item is not None else None
+            inner_definition.check_type(value)
+            if value is not None:
+                inner_definition._encodium_check_value(value)
+        except ValidationError as e:
+            e.args = (name + " inner item " + e.args[0],) + e.args[1:]
+            raise
+        yield value
+
+
+def _find(buf, byte, offset):
+    while buf[offset] != byte:
+        offset += 1
+    return offset
+
+
+def _skip(buf, offset):
+    ''' Returns the offset of the end of the bencoded value at offset in
+    buf, which may be any buffer.
+    '''
+    c = buf[offset]
+    if c == 0x69:  # i
+        return _find(buf, 0x65, offset) + 1
+    elif 0x30 <= c <= 0x39:
+        colon = _find(buf, 0x3a, offset)
+        return colon + 1 + _int(bytes(buf[offset:colon]))
+    elif c == 0x6c or c == 0x64:  # l or d
+        offset += 1
+        while buf[offset] != 0x65:  # e
+            offset = _skip(buf, offset)
+        return offset + 1
+    raise ValidationError("Invalid bencode")
+
+
+_operators = {
+    '==': operator.eq,
+    '!=': operator.ne,
+    '<': operator.lt,
+    '<=': operator.le,
+    '>': operator.gt,
+    '>=': operator.ge,
+    'in': lambda value, operand: value in operand,
+}
+
+
+def _encoded_operand(value):
+    ''' Converts a value to compare to the form it has when encoded. '''
+    if type(value) is str:
+        return value.encode()
+    return value
+
+
+def _compile(cls, where):
+    ''' Returns the conditions of where keyed by encoded field name. '''
+    predicates = {}
+    for name, (op, operand) in where.items():
+        definition = cls._encodium_fields.get(name)
+        if definition is None:
+            raise ValueError(name + " is not a field of " + cls.__name__)
+        nested = definition._encodium_type
+        if isinstance(definition, (List.Definition, Map.Definition)) or (isinstance(nested, type) and issubclass(nested, Encodium)):
+            raise ValueError("Cannot scan on " + name + ", which isn't a single value")
+        if op not in _operators:
+            raise ValueError("Unknown operator " + repr(op))
+        if op == 'in':
+            operand = tuple([_encoded_operand(value) for value in operand])
+        else:
+            operand = _encoded_operand(operand)
+        predicates[name.encode()] = (_operators[op], operand, getattr(definition, '_encodium_struct', None))
+    return predicates
+
+
+def _scalar(buf, offset, packed):
+    ''' Returns the integer or string at offset, and the offset after it. '''
+    c = buf[offset]
+    if c == 0x69:  # i
+        end = _find(buf, 0x65, offset)
+        return _int(bytes(buf[offset + 1:end])), end + 1
+    elif 0x30 <= c <= 0x39:
+        colon = _find(buf, 0x3a, offset)
+        end = colon + 1 + _int(bytes(buf[offset:colon]))
+        data = bytes(buf[colon + 1:end])
+        if packed is not None:
+            if len(data) != packed.size:
+                raise ValidationError("must be packed into %d bytes" % packed.size)
+            return packed.unpack(data)[0], end
+        return data, end
+    return None, _skip(buf, offset)
+
+
+def _matches(buf, predicates):
+    ''' Tests the conditions on the bencoded record in buf. '''
+    if buf[0] != 0x64:  # d
+        raise ValidationError("Cannot create Encodium object from non-dict bencode")
+    offset = 1
+    matched = 0
+    while buf[offset] != 0x65:  # e
+        colon = _find(buf, 0x3a, offset)
+        end = colon + 1 + _int(bytes(buf[offset:colon]))
+        predicate = predicates.get(bytes(buf[colon + 1:end]))
+        if predicate is None:
+            offset = _skip(buf, end)
+            continue
+        function, operand, packed = predicate
+        value, offset = _scalar(buf, end, packed)
+        try:
+            if value is None or not function(value, operand):
+                return False
+        except TypeError:
+            # The value has the wrong type, so it can't match.
+            return False
+        matched += 1
+    return matched == len(predicates)
+
+
+def _buffer_records(buf):
+    offset = 0
+    while offset < len(buf):
+        end = _skip(buf, offset)
+        yield buf[offset:end]
+        offset = end
+
+
+def _stream_records(reader):
+    while reader.pos < len(reader.buffer) or reader.more():
+        reader.mark = reader.pos
+        _bencode_value(reader, False)
+        yield reader.buffer[reader.mark:reader.pos]
+        reader.mark = None
+
+
+def scan(cls, source, where, chunk_size=65536):
+    ''' Yields the cls records in source, a buffer, file-like object or
+    socket of concatenated bencoded records, which match every condition in
+    where.
+    '''
+    predicates = _compile(cls, where)
+    if hasattr(source, 'read') or hasattr(source, 'recv'):
+        records = _stream_records(_Reader(source, chunk_size))
+    else:
+        records = _buffer_records(memoryview(source))
+    return _matching(cls, records, predicates)
+
+
+def _matching(cls, records, predicates):
+    try:
+        for record in records:
+            if _matches(record, predicates):
+                yield cls.from_bencode(bytes(record))
+    except IndexError:
+        raise ValidationError("Unexpected end of record")
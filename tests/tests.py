@@ -1,8 +1,26 @@
+import io
+import os
+import multiprocessing
+import pickle
+import socket
+import struct
+import asyncio
+import threading
 import unittest
 import json
+import tempfile
 from collections import OrderedDict
+from multiprocessing import shared_memory
+from concurrent.futures import ThreadPoolExecutor
 
-from encodium import Encodium, Integer, String, Boolean, List, Bytes, ValidationError
+import encodium
+from encodium import Encodium, Integer, String, Boolean, List, Map, Bytes, Enum, ValidationError
+from encodium import UInt8, UInt16, UInt64, Int8, Int32, Float32, Float64
+from encodium.store import RecordStore
+from encodium.server import Server
+from encodium.shm import Handle, share, attach
+from encodium.compress import build_dictionary, compress, decompress, CompressedStream
+from encodium.rpc import Method, LoopbackServer, ConnectionPool, AsyncConnection, RemoteError
 
 
 class Person(Encodium):
@@ -68,6 +86,72 @@ class TestValueChecker(unittest.TestCase):
         john = Person(age=25, name="John")
 
 
+class Crowd(Encodium):
+    class Definition(Encodium.Definition):
+        checks = 0
+
+        def check_value(self, value):
+            type(self).checks += 1
+            if len(value.people) > 3:
+                raise ValidationError("is too big")
+
+    people = List.Definition(Person.Definition())
+
+
+class Event(Encodium):
+    crowds = List.Definition(Crowd.Definition())
+
+
+class TestValidatedMarker(unittest.TestCase):
+    def setUp(self):
+        Crowd.Definition.checks = 0
+        self.crowd = Crowd(people=[Person(age=25, name='John')])
+
+    def test_accepted_values_are_not_checked_again(self):
+        Event(crowds=[self.crowd] * 10)
+        self.assertEqual(Crowd.Definition.checks, 1)
+
+    def test_changed_values_are_checked_again(self):
+        Event(crowds=[self.crowd])
+        self.crowd.change(people=[Person(age=25, name='John')] * 4)
+        self.assertRaises(ValidationError, Event, crowds=[self.crowd])
+        self.crowd.change(people=[])
+        Event(crowds=[self.crowd])
+        self.crowd.people = [Person(age=25, name='John')] * 4
+        self.assertRaises(ValidationError, Event, crowds=[self.crowd])
+
+    def test_in_place_changes_need_change(self):
+        Event(crowds=[self.crowd])
+        self.crowd.people.extend([Person(age=25, name='John')] * 3)
+        self.crowd.change(people=self.crowd.people)
+        self.assertRaises(ValidationError, Event, crowds=[self.crowd])
+
+    def test_definition_without_super_init(self):
+        class Odd(Encodium):
+            class Definition(Encodium.Definition):
+                def __init__(self, limit):
+                    self.limit = limit
+
+                def check_value(self, value):
+                    if value.count > self.limit:
+                        raise ValidationError("is too big")
+
+            count = Integer.Definition()
+
+        class Holder(Encodium):
+            odd = Odd.Definition(2)
+            odds = List.Definition(Odd.Definition(2))
+
+        Holder(odd=Odd(count=1), odds=[Odd(count=2)])
+        self.assertRaises(ValidationError, Holder, odd=Odd(count=3), odds=[])
+        self.assertRaises(ValidationError, Holder, odd=Odd(count=1), odds=[Odd(count=3)])
+
+    def test_raw_values_are_checked(self):
+        self.assertRaises(ValidationError, Event.from_obj, {'crowds': [{'people': [{'age': -1, 'name': 'John'}]}]})
+        self.assertRaises(ValidationError, City, parties=[Party(people=[])] * 5 + [1])
+        self.assertRaises(ValidationError, Party, people=[Person(age=25, name='John'), {'age': 25, 'name': 'John'}])
+
+
 class TestEquality(unittest.TestCase):
     def test_equality(self):
         john = Person(age=25, name="John")
@@ -105,6 +189,35 @@ class TestJsonSendAndRecv(unittest.TestCase):
         self.assertEqual(json.loads(mocket.received), {'age': 25, 'name': 'John', 'diabetic': True, 'optional': None})
 
 
+class TestSendMany(unittest.TestCase):
+    def setUp(self):
+        self.a, self.b = socket.socketpair()
+
+    def tearDown(self):
+        self.a.close()
+        self.b.close()
+
+    def test_send_many_and_recv_many(self):
+        people = [Person(age=i, name='Person %d' % i) for i in range(3000)]
+        Person.send_many(self.a, people[:2000])
+        received = []
+        while len(received) < 2000:
+            received.extend(Person.recv_many(self.b))
+        self.assertEqual(received, people[:2000])
+
+        Person.send_many(self.a, people[:3])
+        self.assertEqual(Person.recv_many(self.b, max_items=2), people[:2])
+        self.assertEqual(Person.recv_many(self.b), people[2:3])
+
+    def test_partial_object_left_in_socket(self):
+        john = Person(age=25, name='John')
+        data = (john.to_json() + '\n').encode()
+        self.a.sendall(data + data[:5])
+        self.assertEqual(Person.recv_many(self.b), [john])
+        self.a.sendall(data[5:])
+        self.assertEqual(Person.recv_from(self.b), john)
+
+
 class TestInvalidJson(unittest.TestCase):
     def test_invalid_json(self):
         self.assertRaises(ValidationError, Person.from_json, 'invalid json')
@@ -138,6 +251,39 @@ class TestBytes(unittest.TestCase):
         self.assertRaises(ValidationError, TestBytes.Nonce.from_json, '{"data":"invalid base 64"}')
 
 
+class TestUnknownFields(unittest.TestCase):
+    def test_ignore(self):
+        class Ignorer(Encodium):
+            age = Integer.Definition()
+
+        ignorer = Ignorer.from_obj({b'age': 5, b'height': 180})
+        self.assertEqual(ignorer.age, 5)
+        Ignorer(age=5, height=180, weight=80)
+        self.assertEqual(Ignorer._encodium_unknown_count, 3)
+        self.assertEqual(Person._encodium_unknown_count, 0)
+
+    def test_collect(self):
+        class Collector(Encodium):
+            _encodium_unknown_fields = 'collect'
+            age = Integer.Definition()
+
+        collector = Collector.from_json('{"age": 5, "height": 180}')
+        self.assertEqual(collector._encodium_unknown, {'height': 180})
+        collector.change(weight=80)
+        self.assertEqual(collector._encodium_unknown, {'height': 180, 'weight': 80})
+
+    def test_error(self):
+        class Strict(Encodium):
+            _encodium_unknown_fields = 'error'
+            age = Integer.Definition()
+
+        self.assertRaises(ValidationError, Strict.from_obj, {'age': 5, 'height': 180})
+        self.assertRaises(ValidationError, Strict, age=5, height=180)
+        strict = Strict(age=5)
+        self.assertRaises(ValidationError, strict.change, age=6, height=180)
+        self.assertEqual(strict.age, 5)
+
+
 class TestCallableDefault(unittest.TestCase):
     def test_callable_default(self):
         counter = 0
@@ -198,6 +344,1259 @@ class TestBencode(unittest.TestCase):
         self.assertEqual(p.to_bencode(), b'd1:dd4:key1i999e4:key24:MOARe1:ii1234567890e1:ll5:BYTESe1:s6:STRINGe')
         self.assertEqual(P.from_bencode(b'd1:dd4:key1i999e4:key24:MOARe1:ii1234567890e1:ll5:BYTESe1:s6:STRINGe'), p)
 
+    def test_booleans(self):
+        john = Person(age=25, name='John', diabetic=False)
+        self.assertIn(b'8:diabetici0e', john.to_bencode())
+        self.assertIs(Person.from_bencode(john.to_bencode()).diabetic, False)
+        self.assertRaises(ValidationError, Person.from_bencode, john.to_bencode().replace(b'i0e', b'i2e'))
+        # Decoding can't tell the codecs apart, so JSON may use 1 and 0 too.
+        self.assertIs(Person.from_json('{"age": 25, "name": "John", "diabetic": 1}').diabetic, True)
+        for value in ('2', '-1', '1.0', '"true"'):
+            self.assertRaises(ValidationError, Person.from_json, '{"age": 25, "name": "John", "diabetic": %s}' % value)
+        self.assertRaises(ValidationError, Person, age=25, name='John', diabetic=1)
+
+
+class TestPatch(unittest.TestCase):
+    def test_diff_only_contains_changes(self):
+        john = Person(age=25, name='John')
+        older_john = Person(age=26, name='John')
+        self.assertEqual(older_john.diff(john), OrderedDict([('age', OrderedDict([('v', 26)]))]))
+        self.assertEqual(john.diff(john), OrderedDict())
+
+    def test_apply_patch(self):
+        john = Person(age=25, name='John', optional=3)
+        lucy = Person(age=30, name='Lucy', diabetic=False)
+        for codec in (None, 'bencode', 'json'):
+            patched = Person(age=25, name='John', optional=3)
+            patched.apply_patch(lucy.diff(john, codec=codec))
+            self.assertEqual(patched, lucy)
+
+    def test_nested_and_list_patches(self):
+        city = City(parties=[Party(people=[Person(age=25, name='John'), Person(age=30, name='Lucy')])])
+        moved = City(parties=[Party(people=[Person(age=25, name='John'), Person(age=31, name='Lucy')]),
+                              Party(people=[])])
+        patch = moved.diff(city)
+        self.assertEqual(patch['parties']['l'], 2)
+        self.assertEqual(patch['parties']['i'][0][1]['p']['people']['i'], [[1, {'p': {'age': {'v': 31}}}]])
+        for codec in ('bencode', 'json'):
+            patched = City(parties=list(city.parties))
+            patched.apply_patch(moved.diff(city, codec=codec))
+            self.assertEqual(patched.parties[0].people[1].age, 31)
+            self.assertEqual(len(patched.parties), 2)
+        # The original nested objects are untouched.
+        self.assertEqual(city.parties[0].people[1].age, 30)
+
+    def test_none_and_object_items(self):
+        class Holder(Encodium):
+            people = List.Definition(Person.Definition(optional=True))
+            named = Map.Definition(String.Definition(), Person.Definition(optional=True))
+
+        empty = Holder(people=[None], named={'a': None})
+        full = Holder(people=[Person(age=1, name='A')], named={'a': Person(age=2, name='B')})
+        for old, new in ((empty, full), (full, empty)):
+            patch = new.diff(old)
+            self.assertEqual(sorted(patch), ['named', 'people'])
+            patched = Holder(people=list(old.people), named=dict(old.named))
+            patched.apply_patch(patch)
+            # Encodium objects compare equal to None, so compare encodings.
+            self.assertEqual(patched.to_json(), new.to_json())
+
+    def test_invalid_patch(self):
+        john = Person(age=25, name='John')
+        self.assertRaises(ValidationError, john.apply_patch, {'age': {'v': -1}})
+        self.assertEqual(john.age, 25)
+        self.assertRaises(ValidationError, john.apply_patch, {'height': {'v': 180}})
+        self.assertRaises(ValidationError, john.apply_patch, 'invalid json')
+
+
+class TestEvolve(unittest.TestCase):
+    def test_evolve(self):
+        john = Person(age=25, name='John', diabetic=False)
+        older_john = john.evolve(age=26)
+        self.assertEqual(older_john.age, 26)
+        self.assertFalse(older_john.diabetic)
+        self.assertEqual(john.age, 25)
+
+    def test_evolve_shares_unchanged_values(self):
+        party = Party(people=[Person(age=25, name='John')])
+        city = City(parties=[party])
+        renamed = Dad(age=60, name='Paul', puns=['pun']).evolve(name='Pete')
+        self.assertIs(city.evolve().parties, city.parties)
+        self.assertEqual(renamed.puns, ['pun'])
+        self.assertIsInstance(renamed, Dad)
+
+    def test_evolve_validates_changes(self):
+        john = Person(age=25, name='John')
+        self.assertRaises(ValidationError, john.evolve, age=-1)
+        self.assertRaises(ValidationError, john.evolve, name=None)
+
+
+class Checked(Encodium):
+    checks = 0
+    value = Integer.Definition()
+
+    def check(self, changed_attributes):
+        Checked.checks += 1
+
+
+class TestPickle(unittest.TestCase):
+    def test_round_trip(self):
+        city = City(parties=[Party(people=[Person(age=25, name='John'), Dad(age=60, name='Paul', puns=['pun'])])])
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            unpickled = pickle.loads(pickle.dumps(city, protocol))
+            self.assertEqual(unpickled, city)
+            self.assertIsInstance(unpickled.parties[0].people[1], Dad)
+            self.assertEqual(unpickled.parties[0].people[1].puns, ['pun'])
+
+    def test_unpickling_skips_validation(self):
+        checked = Checked(value=1)
+        Checked.checks = 0
+        self.assertEqual(pickle.loads(pickle.dumps(checked)).value, 1)
+        self.assertEqual(Checked.checks, 0)
+
+    def test_compact(self):
+        people = [Person(age=i, name='John') for i in range(100)]
+        state = [dict(person.__dict__) for person in people]
+        self.assertLess(len(pickle.dumps(people)), len(pickle.dumps(state)))
+
+
+class TestEncodedSize(unittest.TestCase):
+    class Blob(Encodium):
+        data = Bytes.Definition(optional=True)
+        chunks = List.Definition(Bytes.Definition(optional=True), default=[])
+        label = String.Definition(optional=True)
+
+    def objects(self):
+        return [
+            Person(age=25, name='John'),
+            Person(age=-0, name='Jöhn "Quoted" \\ \n \u2603 \U0001f600', optional=-123456789012345678901234567890),
+            City(parties=[Party(people=[Person(age=25, name='John'), Dad(age=60, name='Paul', puns=['pun', ''])]),
+                          Party(people=[])]),
+            self.Blob(data=b'\x00\xff' * 7, chunks=[b'', b'a', b'abcd'], label=None),
+            self.Blob(),
+        ]
+
+    def test_encoded_size(self):
+        for obj in self.objects():
+            self.assertEqual(obj.encoded_size(), len(obj.to_bencode()))
+            self.assertEqual(obj.encoded_size('json'), len(obj.to_json().encode()))
+        self.assertRaises(ValueError, Person(age=1, name='John').encoded_size, 'xml')
+
+    def test_cached_size_is_forgotten_on_change(self):
+        john = Person(age=25, name='John')
+        john.encoded_size()
+        john.change(name='Johnathan')
+        self.assertEqual(john.encoded_size(), len(john.to_bencode()))
+        john.age = 1000
+        self.assertEqual(john.encoded_size(), len(john.to_bencode()))
+
+    def test_nested_changes_are_measured(self):
+        party = Party(people=[Person(age=25, name='John')])
+        city = City(parties=[party])
+        for codec in ('bencode', 'json'):
+            city.encoded_size(codec)
+        party.people[0].change(name='Johnathan')
+        party.people.append(Person(age=1, name='A'))
+        self.assertEqual(city.encoded_size(), len(city.to_bencode()))
+        self.assertEqual(city.encoded_size('json'), len(city.to_json().encode()))
+
+    def test_encode_into(self):
+        objects = self.objects()
+        for codec, encode in (('bencode', lambda obj: obj.to_bencode()), ('json', lambda obj: obj.to_json().encode())):
+            expected = b''.join([encode(obj) for obj in objects])
+            buffer = bytearray(len(expected) + 3)
+            offset = 3
+            for obj in objects:
+                offset = obj.encode_into(buffer, offset, codec)
+            self.assertEqual(offset, len(buffer))
+            self.assertEqual(bytes(buffer[3:]), expected)
+        blob = self.Blob(data=b'123', chunks=[b'4'])
+        view = memoryview(bytearray(blob.encoded_size()))
+        blob.encode_into(view)
+        self.assertEqual(bytes(view), blob.to_bencode())
+        self.assertRaises(ValueError, blob.encode_into, bytearray(5))
+
+
+class TestIterField(unittest.TestCase):
+    class Export(Encodium):
+        blob = Bytes.Definition()
+        parties = List.Definition(Party.Definition())
+        title = String.Definition()
+
+    def export(self):
+        parties = [Party(people=[Person(age=i, name='P "%d" \\ \u2603' % i)] * (i % 3)) for i in range(200)]
+        return self.Export(blob=b'x' * 100000, parties=parties, title='Export')
+
+    def test_iter_field(self):
+        export = self.export()
+        for codec, data in (('bencode', export.to_bencode()), ('json', export.to_json().encode())):
+            for chunk_size in (1, 7, 65536):
+                items = list(self.Export.iter_field(io.BytesIO(data), 'parties', codec, chunk_size))
+                self.assertEqual(items, export.parties)
+                self.assertTrue(all(isinstance(item, Party) for item in items))
+
+    def test_iter_field_from_socket(self):
+        a, b = socket.socketpair()
+        try:
+            a.sendall(self.export().to_bencode())
+            a.shutdown(socket.SHUT_WR)
+            self.assertEqual(len(list(self.Export.iter_field(b, 'parties'))), 200)
+        finally:
+            a.close()
+            b.close()
+
+    def test_invalid_items(self):
+        data = b'd7:partiesld6:peopleld3:agei-1e4:name4:Johneeeee'
+        items = self.Export.iter_field(io.BytesIO(data), 'parties')
+        self.assertRaises(ValidationError, list, items)
+        items = self.Export.iter_field(io.BytesIO(b'{"parties": [{"people": [], "x": 1}, 5]}'), 'parties', 'json')
+        self.assertEqual(next(items), Party(people=[]))
+        self.assertRaises(ValidationError, next, items)
+        self.assertRaises(ValueError, self.Export.iter_field, io.BytesIO(b''), 'title')
+        self.assertRaises(ValidationError, list, self.Export.iter_field(io.BytesIO(b'd7:partiesl'), 'parties'))
+        for data in (b'd7:partiesli1xeee', b'd1x:partiesle', b'd7:partiesl1x:ee'):
+            self.assertRaises(ValidationError, list, self.Export.iter_field(io.BytesIO(data), 'parties'))
+
+
+class TestFixedWidth(unittest.TestCase):
+    class Reading(Encodium):
+        sensor = UInt16.Definition()
+        offset = Int8.Definition()
+        total = UInt64.Definition()
+        level = Float64.Definition()
+        samples = List.Definition(Float32.Definition())
+        counts = List.Definition(Int32.Definition())
+        flags = List.Definition(UInt8.Definition(optional=True), optional=True)
+
+    def reading(self):
+        return self.Reading(sensor=65535, offset=-128, total=2 ** 64 - 1, level=0.1,
+                            samples=[1.5, -2.25], counts=[-1, 0, 2 ** 31 - 1], flags=[1, 255])
+
+    def test_round_trip(self):
+        reading = self.reading()
+        data = reading.to_bencode()
+        self.assertIn(b'6:sensor2:\xff\xff', data)
+        self.assertIn(b'6:counts12:\xff\xff\xff\xff\x00\x00\x00\x00\x7f\xff\xff\xff', data)
+        self.assertEqual(self.Reading.from_bencode(data), reading)
+        self.assertEqual(self.Reading.from_json(reading.to_json()), reading)
+        self.assertEqual(json.loads(reading.to_json())['counts'], [-1, 0, 2 ** 31 - 1])
+        self.assertEqual(self.Reading.from_json(reading.to_json().replace('0.1', '3')).level, 3.0)
+        self.assertEqual(reading.encoded_size(), len(data))
+        buffer = bytearray(len(data))
+        reading.encode_into(buffer)
+        self.assertEqual(bytes(buffer), data)
+        items = self.Reading.iter_field(io.BytesIO(data), 'counts', chunk_size=3)
+        self.assertEqual(list(items), reading.counts)
+
+    def test_ranges(self):
+        self.assertRaises(ValidationError, self.reading().evolve, sensor=65536)
+        self.assertRaises(ValidationError, self.reading().evolve, offset=128)
+        self.assertRaises(ValidationError, self.reading().evolve, total=-1)
+        self.assertRaises(ValidationError, self.reading().evolve, counts=[2 ** 31])
+        self.assertRaises(ValidationError, self.reading().evolve, samples=[1e39])
+        self.assertRaises(ValidationError, self.reading().evolve, level=1)
+        self.assertEqual(self.reading().evolve(samples=[float('inf')]).samples, [float('inf')])
+        self.assertRaises(ValidationError, self.reading().evolve, sensor=True)
+        self.assertRaises(ValidationError, self.reading().evolve, counts=[1, False])
+        self.assertRaises(ValidationError, self.reading().evolve, counts=[0, -2 ** 31 - 1, 5])
+        self.assertRaises(ValidationError, self.reading().evolve, counts=[1, None])
+        self.assertRaises(ValidationError, self.reading().evolve, counts=[1, 2.0])
+        self.assertEqual(self.reading().evolve(counts=[]).counts, [])
+        self.assertRaises(ValidationError, self.reading().evolve, samples=[1.0, 1])
+        text = self.reading().to_json()
+        self.assertRaises(ValidationError, self.Reading.from_json, text.replace('"sensor":65535', '"sensor":true'))
+        self.assertRaises(ValidationError, self.Reading.from_json, text.replace('"level":0.1', '"level":1' + '0' * 400))
+
+    def test_invalid_packing(self):
+        data = self.reading().to_bencode()
+        self.assertRaises(ValidationError, self.Reading.from_bencode, data.replace(b'6:sensor2:\xff', b'6:sensor1:'))
+        self.assertRaises(ValidationError, self.Reading.from_bencode, data.replace(b'6:counts12:\xff', b'6:counts11:'))
+
+
+class TestMap(unittest.TestCase):
+    class Census(Encodium):
+        ages = Map.Definition(String.Definition(), Integer.Definition(non_negative=True))
+        people = Map.Definition(Integer.Definition(), Person.Definition(), optional=True)
+        blobs = Map.Definition(Bytes.Definition(), String.Definition(optional=True), optional=True)
+
+    def census(self):
+        return self.Census(ages={'zed': 3, 'amy': 40, '\u2603': 1},
+                           people={10: Person(name='Ten', age=10), 9: Person(name='Nine', age=9)},
+                           blobs={b'\xff': 'x', b'\x00': None})
+
+    def test_canonical_encoding(self):
+        census = self.census()
+        data = census.to_json()
+        self.assertIn('"ages":{"amy":40,"zed":3,"\\u2603":1}', data)
+        self.assertIn('"people":{"10":', data)
+        self.assertEqual(self.Census.from_json(data), census)
+        self.assertEqual(json.loads(data), json.loads(json.dumps(census.to_json_primitive())))
+        census.blobs = None
+        data = census.to_bencode()
+        self.assertIn(b'4:agesd3:amyi40e3:zedi3e3:\xe2\x98\x83i1ee', data)
+        self.assertEqual(self.Census.from_bencode(data), census)
+        for codec, encoded in (('bencode', data), ('json', census.to_json().encode())):
+            self.assertEqual(census.encoded_size(codec), len(encoded))
+            buffer = bytearray(len(encoded))
+            census.encode_into(buffer, codec=codec)
+            self.assertEqual(bytes(buffer), encoded)
+
+    def test_validation(self):
+        self.assertRaises(ValidationError, self.Census, ages={'a': -1})
+        self.assertRaises(ValidationError, self.Census, ages={1: 1})
+        self.assertRaises(ValidationError, self.Census, ages={'a': None})
+        self.assertRaises(ValidationError, self.Census, ages=[])
+        self.assertRaises(ValidationError, self.Census.from_json, '{"ages": {}, "people": {"x": null}}')
+        self.assertRaises(TypeError, Map.Definition, List.Definition(Integer.Definition()), Integer.Definition())
+
+    def test_int_keys_are_canonical(self):
+        person = '{"age": 1, "name": "x", "diabetic": true}'
+        for key in ('01', ' 1', '1_0', '+1', '-0', '1 '):
+            data = '{"ages": {}, "people": {"%s": %s}}' % (key, person)
+            self.assertRaises(ValidationError, self.Census.from_json, data)
+        census = self.Census.from_json('{"ages": {}, "people": {"-1": %s, "10": %s}}' % (person, person))
+        self.assertEqual(sorted(census.people), [-1, 10])
+        self.assertRaises(ValidationError, self.Census.from_bencode, b'd4:agesde6:peopled2:01d3:agei1e8:diabetici1e4:name1:xeee')
+        self.assertRaises(ValidationError, self.Census, ages={}, people={True: Person(name='x', age=1)})
+        self.assertRaises(ValidationError, self.Census, ages={True: 1})
+
+    def test_patch(self):
+        old = self.census()
+        new = old.evolve(ages={'amy': 41, 'bob': 2, '\u2603': 1},
+                         people={9: old.people[9].evolve(age=90)},
+                         blobs={b'\xff': 'x', b'\x00': 'y', b'\x01': None})
+        for codec in (None, 'bencode', 'json'):
+            patched = self.census()
+            patched.apply_patch(new.diff(old, codec=codec))
+            self.assertEqual(patched, new)
+
+
+class TestCompression(unittest.TestCase):
+    def people(self, n):
+        return [Person(age=i, name='Person %d' % i, diabetic=i % 2 == 0) for i in range(n)]
+
+    def test_build_dictionary(self):
+        zdict = build_dictionary(City, samples=self.people(2))
+        for key in (b'7:parties', b'6:people', b'4:name', b'8:diabetic'):
+            self.assertIn(key, zdict)
+        self.assertTrue(zdict.endswith(self.people(2)[1].to_bencode()))
+        self.assertIn(b'"diabetic":', build_dictionary(City, codec='json'))
+        self.assertEqual(len(build_dictionary(City, self.people(100), size=100)), 100)
+
+    def test_dictionary_helps_small_messages(self):
+        zdict = build_dictionary(Person, samples=self.people(3))
+        data = Person(age=77, name='Someone', diabetic=False).to_bencode()
+        self.assertLess(len(compress(data, zdict)), len(compress(data)))
+        self.assertEqual(decompress(compress(data, zdict), zdict), data)
+
+    def test_stream(self):
+        people = self.people(50)
+        zdict = build_dictionary(Person, samples=people[:2], codec='json')
+        a, b = socket.socketpair()
+        try:
+            sender = CompressedStream(a, Person, zdict=zdict, codec='json')
+            receiver = CompressedStream(b, Person, zdict=zdict, codec='json')
+            for person in people:
+                sender.send(person)
+                self.assertEqual(receiver.recv(), person)
+            self.assertRaises(TypeError, sender.send, City(parties=[]))
+        finally:
+            a.close()
+            b.close()
+
+        f = io.BytesIO()
+        stream = CompressedStream(f, Person)
+        for person in people:
+            stream.send(person)
+        # Later messages refer back to earlier ones.
+        self.assertLess(len(f.getvalue()), sum(len(compress(person.to_bencode())) for person in people))
+        f.seek(0)
+        self.assertEqual(list(CompressedStream(f, Person)), people)
+
+    def test_record_store(self):
+        zdict = build_dictionary(Person, samples=self.people(3))
+        with tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, 'people.log')
+            with RecordStore(path, Person, zdict=zdict) as store:
+                for person in self.people(20):
+                    store.append(person)
+            with RecordStore(path, Person, zdict=zdict) as store:
+                self.assertEqual(list(store), self.people(20))
+                self.assertEqual(store.get_raw(4), self.people(20)[4].serialize())
+            self.assertLess(os.path.getsize(path), sum(len(person.serialize()) for person in self.people(20)))
+
+
+class TestInterning(unittest.TestCase):
+    class Order(Encodium):
+        country = String.Definition(intern=True)
+        status = Enum.Definition(values=('open', 'paid'))
+        note = String.Definition(optional=True)
+
+    def test_intern(self):
+        orders = [self.Order.from_bencode(b'd7:country2:nz6:status4:paide'),
+                  self.Order.from_json('{"country": "nz", "status": "paid"}'),
+                  self.Order.from_bencode(b'd7:country2:nz4:note2:nz6:status4:paide')]
+        for order in orders[1:]:
+            self.assertIs(order.country, orders[0].country)
+            self.assertIs(order.status, orders[0].status)
+        self.assertIsNot(orders[2].note, orders[0].country)
+
+    def test_limit(self):
+        class Address(Encodium):
+            country = String.Definition(intern=True, intern_limit=2)
+
+        countries = [Address.from_bencode(b'd7:country2:%se' % code).country for code in (b'nz', b'au', b'us', b'us')]
+        self.assertIs(Address.from_json('{"country": "au"}').country, countries[1])
+        self.assertIsNot(countries[2], countries[3])
+        self.assertEqual(countries[2], countries[3])
+
+    def test_invalid_values_are_not_interned(self):
+        class Address(Encodium):
+            country = String.Definition(intern=True, intern_limit=1)
+
+        for invalid in ('{"country": [1]}', '{"country": {"a": 1}}', '{"country": 5}'):
+            self.assertRaises(ValidationError, Address.from_json, invalid)
+        self.assertRaises(ValidationError, Address.from_bencode, b'd7:countryli1eee')
+        self.assertRaises(ValidationError, Address.from_bencode, b'd7:countryi5ee')
+        nz = Address.from_json('{"country": "nz"}').country
+        self.assertIs(Address.from_bencode(b'd7:country2:nze').country, nz)
+
+    def test_enum_values(self):
+        self.assertRaises(ValidationError, self.Order, country='nz', status='lost')
+        self.assertRaises(ValidationError, self.Order.from_bencode, b'd7:country2:nz6:status4:losse')
+        self.assertRaises(ValidationError, self.Order.from_json, '{"country": "nz", "status": 1}')
+        self.assertEqual(self.Order(country='nz', status='open').to_json(), '{"country":"nz","note":null,"status":"open"}')
+
+
+class TestDefaults(unittest.TestCase):
+    class Counted(Integer):
+        class Definition(Integer.Definition):
+            checks = 0
+
+            def check_value(self, value):
+                type(self).checks += 1
+
+    def test_constant_defaults_checked_once(self):
+        class Settings(Encodium):
+            level = TestDefaults.Counted.Definition(default=3)
+            tags = List.Definition(String.Definition(), default=list, trusted_default=True)
+            names = List.Definition(TestDefaults.Counted.Definition(), default=lambda: [1])
+            seen = []
+
+            def check(self, changed_attributes):
+                self.seen.append(set(changed_attributes))
+
+        checks = self.Counted.Definition.checks
+        for _ in range(10):
+            settings = Settings()
+        self.assertEqual(settings.level, 3)
+        # Only the untrusted factory's items are checked.
+        self.assertEqual(self.Counted.Definition.checks, checks + 10)
+        self.assertEqual(Settings.seen[-1], {'level', 'tags', 'names'})
+        self.assertIsNot(Settings().tags, settings.tags)
+        self.assertEqual(Settings(level=4).level, 4)
+        self.assertRaises(ValidationError, Settings, level='x')
+
+    def test_invalid_default(self):
+        class Broken(Encodium):
+            age = Integer.Definition(non_negative=True, default=-1)
+
+        self.assertRaises(ValidationError, Broken)
+        self.assertEqual(Broken(age=1).age, 1)
+        self.assertRaises(ValidationError, Person, name='No age')
+
+
+class TestTryFromObj(unittest.TestCase):
+    class Visit(Encodium):
+        host = Person.Definition()
+        party = Party.Definition(optional=True)
+
+        def check(self, changed_attributes):
+            if self.host.age < 18:
+                raise ValidationError("host must be an adult")
+
+    def test_valid(self):
+        obj = {b'host': {b'age': 30, b'name': b'John'}, b'party': {b'people': []}}
+        result = self.Visit.try_from_obj(obj)
+        self.assertTrue(result)
+        self.assertEqual(result.errors, [])
+        self.assertEqual(result.get(), self.Visit.from_obj(obj))
+        self.assertTrue(result.value.host.diabetic)
+
+    def test_errors(self):
+        def codes(obj, all_errors=True):
+            result = self.Visit.try_from_obj(obj, all_errors)
+            self.assertFalse(result)
+            self.assertIsNone(result.value)
+            return [(error.field, error.code) for error in result.errors]
+
+        obj = {'host': {'age': -1, 'name': 5, 'height': 2}, 'party': {'people': 'x'}}
+        self.assertEqual(codes(obj), [('host.age', 'value'), ('host.name', 'type'), ('party.people', 'decode')])
+        self.assertEqual(codes(obj, all_errors=False), [('host.age', 'value')])
+        self.assertEqual(codes({'host': {'name': 'Jo'}}), [('host.age', 'missing')])
+        self.assertEqual(codes({}), [('host', 'missing')])
+        self.assertEqual(codes({'host': {'age': 10, 'name': 'Jo'}}), [(None, 'check')])
+        self.assertEqual(codes({'host': {'age': 20, 'name': b'\xff'}, 'party': 5}), [('host.name', 'decode'), ('party', 'decode')])
+        self.assertEqual(codes([]), [(None, 'type')])
+
+    def test_list_and_map_items(self):
+        class Registry(Encodium):
+            cities = Map.Definition(String.Definition(), City.Definition())
+
+        people = [{'age': 1, 'name': 'a'}, {'age': -1, 'name': 'b'}, {'age': 'x', 'name': 'c'}]
+        obj = {'cities': {'x': {'parties': [{'people': []}, {'people': people}]}, 'y': {'parties': 5}}}
+        result = Registry.try_from_obj(obj, all_errors=True)
+        self.assertEqual(sorted([(error.field, error.code) for error in result.errors]), [
+            ('cities[x].parties[1].people[1].age', 'value'),
+            ('cities[x].parties[1].people[2].age', 'type'),
+            ('cities[y].parties', 'decode')])
+        self.assertEqual(len(Registry.try_from_obj(obj).errors), 1)
+        self.assertEqual(result.errors[0].message if result.errors[0].code == 'value' else result.errors[1].message,
+                         'cities[x].parties[1].people[1].age must not be negative')
+        obj['cities']['x']['parties'][1]['people'] = people[:1] + [None]
+        self.assertEqual([error.field for error in Registry.try_from_obj(obj).errors], ['cities[x].parties[1].people[1]'])
+        del obj['cities']['y']
+        obj['cities']['x']['parties'][1]['people'] = people[:1]
+        self.assertEqual(Registry.try_from_obj(obj).get(), Registry.from_obj(obj))
+
+    def test_messages(self):
+        result = self.Visit.try_from_obj({'host': {'age': 'old', 'name': 'x' * 51}}, all_errors=True)
+        self.assertEqual([error.message for error in result.errors], [
+            "host.age is supposed to be type <class 'int'>, but was set to something of type <class 'str'>.",
+            "host.name was set to a string of length 51 but cannot be longer than 50"])
+        with self.assertRaises(ValidationError) as raised:
+            result.get()
+        self.assertEqual(raised.exception.args[0], result.errors[0].message)
+        self.assertEqual(self.Visit.try_from_obj(5).errors[0].message, 'Cannot create Encodium object from int')
+
+    def test_unknown_fields(self):
+        class Strict(Encodium):
+            _encodium_unknown_fields = 'error'
+            age = Integer.Definition()
+
+        result = Strict.try_from_obj({'age': 1, 'zzz': 2, 'aaa': 3}, all_errors=True)
+        self.assertEqual([(error.field, error.code) for error in result.errors], [('aaa', 'unknown'), ('zzz', 'unknown')])
+        self.assertEqual(result.errors[0].message, 'aaa is not a field of Strict')
+        self.assertEqual(Strict._encodium_unknown_count, 2)
+
+
+class TestServer(unittest.TestCase):
+    def run_server(self, handler, client, **kwargs):
+        async def main():
+            async with Server(Person, handler, **kwargs) as server:
+                reader, writer = await asyncio.open_connection(*server.address)
+                try:
+                    return await client(server, reader, writer)
+                finally:
+                    writer.close()
+        return asyncio.run(main())
+
+    def test_pipelined_requests(self):
+        async def older(person):
+            # Later requests finish first, but are answered in order.
+            await asyncio.sleep(0.01 * (5 - person.age))
+            return person.evolve(age=person.age + 1)
+
+        async def client(server, reader, writer):
+            for age in range(5):
+                writer.write((Person(name='P', age=age).to_json() + '\n').encode())
+            big = Person(name='x' * 50, age=9)
+            writer.write((big.to_json() + '\n').encode())
+            return [Person.from_json((await reader.readline()).decode()).age for _ in range(6)]
+
+        # Every message is decoded in the executor.
+        self.assertEqual(self.run_server(older, client, offload_size=0), [1, 2, 3, 4, 5, 10])
+
+    def test_limits(self):
+        running = []
+        peak = []
+
+        async def handler(person):
+            running.append(person)
+            peak.append(len(running))
+            await asyncio.sleep(0.01)
+            running.remove(person)
+            return person
+
+        async def client(server, reader, writer):
+            writer.write(b''.join([(Person(name='P', age=i).to_json() + '\n').encode() for i in range(20)]))
+            for _ in range(20):
+                await reader.readline()
+            writer.write(b'{"name": "' + b'x' * 200 + b'", "age": 1}\n')
+            return await reader.readline()
+
+        self.assertEqual(self.run_server(handler, client, max_in_flight=3, max_pending=5, max_size=100), b'')
+        self.assertEqual(max(peak), 3)
+
+    def test_invalid_request_closes_connection(self):
+        async def client(server, reader, writer):
+            writer.write((Person(name='A', age=1).to_json() + '\n{"age": -1}\n').encode())
+            return [await reader.readline(), await reader.readline()]
+
+        first, second = self.run_server(lambda person: person, client)
+        self.assertEqual(Person.from_json(first.decode()).name, 'A')
+        self.assertEqual(second, b'')
+
+    def test_graceful_close(self):
+        started = []
+
+        async def slow(person):
+            started.append(person)
+            await asyncio.sleep(0.05)
+            return person
+
+        async def client(server, reader, writer):
+            writer.write((Person(name='Slow', age=1).to_json() + '\n').encode())
+            while not started:
+                await asyncio.sleep(0.001)
+            closing = asyncio.ensure_future(server.close())
+            reply = await reader.readline()
+            await closing
+            return reply, await reader.readline()
+
+        reply, after = self.run_server(slow, client)
+        self.assertEqual(Person.from_json(reply.decode()).name, 'Slow')
+        self.assertEqual(after, b'')
+
+
+class Upload(Encodium):
+    data = Bytes.Definition()
+    owner = Person.Definition()
+    tags = List.Definition(String.Definition())
+    note = String.Definition(default='none')
+
+
+def _attached_length(handle, results):
+    with attach(Upload, handle) as upload:
+        results.put((len(upload.data), upload.owner.name))
+
+
+class TestSharedMemory(unittest.TestCase):
+    def upload(self):
+        return Upload(data=b'x' * 1000000, owner=Person(name='John', age=30), tags=['a', 'b'])
+
+    def test_attach(self):
+        with share(self.upload()) as shared:
+            with attach(Upload, shared.handle) as upload:
+                self.assertIsInstance(upload.data, memoryview)
+                self.assertEqual(upload.data, b'x' * 1000000)
+                self.assertEqual(upload.owner, Person(name='John', age=30))
+                self.assertIs(upload.owner, upload.owner)
+                self.assertEqual(upload.tags, ['a', 'b'])
+                self.assertEqual(upload.note, 'none')
+                self.assertEqual(upload.decode(), self.upload())
+                self.assertRaises(AttributeError, getattr, upload, 'missing')
+                data = upload.data
+            self.assertRaises(ValueError, bytes, data)
+            handle = Handle.from_json(shared.handle.to_json())
+        self.assertRaises(FileNotFoundError, attach, Upload, handle)
+
+    def test_other_process(self):
+        results = multiprocessing.get_context('spawn').Queue()
+        with share(self.upload()) as shared:
+            process = multiprocessing.get_context('spawn').Process(target=_attached_length, args=(shared.handle, results))
+            process.start()
+            self.assertEqual(results.get(timeout=30), (1000000, 'John'))
+            process.join()
+            # The segment outlives the receiver.
+            with attach(Upload, shared.handle) as upload:
+                self.assertEqual(upload.owner.age, 30)
+
+    def test_invalid_fields(self):
+        with share(Person(name='John', age=30)) as shared:
+            with attach(Upload, shared.handle) as upload:
+                self.assertRaises(ValidationError, getattr, upload, 'owner')
+            with attach(Dad, shared.handle) as dad:
+                self.assertEqual(dad.name, 'John')
+                self.assertRaises(ValidationError, getattr, dad, 'puns')
+        memory = shared_memory.SharedMemory(create=True, size=11)
+        try:
+            memory.buf[:11] = b'd1x:agei1ee'
+            self.assertRaises(ValidationError, attach, Person, Handle(name=memory.name, size=11))
+        finally:
+            memory.close()
+            memory.unlink()
+
+        memory = shared_memory.SharedMemory(create=True, size=20)
+        try:
+            memory.buf[:20] = b'd3:agei1xe4:name1:xe'
+            with attach(Person, Handle(name=memory.name, size=20)) as person:
+                self.assertEqual(person.name, 'x')
+                with self.assertRaisesRegex(ValidationError, '^age '):
+                    person.age
+        finally:
+            memory.close()
+            memory.unlink()
+
+    def test_failed_share_frees_segment(self):
+        class Broken(Encodium):
+            name = String.Definition()
+
+            def encode_into(self, buffer, offset=0, codec='bencode'):
+                raise RuntimeError('broken')
+
+        names = []
+        created = shared_memory.SharedMemory.__init__
+
+        def recording(memory, *args, **kwargs):
+            created(memory, *args, **kwargs)
+            names.append(memory.name)
+
+        shared_memory.SharedMemory.__init__ = recording
+        try:
+            self.assertRaises(RuntimeError, share, Broken(name='x'))
+        finally:
+            shared_memory.SharedMemory.__init__ = created
+        self.assertEqual(len(names), 1)
+        self.assertRaises(FileNotFoundError, shared_memory.SharedMemory, names[0])
+
+
+class TestGraph(unittest.TestCase):
+    class Directory(Encodium):
+        owner = Person.Definition()
+        by_name = Map.Definition(String.Definition(), Person.Definition())
+        city = City.Definition(optional=True)
+
+    def city(self):
+        john = Person(name='John', age=30)
+        jane = Person(name='Jane', age=31)
+        return City(parties=[Party(people=[john, jane]), Party(people=[jane, john, john])]), john, jane
+
+    def test_shared_objects(self):
+        city, john, jane = self.city()
+        for codec in ('bencode', 'json'):
+            data = city.to_graph(codec)
+            decoded = City.from_graph(data, codec)
+            self.assertEqual(decoded, city)
+            first, second = decoded.parties
+            self.assertIs(first.people[0], second.people[1])
+            self.assertIs(first.people[0], second.people[2])
+            self.assertIs(first.people[1], second.people[0])
+            self.assertIsNot(first.people[0], first.people[1])
+        self.assertLess(len(city.to_graph()), len(city.to_bencode()))
+        self.assertEqual(City.from_graph(City(parties=[]).to_graph()), City(parties=[]))
+
+    def test_maps_and_nesting(self):
+        city, john, jane = self.city()
+        directory = self.Directory(owner=john, by_name={'john': john, 'jane': jane}, city=city)
+        for codec in ('bencode', 'json'):
+            decoded = self.Directory.from_graph(directory.to_graph(codec), codec)
+            self.assertEqual(decoded, directory)
+            self.assertIs(decoded.owner, decoded.by_name['john'])
+            self.assertIs(decoded.owner, decoded.city.parties[1].people[2])
+        self.assertEqual(len(json.loads(directory.to_graph('json'))), 6)
+
+    def test_invalid_graphs(self):
+        self.assertRaises(ValidationError, Party.from_graph, b'le')
+        self.assertRaises(ValidationError, Party.from_graph, b'de')
+        # References must be to earlier objects.
+        self.assertRaises(ValidationError, Party.from_graph, b'ld6:peopleli0eeee')
+        self.assertRaises(ValidationError, Party.from_graph, b'ld6:peopleli5eeee')
+        # A reference to an object of the wrong type.
+        self.assertRaises(ValidationError, Party.from_graph, '[{"people":[]},{"people":[0]}]', 'json')
+        self.assertRaises(ValidationError, Party.from_graph, b'ld3:agei-1e4:name1:ted6:peopleli0eeee')
+        self.assertEqual(len(Party.from_graph(b'ld3:agei1e4:name1:ted6:peopleli0ei0eeee').people), 2)
+        self.assertRaises(ValueError, Party(people=[]).to_graph, 'xml')
+
+
+class TestScan(unittest.TestCase):
+    class Sample(Encodium):
+        sensor = UInt16.Definition()
+        name = String.Definition()
+        ok = Boolean.Definition()
+        values = List.Definition(Integer.Definition(), optional=True)
+
+    def records(self):
+        return [self.Sample(sensor=i, name='s%d' % (i % 3), ok=i % 2 == 0, values=[i] * i) for i in range(30)]
+
+    def data(self):
+        return b''.join([record.to_bencode() for record in self.records()])
+
+    def test_scan(self):
+        records = self.records()
+        where = {'sensor': ('>=', 10), 'name': ('==', 's1'), 'ok': ('==', True)}
+        expected = [r for r in records if r.sensor >= 10 and r.name == 's1' and r.ok]
+        self.assertEqual(list(self.Sample.scan(self.data(), where)), expected)
+        self.assertEqual(list(self.Sample.scan(bytearray(self.data()), where)), expected)
+        for chunk_size in (1, 7, 65536):
+            self.assertEqual(list(self.Sample.scan(io.BytesIO(self.data()), where, chunk_size)), expected)
+        self.assertEqual(len(list(self.Sample.scan(self.data(), {'name': ('in', ['s0', b's2'])}))), 20)
+        self.assertEqual(len(list(self.Sample.scan(self.data(), {'sensor': ('<', 5), 'name': ('!=', 's0')}))), 3)
+        self.assertEqual(list(self.Sample.scan(b'', {})), [])
+        self.assertEqual(len(list(Person.scan(b''.join(p.to_bencode() for p in [Person(name='a', age=1), Person(name='b', age=2, optional=3)]), {'optional': ('>', 0)}))), 1)
+
+    def test_only_matches_are_decoded(self):
+        data = self.data() + b'd4:name2:s06:sensor2:\x00\x01e'
+        # The invalid last record doesn't match, so it isn't decoded.
+        self.assertEqual(len(list(self.Sample.scan(data, {'name': ('==', 's1')}))), 10)
+        self.assertRaises(ValidationError, list, self.Sample.scan(data, {'name': ('==', 's0')}))
+        self.assertRaises(ValidationError, list, self.Sample.scan(self.data()[:-1], {'name': ('==', 's0')}))
+        for data in (b'd3:agei1xee', b'd1x:agei1ee', b'd3:age2x:abe'):
+            self.assertRaises(ValidationError, list, Person.scan(data, {'age': ('==', 1)}))
+            self.assertRaises(ValidationError, list, Person.scan(io.BytesIO(data), {'age': ('==', 1)}))
+
+    def test_invalid_conditions(self):
+        self.assertRaises(ValueError, self.Sample.scan, b'', {'values': ('==', [])})
+        self.assertRaises(ValueError, self.Sample.scan, b'', {'height': ('==', 1)})
+        self.assertRaises(ValueError, self.Sample.scan, b'', {'sensor': ('~', 1)})
+        self.assertRaises(ValueError, Party.scan, b'', {'people': ('==', 1)})
+
+
+class TestJsonDecoding(unittest.TestCase):
+    class Archive(Encodium):
+        _encodium_unknown_fields = 'collect'
+        blobs = List.Definition(Bytes.Definition(optional=True))
+        city = City.Definition()
+        owners = Map.Definition(String.Definition(), Person.Definition(), optional=True)
+        counts = List.Definition(List.Definition(Integer.Definition()))
+
+    def archive(self):
+        city = City(parties=[Party(people=[Person(name='J\u00f6hn "J"', age=30)]), Party(people=[])])
+        return self.Archive(blobs=[b'\x00\xff', None, b''], city=city, owners={'a': Person(name='A', age=1)}, counts=[[1, 2], []])
+
+    def test_decodes_like_from_obj(self):
+        archive = self.archive()
+        text = archive.to_json()
+        self.assertEqual(self.Archive.from_json(text), archive)
+        self.assertEqual(self.Archive.from_json(text.encode()), archive)
+        spaced = json.dumps(json.loads(text), indent=2)
+        self.assertEqual(self.Archive.from_json(spaced), archive)
+        extra = json.loads(text)
+        extra['later'] = {'nested': [1, {'x': None}]}
+        decoded = self.Archive.from_json(json.dumps(extra))
+        self.assertEqual(decoded, archive)
+        self.assertEqual(decoded._encodium_unknown, {'later': {'nested': [1, {'x': None}]}})
+        self.assertEqual(Person.from_json(' {"age": 1, "name": "x", "diabetic": null} ').diabetic, True)
+
+    def test_errors(self):
+        text = self.archive().to_json()
+        for invalid in (text[:-1], text + 'x', text.replace(':', ' '), text.replace(',', ',,', 1),
+                        '{"blobs": [1 2]}', '{age: 1}', '{"a": tru}', b'{"name": "\xff"}'):
+            self.assertRaises(ValidationError, self.Archive.from_json, invalid)
+        self.assertRaises(ValidationError, self.Archive.from_json, text.replace('"AP8="', '"A"'))
+        self.assertRaises(ValidationError, Party.from_json, '{"people": [{"age": -1, "name": "x"}]}')
+        self.assertRaises(ValidationError, Party.from_json, '{"people": [5]}')
+        for top_level, message in (('[]', 'Cannot create Encodium object from list'), ('5', 'Cannot create Encodium object from int'),
+                                   ('null', 'Invalid JSON: null')):
+            with self.assertRaises(ValidationError) as raised:
+                Person.from_json(top_level)
+            self.assertEqual(raised.exception.args[0], message)
+
+
+class TestJsonBackends(unittest.TestCase):
+    class Mixed(Encodium):
+        name = String.Definition()
+        data = Bytes.Definition(optional=True)
+        big = Integer.Definition()
+        tags = Map.Definition(String.Definition(), List.Definition(Integer.Definition()))
+
+    class Measured(Encodium):
+        values = List.Definition(Float64.Definition())
+
+    def setUp(self):
+        self.backend = encodium.get_json_backend()
+
+    def tearDown(self):
+        encodium.set_json_backend(self.backend.name)
+
+    def objects(self):
+        return [self.Mixed(name='\u00f6\x7f\x1f/"\\ \U0001f600', data=b'\xff', big=2 ** 70, tags={'b': [1], 'a': []}),
+                self.Mixed(name='plain', big=-1, tags={}),
+                self.Measured(values=[1e16, 0.1, -0.0, 1.5e-07, float('inf')]),
+                City(parties=[Party(people=[Person(name='John', age=30)])])]
+
+    def test_backends_agree(self):
+        encodium.set_json_backend('json')
+        expected = [obj.to_json() for obj in self.objects()]
+        self.assertEqual(expected[1], '{"big":-1,"data":null,"name":"plain","tags":{}}')
+        for name in encodium.json_backends:
+            encodium.set_json_backend(name)
+            self.assertEqual(encodium.get_json_backend().name, name)
+            for obj, text in zip(self.objects(), expected):
+                self.assertEqual(obj.to_json(), text)
+                self.assertEqual(obj.__class__.from_json(text), obj)
+                self.assertEqual(obj.__class__.from_json(text.encode()), obj)
+                self.assertEqual(obj.encoded_size('json'), len(text.encode()))
+            self.assertRaises(ValidationError, Person.from_json, '{"age": 1,}')
+            self.assertRaises(ValidationError, self.Mixed.from_json, '{"big": 1.5, "name": "x", "tags": {}}')
+
+    def test_duplicate_keys(self):
+        messages = set()
+        for name in encodium.json_backends:
+            encodium.set_json_backend(name)
+            with self.assertRaises(ValidationError) as raised:
+                Person.from_json('{"age": 1, "age": null, "name": "x"}')
+            messages.add(raised.exception.args[0])
+            self.assertEqual(Person.from_json('{"age": 1, "name": "x", "diabetic": false, "diabetic": null}').diabetic, True)
+            self.assertEqual(Person.from_json('{"age": 1, "age": 2, "name": "x"}').age, 2)
+        self.assertEqual(len(messages), 1)
+
+    def test_custom_to_json(self):
+        class Hex(Encodium):
+            class Definition(Integer.Definition):
+                def to_json(self, value):
+                    return '"%x"' % value
+
+        class Holder(Encodium):
+            h = Hex.Definition()
+
+        class Outer(Encodium):
+            holders = List.Definition(Holder.Definition())
+
+        holder = Holder(h=255)
+        outer = Outer(holders=[holder])
+        for name in encodium.json_backends:
+            encodium.set_json_backend(name)
+            self.assertEqual(holder.to_json(), '{"h":"ff"}')
+            self.assertEqual(outer.to_json(), '{"holders":[{"h":"ff"}]}')
+            for obj in (holder, outer):
+                buffer = bytearray(obj.encoded_size('json'))
+                self.assertEqual(obj.encode_into(buffer, codec='json'), len(buffer))
+                self.assertEqual(buffer.decode(), obj.to_json())
+        self.assertFalse(Person._encodium_custom_json)
+
+    def test_selection(self):
+        self.assertIn('json', encodium.json_backends)
+        encodium.set_json_backend('auto')
+        self.assertEqual(encodium.get_json_backend().name, next(iter(encodium.json_backends)))
+        self.assertRaises(ValueError, encodium.set_json_backend, 'simplejson')
+
+
+class TestThreading(unittest.TestCase):
+    class Visit(Encodium):
+        city = City.Definition()
+        tags = List.Definition(String.Definition(intern=True))
+
+    def visits(self):
+        party = Party(people=[Person(name='John', age=30), Person(name='Jane', age=31)])
+        city = City(parties=[party, party])
+        return [self.Visit(city=city, tags=['tag%d' % (i % 5)]) for i in range(200)]
+
+    def test_encode_and_decode_many(self):
+        visits = self.visits()
+        for codec in ('bencode', 'json'):
+            expected = [visit.to_bencode() if codec == 'bencode' else visit.to_json() for visit in visits]
+            self.assertEqual(Encodium.encode_many(visits, codec), expected)
+            self.assertEqual(self.Visit.decode_many(expected, codec), visits)
+            with ThreadPoolExecutor(4) as executor:
+                self.assertEqual(Encodium.encode_many(visits, codec, executor, chunk_size=7), expected)
+                self.assertEqual(self.Visit.decode_many(expected, codec, executor, chunk_size=7), visits)
+        with ThreadPoolExecutor(4) as executor:
+            self.assertRaises(ValidationError, Person.decode_many, [b'd3:agei1ee', b'd3:agei-1ee'], executor=executor)
+        self.assertRaises(ValueError, Encodium.encode_many, visits, 'xml')
+
+    def test_class_tables_are_read_only(self):
+        with self.assertRaises(TypeError):
+            Person._encodium_fields['height'] = Integer.Definition()
+        self.assertEqual(Dad._encodium_fields['age'], Person._encodium_fields['age'])
+
+    def test_stress(self):
+        class Counted(Encodium):
+            name = String.Definition(intern=True)
+
+        visits = self.visits()
+        data = [visit.to_bencode() for visit in visits]
+        extra = [b'd4:name1:x5:other1:ye'] * 100
+        barrier = threading.Barrier(8)
+        results = []
+
+        def work():
+            barrier.wait()
+            # The nested objects are shared by every visit and every thread.
+            encoded = Encodium.encode_many(visits)
+            sizes = [visit.encoded_size() for visit in visits]
+            decoded = self.Visit.decode_many(data)
+            counted = Counted.decode_many(extra)
+            results.append((encoded, sizes, decoded, counted))
+
+        threads = [threading.Thread(target=work) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        self.assertEqual(len(results), 8)
+        for encoded, sizes, decoded, counted in results:
+            self.assertEqual(encoded, data)
+            self.assertEqual(sizes, [len(item) for item in data])
+            self.assertEqual(decoded, visits)
+            self.assertEqual(len(counted), 100)
+        self.assertEqual(Counted._encodium_unknown_count, 800)
+        names = set([id(obj.name) for _, _, _, counted in results for obj in counted])
+        self.assertEqual(len(names), 1)
+
+
+class TestDeprecated(unittest.TestCase):
+    def test_round_trip(self):
+        from encodium import deprecated
+
+        class Upper(deprecated.String):
+            def deserialize(self, data):
+                return data.decode('utf-8')[1:].lower()
+
+        class Legacy(deprecated.Field):
+            def fields():
+                name = deprecated.String(max_length=5)
+                age = deprecated.Integer()
+                tags = deprecated.List(deprecated.String(), optional=True)
+                data = deprecated.Bytes(optional=True)
+
+        legacy = Legacy.make(name='ab', age=300, tags=['x'])
+        data = Legacy().serialize(legacy)
+        self.assertEqual(data, b'\x01\x03\x01ab\x02\x01,\x04\x01\x02\x01x\x00')
+        self.assertEqual(Legacy.make(data), legacy)
+        self.assertEqual(Legacy.make(memoryview(data)), legacy)
+        self.assertIs(Legacy().get_fields(), Legacy().get_fields())
+
+        legacy = Legacy.make(name='ab', age=1, data=b'y' * 300)
+        data = Legacy().serialize(legacy)
+        self.assertEqual(data[:12], b'\x01\x03\x01ab\x01\x01\x00\xfb\x01-\x01')
+        self.assertEqual(Legacy.make(data), legacy)
+        self.assertIsNone(Legacy.make(data).tags)
+        self.assertRaises(deprecated.ValidationError, Legacy.make, name='abcdef', age=1)
+
+        class Shouting(deprecated.Field):
+            def fields():
+                word = Upper()
+                words = deprecated.List(Upper())
+                inner = Legacy()
+
+        shouting = Shouting.make(word='HI', words=['A', 'B'], inner=Legacy.make(name='ab', age=1))
+        decoded = Shouting.make(Shouting().serialize(shouting))
+        self.assertEqual((decoded.word, decoded.words, decoded.inner), ('hi', ['a', 'b'], shouting.inner))
+
+
+class TestRecordStore(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'people.log')
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def people(self, n):
+        return [Person(age=i, name='Person %d' % i, diabetic=i % 2 == 0) for i in range(n)]
+
+    def test_append_and_read(self):
+        with RecordStore(self.path, Person) as store:
+            for person in self.people(10):
+                store.append(person)
+            self.assertEqual(store[3], self.people(10)[3])
+            self.assertEqual(store[-1], self.people(10)[-1])
+            store.append(Person(age=99, name='Late'))
+            self.assertEqual(store[10].name, 'Late')
+            self.assertRaises(IndexError, store.__getitem__, 11)
+            self.assertRaises(TypeError, store.append, City(parties=[]))
+
+        with RecordStore(self.path, Person) as store:
+            self.assertEqual(len(store), 11)
+            self.assertEqual(list(store.iter_range(2, 5)), self.people(10)[2:5])
+            self.assertEqual(list(store)[:10], self.people(10))
+
+    def test_reads_do_not_fsync(self):
+        calls = []
+        fsync = os.fsync
+        os.fsync = lambda fd: calls.append(fd)
+        try:
+            with RecordStore(self.path, Person) as store:
+                for person in self.people(5):
+                    store.append(person)
+                    self.assertEqual(store[-1], person)
+                self.assertEqual(calls, [])
+            self.assertEqual(len(calls), 2)
+        finally:
+            os.fsync = fsync
+
+    def test_recovers_partial_append(self):
+        with RecordStore(self.path, Person) as store:
+            for person in self.people(5):
+                store.append(person)
+        with open(self.path, 'ab') as f:
+            f.write(b'\x00\x00\x01\x00garbage')
+        with RecordStore(self.path, Person) as store:
+            self.assertEqual(len(store), 5)
+            store.append(Person(age=5, name='Person 5'))
+            self.assertEqual(store[5].name, 'Person 5')
+
+    def test_recovers_missing_index_entries(self):
+        with RecordStore(self.path, Person) as store:
+            for person in self.people(5):
+                store.append(person)
+        with open(self.path + '.idx', 'r+b') as f:
+            f.truncate(16)
+        with RecordStore(self.path, Person) as store:
+            self.assertEqual(len(store), 5)
+            self.assertEqual(list(store), self.people(5))
+
+
+class TestFieldIndex(unittest.TestCase):
+    class Citizen(Encodium):
+        name = String.Definition(indexed=True)
+        age = Integer.Definition(indexed=True, optional=True)
+
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.path = os.path.join(self.directory.name, 'citizens.log')
+        self.citizens = [self.Citizen(name=name, age=age) for name, age in
+                         [('John', 25), ('Lucy', 30), ('John', 40), ('Anna', None), ('Zed', 30)]]
+
+    def tearDown(self):
+        self.directory.cleanup()
+
+    def fill(self, store):
+        for citizen in self.citizens:
+            store.append(citizen)
+
+    def check_lookups(self, store):
+        self.assertEqual([c.age for c in store.find('name', 'John')], [25, 40])
+        self.assertEqual(list(store.index('age').lookup(30)), [1, 4])
+        self.assertEqual([c.name for c in store.find_range('name', 'B', 'Z')], ['John', 'John', 'Lucy'])
+        self.assertEqual([c.age for c in store.find_range('age', start=26)], [30, 30, 40])
+        self.assertEqual(list(store.find('name', 'Nobody')), [])
+
+    def test_lookups(self):
+        with RecordStore(self.path, self.Citizen) as store:
+            self.fill(store)
+            self.check_lookups(store)
+            self.assertRaises(KeyError, store.index, 'nonexistent')
+        with RecordStore(self.path, self.Citizen) as store:
+            self.check_lookups(store)
+
+    def test_compaction(self):
+        with RecordStore(self.path, self.Citizen) as store:
+            store.index('name').compact_threshold = 2
+            self.fill(store)
+            self.check_lookups(store)
+        with RecordStore(self.path, self.Citizen) as store:
+            self.check_lookups(store)
+
+    def test_rebuild_with_bounded_chunks(self):
+        with RecordStore(self.path, self.Citizen) as store:
+            self.fill(store)
+            store.rebuild_index('name', chunk_size=2)
+            store.rebuild_index('age', chunk_size=2)
+            self.check_lookups(store)
+
+    def test_catches_up_on_missing_index(self):
+        with RecordStore(self.path, self.Citizen) as store:
+            self.fill(store)
+        for name in os.listdir(self.directory.name):
+            if '.name.' in name:
+                os.remove(os.path.join(self.directory.name, name))
+        with RecordStore(self.path, self.Citizen) as store:
+            self.check_lookups(store)
+
+    def test_forgets_lost_records(self):
+        for threshold, lost in ((100, 1), (2, 3)):
+            with RecordStore(self.path, self.Citizen) as store:
+                store.index('name').compact_threshold = threshold
+                self.fill(store)
+            # Tear the first lost record, as if the process died writing it.
+            with open(self.path + '.idx', 'rb') as f:
+                f.seek(-8 * lost, os.SEEK_END)
+                offset, = struct.unpack('>Q', f.read(8))
+            with open(self.path, 'r+b') as f:
+                f.truncate(offset + 1)
+            with RecordStore(self.path, self.Citizen) as store:
+                self.assertEqual(len(store), 5 - lost)
+                store.append(self.Citizen(name='Bob', age=1))
+                self.assertEqual([c.name for c in store.find('name', 'Zed')], [])
+                self.assertEqual([c.name for c in store.find('name', 'Bob')], ['Bob'])
+                self.assertEqual(list(store.index('age').lookup(30)), [1])
+            for name in os.listdir(self.directory.name):
+                os.remove(os.path.join(self.directory.name, name))
+
+
+class TestRpc(unittest.TestCase):
+    class Lookup(Encodium):
+        name = String.Definition()
+
+    def setUp(self):
+        people = {'John': Person(age=25, name='John'), 'Lucy': Person(age=30, name='Lucy')}
+        self.lookup = Method('lookup', self.Lookup, Person)
+        self.server = LoopbackServer({self.lookup: lambda request: people[request.name]})
+
+    def tearDown(self):
+        self.server.close()
+
+    def test_pipelined_calls(self):
+        pool = ConnectionPool()
+        try:
+            connection = pool.get(self.server.address)
+            self.assertIs(pool.get(self.server.address), connection)
+            futures = [connection.call_async(self.lookup, self.Lookup(name=name)) for name in ['John', 'Lucy'] * 50]
+            self.assertEqual([future.result(5).name for future in futures], ['John', 'Lucy'] * 50)
+            self.assertRaises(RemoteError, connection.call, self.lookup, self.Lookup(name='Nobody'), 5)
+            self.assertRaises(TypeError, connection.call, self.lookup, Person(age=1, name='Wrong'))
+        finally:
+            pool.close()
+
+    def test_async_calls(self):
+        async def calls():
+            connection = await AsyncConnection.open(self.server.address)
+            try:
+                return await asyncio.gather(*[connection.call(self.lookup, self.Lookup(name=name))
+                                              for name in ['Lucy', 'John'] * 20])
+            finally:
+                await connection.close()
+
+        people = asyncio.run(calls())
+        self.assertEqual([person.age for person in people], [30, 25] * 20)
+
+    def test_invalid_frame(self):
+        for frame in (b'\x00\x00\x00\x03zzz', b'\x00\x00\x00\x0ad2:idi1xee'):
+            self.check_invalid_frame(frame)
+
+    def check_invalid_frame(self, frame):
+        listener = socket.socket()
+        listener.bind(('127.0.0.1', 0))
+        listener.listen(1)
+
+        def serve():
+            sock, _ = listener.accept()
+            sock.recv(65536)
+            sock.sendall(frame)
+            sock.recv(65536)
+            sock.close()
+
+        server = threading.Thread(target=serve)
+        server.start()
+        pool = ConnectionPool()
+        try:
+            connection = pool.get(listener.getsockname())
+            self.assertRaises(ValidationError, connection.call, self.lookup, self.Lookup(name='John'), 5)
+            self.assertTrue(connection.closed)
+            self.assertRaises(ConnectionError, connection.call_async, self.lookup, self.Lookup(name='John'))
+        finally:
+            pool.close()
+            server.join(5)
+            listener.close()
+
+    def test_async_invalid_frame(self):
+        for frame in (b'\x00\x00\x00\x03zzz', b'\x00\x00\x00\x0ad2:idi1xee'):
+            self.check_async_invalid_frame(frame)
+
+    def check_async_invalid_frame(self, frame):
+        async def serve(reader, writer):
+            await reader.read(65536)
+            writer.write(frame)
+            await reader.read(65536)
+            writer.close()
+
+        async def calls():
+            server = await asyncio.start_server(serve, '127.0.0.1', 0)
+            connection = await AsyncConnection.open(server.sockets[0].getsockname())
+            try:
+                with self.assertRaises(ValidationError):
+                    await asyncio.wait_for(connection.call(self.lookup, self.Lookup(name='John')), 5)
+                self.assertTrue(connection.closed)
+            finally:
+                await connection.close()
+                server.close()
+                await server.wait_closed()
+
+        asyncio.run(calls())
+
 
 if __name__ == '__main__':
     unittest.main()